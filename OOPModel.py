@@ -3,18 +3,32 @@ import bcrypt
 
 
 # """ PYMONGO IMPORTS """
-from pymongo import MongoClient
-
-
-# """ PYMONGO SETUP """
-mongo = MongoClient('localhost', 27017)
-db = mongo.develop_database
+from pymongo import IndexModel, ASCENDING, InsertOne, UpdateOne
+from pymongo.errors import DuplicateKeyError, BulkWriteError
 
 
 # """ BSON IMPORTS """
 from bson.objectid import ObjectId
 
 
+# """ FLASK IMPORTS """
+from flask import current_app, has_app_context
+
+
+# """ LOCAL IMPORTS """
+from utils import database
+from utils.auth_cache import CredentialCache
+from utils.hash_pool import hash_pool
+from utils.bcrypt_cost import bcrypt_cost
+from utils.indexes import create_indexes
+from utils.queryset import QuerySet
+from utils.unit_of_work import current_unit_of_work
+
+
+# """ AUTH CACHE """
+credential_cache = CredentialCache()
+
+
 # """ EXCEPTIONS """
 class NullDocumentException(Exception):
     pass
@@ -22,9 +36,14 @@ class NullDocumentException(Exception):
 
 class DBModel(object):
 
+    INDEXES = []
+    # saves made during a request wait for the unit of work to flush them
+    DEFERRED_SAVE = True
+
     def __init__(self, identifier=None, rawdata=None):
 
         self.is_saved = False
+        self._clear_changes()
         if identifier:
             self._queryload({'_id': ObjectId(identifier)})
         elif rawdata:
@@ -36,51 +55,194 @@ class DBModel(object):
 
         self.is_saved = True
         self.data = data
+        self._clear_changes()
+
+    def _clear_changes(self):
+
+        self._dirty = set()
+        self._unset = set()
+
+    def is_dirty(self):
+
+        return bool(self._dirty or self._unset)
+
+    def _changes(self):
+
+        # minimal update document for the keys touched since the last save
+        changes = {}
+        updated = self._dirty - {'_id'}
+        if updated:
+            changes['$set'] = dict((key, self.data[key]) for key in updated)
+        if self._unset:
+            changes['$unset'] = dict((key, '') for key in self._unset)
+        return changes
 
     def _queryload(self, query):
 
+        uow = current_unit_of_work()
+        if uow is not None:
+            loaded = uow.get(type(self), query)
+            if loaded is not None:
+                # a constructor can't hand back the mapped instance, so this
+                # one takes over its state: data, changes and saved flag
+                self.__dict__ = loaded.__dict__
+                return
+
         collection = self._collection()
         entity = collection.find_one(query)
         if not entity:
             raise NullDocumentException()
         self._rawload(entity)
+        if uow is not None:
+            uow.add(self, query)
+
+    @classmethod
+    def _from_document(cls, document, partial=False):
+
+        # partial (projected) documents never enter the identity map
+        uow = None if partial else current_unit_of_work()
+        if uow is not None:
+            loaded = uow.get_identity(cls, document.get('_id'))
+            if loaded is not None:
+                return loaded
+        model = cls(rawdata=document)
+        if uow is not None:
+            uow.add(model)
+        return model
+
+    @classmethod
+    def database(cls):
+
+        # the app's database inside a request or app context, so each app
+        # made by a factory keeps its own
+        if has_app_context() and getattr(current_app, 'db', None) is not None:
+            return current_app.db
+        return database.get_database()
 
     @classmethod
     def _collection(cls):
 
-        return db[cls.__name__]
+        return cls.database()[cls.__name__]
+
+    @classmethod
+    def ensure_indexes(cls):
+
+        if cls.INDEXES:
+            create_indexes(cls._collection(), cls.INDEXES)
 
     def save(self):
 
+        if self.is_saved and not self.is_dirty():
+            return True
+
+        uow = current_unit_of_work()
+        if uow is not None and self.DEFERRED_SAVE:
+            # assign the _id now so callers can use identifier() right away
+            self.data.setdefault('_id', ObjectId())
+            uow.register_save(self)
+            return True
+
         if self.is_saved:
             self._update()
         else:
             self._insert()
         return True
 
+    def _write_op(self):
+
+        if not self.is_saved:
+            return InsertOne(self.data)
+        changes = self._changes()
+        if changes:
+            return UpdateOne({'_id': self.data['_id']}, changes)
+        return None
+
+    @classmethod
+    def save_many(cls, models, ordered=True):
+
+        # one bulk_write for all the models' inserts and minimal updates
+        written = []
+        operations = []
+        for model in models:
+            if not model.is_saved:
+                model.data.setdefault('_id', ObjectId())
+            operation = model._write_op()
+            if operation:
+                written.append(model)
+                operations.append(operation)
+        if not operations:
+            return None
+
+        try:
+            result = cls._collection().bulk_write(operations, ordered=ordered)
+        except BulkWriteError as e:
+            failed = set(error['index'] for error in e.details['writeErrors'])
+            first_failure = min(failed)
+            for index, model in enumerate(written):
+                if index in failed or (ordered and index > first_failure):
+                    continue
+                model.is_saved = True
+                model._clear_changes()
+            raise
+
+        for model in written:
+            model.is_saved = True
+            model._clear_changes()
+        return result
+
+    @classmethod
+    def delete_many(cls, models):
+
+        uow = current_unit_of_work()
+        identifiers = []
+        for model in models:
+            if uow is not None:
+                uow.discard(model)
+            if model.is_saved:
+                identifiers.append(model.data['_id'])
+                model.is_saved = False
+        if not identifiers:
+            return None
+        return cls._collection().delete_many({'_id': {'$in': identifiers}})
+
     def _update(self):
 
+        changes = self._changes()
+        if not changes:
+            return
         collection = self._collection()
         collection.update_one({
             '_id': self.data['_id']
-        }, {
-            '$set': self.data
-        })
+        }, changes)
+        self._clear_changes()
 
     def _insert(self):
 
         collection = self._collection()
         collection.insert_one(self.data)
         self.is_saved = True
+        self._clear_changes()
 
     def remove(self):
+        uow = current_unit_of_work()
+        if uow is not None:
+            uow.discard(self)
         collection = self._collection()
         collection.delete_one(self.data)
         self.is_saved = False
 
     def set(self, key, value):
 
+        # nested values changed in place aren't noticed, set() them again
         self.data[key] = value
+        self._dirty.add(key)
+        self._unset.discard(key)
+
+    def unset(self, key):
+
+        self.data.pop(key, None)
+        self._unset.add(key)
+        self._dirty.discard(key)
 
     def get(self, key):
 
@@ -93,14 +255,15 @@ class DBModel(object):
     @classmethod
     def fetch(cls, query):
 
-        collection = cls._collection()
-        entities = collection.find(query)
-        return [cls(rawdata=entity) for entity in entities]
+        return QuerySet(cls, query)
 
 
 class User(DBModel):
 
-    BCRYPT_ROUNDS = 12
+    BCRYPT_ROUNDS = bcrypt_cost.rounds
+    # signup needs to know straight away whether the username was free
+    DEFERRED_SAVE = False
+    INDEXES = [IndexModel([('username', ASCENDING)], unique=True)]
 
     def __init__(self, *args, username=None, **kwargs):
 
@@ -111,22 +274,59 @@ class User(DBModel):
     def set_password(self, password):
 
         encodedpassword = password.encode('utf-8')
-        hashed = bcrypt.hashpw(encodedpassword, bcrypt.gensalt(self.BCRYPT_ROUNDS))
+        hashed = hash_pool.hashpw(encodedpassword, bcrypt.gensalt(self.BCRYPT_ROUNDS))
         self.set('password', hashed)
+        if 'username' in self.data:
+            credential_cache.invalidate(self.get('username'))
 
     def compare_password(self, password):
 
+        username = self.data.get('username')
+        hashed = self.get('password')
+        if credential_cache.check(username, password, hashed):
+            return True
         encodedpassword = password.encode('utf-8')
-        return bcrypt.hashpw(encodedpassword, self.get('password')) == self.get('password')
+        if hash_pool.hashpw(encodedpassword, hashed) == hashed:
+            credential_cache.add(username, password, hashed)
+            return True
+        return False
+
+    def needs_rehash(self):
+
+        return bcrypt_cost.needs_rehash(self.get('password'))
+
+    def rehash_password(self, password):
+
+        # conditional on the old hash, so concurrent logins (or a password
+        # change) aren't overwritten; True if this call stored the new hash
+        old = self.get('password')
+        encodedpassword = password.encode('utf-8')
+        hashed = hash_pool.hashpw(encodedpassword, bcrypt.gensalt(self.BCRYPT_ROUNDS))
+        result = self._collection().update_one(
+            {'_id': self.data['_id'], 'password': old},
+            {'$set': {'password': hashed}})
+        if not result.modified_count:
+            return False
+        self.data['password'] = hashed
+        credential_cache.invalidate(self.get('username'))
+        return True
 
     def save(self):
 
-        if not self.is_saved:
-            query = self.fetch({'username': self.get('username')})
-            if len(query) > 0:
-                return False
-        return super(User, self).save()
+        # the unique username index turns a taken username into a failed insert
+        try:
+            return super(User, self).save()
+        except DuplicateKeyError:
+            self.data.pop('_id', None)
+            return False
 
 
 class Trip(DBModel):
-    pass
+
+    INDEXES = [IndexModel([('username', ASCENDING), ('_id', ASCENDING)])]
+
+
+def ensure_all_indexes():
+
+    for model in (User, Trip):
+        model.ensure_indexes()
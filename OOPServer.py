@@ -1,19 +1,47 @@
 """ GENERAL IMPORTS """
+import os
 from functools import wraps
 
 
 """ FLASK IMPORTS """
-from flask import Flask, request, make_response
+from flask import Flask, request, g, current_app
 from flask_restful import Resource, Api
 
 
-""" FLASK BOILERPLATE """
-app = Flask(__name__)
-api = Api(app)
+""" BSON IMPORTS """
+from bson.errors import InvalidId
+from bson.objectid import ObjectId
 
 
 """ LOCAL IMPORTS """
 from OOPModel import *
+from utils.tokens import issue_token, verify_token, bearer_token
+from utils.hash_pool import hash_pool, PoolBusy
+from utils.bcrypt_cost import bcrypt_cost
+from utils.indexes import bootstrap_before_first_request
+from utils import database, metrics, query_log, unit_of_work
+from utils.representation import json_response
+
+
+# """ AUTH HELPERS """
+@metrics.timed('auth')
+def check_basic_auth(auth):
+
+    try:
+        user = User(username=auth.username)
+    except NullDocumentException:
+        return False
+    if not user.compare_password(auth.password):
+        return False
+    if user.needs_rehash():
+        # upgrade to the current bcrypt cost while we have the plaintext,
+        # a busy pool just leaves it for the next login
+        try:
+            if user.rehash_password(auth.password):
+                bcrypt_cost.record_rehash()
+        except PoolBusy:
+            pass
+    return True
 
 
 # """ DECORATORS """
@@ -21,16 +49,24 @@ def require_auth(f):
 
     @wraps(f)
     def helper(*args, **kwargs):
-        auth = request.authorization
-        if not auth:
-            return ({'error': 'Basic Auth Required.'}, 401, None)
-        try:
-            user = User(username=auth.username)
-        except:
-            return ({'error': 'Invalid Auth.'}, 401, None)
-        if not user.compare_password(auth.password):
-            return ({'error': 'Invalid Auth.'}, 401, None)
-
+        token = bearer_token(request)
+        if token is not None:
+            username = verify_token(current_app.secret_key, token,
+                                    current_app.config['AUTH_TOKEN_MAX_AGE'])
+            if username is None:
+                return ({'error': 'Invalid Auth.'}, 401, None)
+        else:
+            auth = request.authorization
+            if not auth:
+                return ({'error': 'Basic Auth Required.'}, 401, None)
+            try:
+                if not check_basic_auth(auth):
+                    return ({'error': 'Invalid Auth.'}, 401, None)
+            except PoolBusy:
+                return hash_pool.busy_response()
+            username = auth.username
+
+        g.username = username
         return f(*args, **kwargs)
     return helper
 
@@ -50,6 +86,17 @@ def params(*params):
     return decorator
 
 
+def find_trip(username, trip_id):
+
+    # one lookup on the (username, _id) index rather than loading every trip
+    # the user has to pick one out
+    try:
+        trip_id = ObjectId(trip_id)
+    except (InvalidId, TypeError):
+        return None
+    return Trip.fetch({'_id': trip_id, 'username': username}).first()
+
+
 # """ IMPLEMENT REST Resource """
 class Users(Resource):
 
@@ -57,7 +104,10 @@ class Users(Resource):
     def post(self, username=None, password=None):
         user = User()
         user.set('username', username)
-        user.set_password(password)
+        try:
+            user.set_password(password)
+        except PoolBusy:
+            return hash_pool.busy_response()
         was_saved = user.save()
 
         if not was_saved:
@@ -72,52 +122,115 @@ class Users(Resource):
         return {}
 
 
+class Login(Resource):
+
+    def post(self):
+        auth = request.authorization
+        if not auth:
+            return ({'error': 'Basic Auth Required.'}, 401, None)
+        try:
+            if not check_basic_auth(auth):
+                return ({'error': 'Invalid Auth.'}, 401, None)
+        except PoolBusy:
+            return hash_pool.busy_response()
+
+        return {
+            'token': issue_token(current_app.secret_key, auth.username),
+            'expires_in': current_app.config['AUTH_TOKEN_MAX_AGE']
+        }
+
+
 class Trips(Resource):
 
     @require_auth
     def post(self):
-        username = request.authorization.username
+        username = g.username
         trip_info = request.json
-        trip = Trip(rawdata=trip_info)
+        # rawdata would mark the trip as already stored, set() marks each
+        # field as new instead
+        trip = Trip()
+        for key, value in trip_info.items():
+            if key != '_id':
+                trip.set(key, value)
         # add waypoints
         trip.set('username', username)
         trip.save()
 
+        return {
+            'identifier': trip.identifier()
+        }
+
     @require_auth
     def get(self, trip_id=None):
-        username = request.authorization.username
-        trips = Trip.fetch({'username': username})
-        get_trip = trips.get(trip_id)
-        # get trips
-        return get_trip
+        username = g.username
+        if trip_id is None:
+            # get trips
+            return [trip.data for trip in Trip.fetch({'username': username})]
+
+        get_trip = find_trip(username, trip_id)
+        if get_trip is None:
+            return ({'error': 'Trip not found.'}, 404, None)
+        return get_trip.data
 
     @require_auth
     def put(self, trip_id=None):
-        username = request.authorization.username
-        trips = Trip.fetch({'username': username})
-        get_trip = trips.get(trip_id)
+        username = g.username
+        get_trip = find_trip(username, trip_id)
+        if get_trip is None:
+            return ({'error': 'Trip not found.'}, 404, None)
+
         trip_info = request.json
-        get_trip.save(trip_info)
+        for key, value in trip_info.items():
+            if key not in ('_id', 'username'):
+                get_trip.set(key, value)
+        get_trip.save()
+        return get_trip.data
 
     @require_auth
-    def delete(self):
-        username = request.authorization.username
-        trips = Trip.fetch({'username': username})
-        get_trip = trips.get(trip_id)
-        Trip.remove(get_trip)
+    def delete(self, trip_id=None):
+        username = g.username
+        get_trip = find_trip(username, trip_id)
+        if get_trip is None:
+            return ({'error': 'Trip not found.'}, 404, None)
+        get_trip.remove()
 
-
-""" ADD REST RESOURCE TO API """
-api.add_resource(Users, '/users/')
+        return {
+            'identifier': trip_id
+        }
 
 
 # """ API RESPONSE ENCODING """
-@api.representation('application/json')
 def output_json(data, code, headers=None):
-    from json import dumps as stringify
-    resp = make_response(stringify(data), code)
-    resp.headers.extend(headers or {})
-    return resp
+    return json_response(data, code, headers)
+
+
+# """ FLASK BOILERPLATE """
+def create_app(config=None):
+    app = Flask(__name__)
+    # MONGO_* settings from the environment, overridden by config
+    app.config.update(database.config_from_env())
+    app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY') or os.urandom(24)
+    app.config['AUTH_TOKEN_MAX_AGE'] = 3600
+    app.config.update(config or {})
+    # the models use this app's database, on the process-wide client
+    app.db = database.AppDatabase(app.config)
+
+    api = Api(app)
+    # """ ADD REST RESOURCE TO API """
+    api.add_resource(Users, '/users/')
+    api.add_resource(Login, '/login/')
+    api.add_resource(Trips, '/trips/', '/trips/<string:trip_id>')
+    api.representation('application/json')(output_json)
+    bootstrap_before_first_request(app, ensure_all_indexes)
+    unit_of_work.init_app(app)
+    # slow queries, request query counts and collection scans
+    query_log.init_app(app)
+    # per-endpoint auth/db/serialization timings on GET /metrics
+    metrics.init_app(app, [
+        metrics.cache_stats('credential', credential_cache)])
+    return app
+
+app = create_app()
 
 
 # """ START SERVER COMMANDS """
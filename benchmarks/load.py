@@ -0,0 +1,344 @@
+"""Load test the bengServer /user/ and /trip/ routes end to end.
+
+    python -m benchmarks.load --concurrency 32 --duration 30 --output run.json
+
+Seeds a benchmark database on the mongod named by MONGO_URI (default
+localhost) with users and trips, serves bengServer in process (threaded or
+asyncio, see --server) or targets --url, then runs a weighted mix of signup,
+trip GET, list, PUT and DELETE requests from --concurrency keep-alive
+clients. Prints requests per second and p50/p95/p99 latency per endpoint;
+--output also writes them as JSON, tagged with the current commit, so runs
+can be compared across commits.
+"""
+import argparse
+import base64
+import datetime
+import http.client
+import itertools
+import json
+import math
+import random
+import subprocess
+import sys
+import threading
+import time
+from urllib.parse import urlsplit
+
+import bcrypt
+from werkzeug.serving import make_server, WSGIRequestHandler
+
+import bengServer
+from benchmarks.serializer_bench import make_trip
+from utils import database, serializer
+from utils.asyncio_server import start_in_thread, stop_in_thread
+from utils.bcrypt_cost import bcrypt_cost
+from utils.indexes import ensure_indexes
+
+PASSWORD = 'benchmark'
+DEFAULT_MIX = 'signup=1,get=6,list=2,put=2,delete=1'
+ENDPOINTS = ('signup', 'get', 'list', 'put', 'delete')
+# numbers the usernames signups create, shared by every client
+SIGNUPS = itertools.count()
+
+
+def parse_mix(text):
+    mix = []
+    for part in text.split(','):
+        name, _, weight = part.partition('=')
+        if name not in ENDPOINTS:
+            raise argparse.ArgumentTypeError(
+                'unknown endpoint {0!r}, use {1}'.format(
+                    name, ', '.join(ENDPOINTS)))
+        mix.append((name, int(weight or 1)))
+    return mix
+
+
+def percentile(ordered, fraction):
+    # nearest rank on an already sorted list
+    if not ordered:
+        return None
+    index = max(0, min(len(ordered) - 1,
+                       int(math.ceil(fraction * len(ordered))) - 1))
+    return ordered[index]
+
+
+def basic_auth(username, password):
+    credentials = '{0}:{1}'.format(username, password).encode('utf-8')
+    return 'Basic ' + base64.b64encode(credentials).decode()
+
+
+def seed(db, users, trips_per_user, waypoints, rng):
+    # every user shares one hash, made at the server's cost, so seeding
+    # doesn't take users * one bcrypt
+    db.drop_collection('users')
+    db.drop_collection('trips')
+    ensure_indexes(db, [bengServer.User, bengServer.Trip])
+
+    hashed = bcrypt.hashpw(PASSWORD.encode('utf-8'),
+                           bcrypt.gensalt(bcrypt_cost.rounds))
+    names = ['loaduser{0}'.format(n) for n in range(users)]
+    db.users.insert_many([{'username': name, 'password': hashed}
+                          for name in names])
+
+    owned = dict((name, []) for name in names)
+    trips = []
+    for name in names:
+        for _ in range(trips_per_user):
+            trip = make_trip(waypoints, rng)
+            trip['user'] = name
+            trip['version'] = 1
+            trips.append(trip)
+            owned[name].append(str(trip['_id']))
+    if trips:
+        db.trips.insert_many(trips)
+    return owned
+
+
+class Recorder(object):
+
+    def __init__(self):
+        self._latencies = dict((name, []) for name in ENDPOINTS)
+        self._errors = dict((name, 0) for name in ENDPOINTS)
+        self._lock = threading.Lock()
+
+    def record(self, endpoint, seconds, ok):
+        with self._lock:
+            self._latencies[endpoint].append(seconds)
+            if not ok:
+                self._errors[endpoint] += 1
+
+    def report(self, elapsed):
+        results = {}
+        for endpoint in ENDPOINTS:
+            ordered = sorted(self._latencies[endpoint])
+            if not ordered:
+                continue
+            results[endpoint] = {
+                'requests': len(ordered),
+                'errors': self._errors[endpoint],
+                'requests_per_second': len(ordered) / elapsed,
+                'mean_ms': sum(ordered) / len(ordered) * 1000,
+                'p50_ms': percentile(ordered, 0.50) * 1000,
+                'p95_ms': percentile(ordered, 0.95) * 1000,
+                'p99_ms': percentile(ordered, 0.99) * 1000,
+                'max_ms': ordered[-1] * 1000,
+            }
+        return results
+
+
+class Client(threading.Thread):
+    # one keep-alive connection acting as one user until the deadline
+
+    def __init__(self, host, port, username, trip_ids, mix, auth, deadline,
+                 recorder, rng):
+        super(Client, self).__init__(daemon=True)
+        self.conn = http.client.HTTPConnection(host, port, timeout=60)
+        self.username = username
+        self.trip_ids = list(trip_ids)
+        self.names = [name for name, _ in mix]
+        self.weights = [weight for _, weight in mix]
+        self.auth = auth
+        self.deadline = deadline
+        self.recorder = recorder
+        self.rng = rng
+        self.authorization = basic_auth(username, PASSWORD)
+
+    def request(self, method, path, body=None, auth=True):
+        headers = {'Content-Type': 'application/json'}
+        if auth:
+            headers['Authorization'] = self.authorization
+        if body is not None:
+            body = serializer.dumps(body)
+        try:
+            self.conn.request(method, path, body, headers)
+            response = self.conn.getresponse()
+            data = response.read()
+        except (http.client.HTTPException, OSError):
+            self.conn.close()
+            return None, b''
+        return response.status, data
+
+    def login(self):
+        status, data = self.request('POST', '/login/')
+        if status == 200:
+            token = json.loads(data.decode())['token']
+            self.authorization = 'Bearer ' + token
+
+    def run(self):
+        if self.auth == 'token':
+            self.login()
+        while time.perf_counter() < self.deadline:
+            endpoint = self.weighted_choice()
+            if endpoint in ('get', 'put', 'delete') and not self.trip_ids:
+                endpoint = 'signup'
+            start = time.perf_counter()
+            ok = getattr(self, endpoint)()
+            self.recorder.record(endpoint, time.perf_counter() - start, ok)
+        self.conn.close()
+
+    def weighted_choice(self):
+        # random.choices only arrived in Python 3.6
+        point = self.rng.uniform(0, sum(self.weights))
+        for name, weight in zip(self.names, self.weights):
+            point -= weight
+            if point <= 0:
+                return name
+        return self.names[-1]
+
+    def signup(self):
+        username = 'signup{0}'.format(next(SIGNUPS))
+        status, _ = self.request('POST', '/user/',
+                                 {'username': username,
+                                  'password': PASSWORD}, auth=False)
+        return status == 200
+
+    def get(self):
+        trip_id = self.rng.choice(self.trip_ids)
+        status, _ = self.request('GET', '/trip/' + trip_id)
+        return status == 200
+
+    def list(self):
+        status, _ = self.request('GET', '/trip/?limit=50')
+        return status == 200
+
+    def put(self):
+        trip_id = self.rng.choice(self.trip_ids)
+        status, _ = self.request('PUT', '/trip/' + trip_id,
+                                 {'name': 'renamed {0}'.format(
+                                     self.rng.randint(0, 100000))})
+        return status == 200
+
+    def delete(self):
+        trip_id = self.trip_ids.pop(self.rng.randrange(len(self.trip_ids)))
+        status, _ = self.request('DELETE', '/trip/' + trip_id)
+        return status == 200
+
+
+class QuietHandler(WSGIRequestHandler):
+    # an access log line per request would skew the numbers
+
+    def log_request(self, *args, **kwargs):
+        pass
+
+
+def serve(app, kind):
+    # returns (host, port, stop)
+    if kind == 'asyncio':
+        server = start_in_thread(app)
+        return '127.0.0.1', server.port, lambda: stop_in_thread(server)
+    server = make_server('127.0.0.1', 0, app, threaded=True,
+                         request_handler=QuietHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+
+    def stop():
+        server.shutdown()
+        thread.join()
+    return '127.0.0.1', server.server_port, stop
+
+
+def current_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'],
+            stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--duration', type=float, default=10,
+                        help='seconds to run the mix for')
+    parser.add_argument('--users', type=int,
+                        help='seeded users (default: one per client)')
+    parser.add_argument('--trips-per-user', type=int, default=20)
+    parser.add_argument('--waypoints', type=int, default=10)
+    parser.add_argument('--mix', type=parse_mix, default=DEFAULT_MIX,
+                        help='endpoint weights (default {0})'.format(
+                            DEFAULT_MIX))
+    parser.add_argument('--auth', choices=('basic', 'token'),
+                        default='basic')
+    parser.add_argument('--server', choices=('threaded', 'asyncio'),
+                        default='threaded',
+                        help='how to serve bengServer in process')
+    parser.add_argument('--url', help='target an already running server; '
+                        'it must use the same database as MONGO_DBNAME')
+    parser.add_argument('--database', default='benchmark_database')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='write results as JSON to this file')
+    args = parser.parse_args(argv)
+    if isinstance(args.mix, str):
+        args.mix = parse_mix(args.mix)
+
+    rng = random.Random(args.seed)
+    config = database.config_from_env()
+    config['MONGO_DBNAME'] = args.database
+    db = database.get_database(config)
+    users = args.users or args.concurrency
+    owned = seed(db, users, args.trips_per_user, args.waypoints, rng)
+    print('seeded {0} users with {1} trips each'.format(
+        users, args.trips_per_user))
+
+    if args.url:
+        target = urlsplit(args.url)
+        host, port, stop = target.hostname, target.port or 80, None
+    else:
+        app = bengServer.create_app(config)
+        host, port, stop = serve(app, args.server)
+
+    recorder = Recorder()
+    names = sorted(owned)
+    start = time.perf_counter()
+    deadline = start + args.duration
+    clients = [Client(host, port, names[n % len(names)],
+                      owned[names[n % len(names)]], args.mix, args.auth,
+                      deadline, recorder, random.Random(rng.random()))
+               for n in range(args.concurrency)]
+    for client in clients:
+        client.start()
+    for client in clients:
+        client.join()
+    elapsed = time.perf_counter() - start
+    if stop is not None:
+        stop()
+
+    results = recorder.report(elapsed)
+    total = sum(result['requests'] for result in results.values())
+    print('{0:<8} {1:>8} {2:>7} {3:>9} {4:>8} {5:>8} {6:>8}'.format(
+        'endpoint', 'requests', 'errors', 'req/s', 'p50 ms', 'p95 ms',
+        'p99 ms'))
+    for endpoint in ENDPOINTS:
+        if endpoint not in results:
+            continue
+        result = results[endpoint]
+        print('{0:<8} {1:>8} {2:>7} {3:>9.1f} {4:>8.1f} {5:>8.1f} '
+              '{6:>8.1f}'.format(
+                  endpoint, result['requests'], result['errors'],
+                  result['requests_per_second'], result['p50_ms'],
+                  result['p95_ms'], result['p99_ms']))
+    print('{0} requests in {1:.1f}s, {2:.1f} req/s'.format(
+        total, elapsed, total / elapsed))
+
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump({
+                'commit': current_commit(),
+                'started': datetime.datetime.utcnow().isoformat() + 'Z',
+                'server': args.url or args.server,
+                'concurrency': args.concurrency,
+                'duration': args.duration,
+                'auth': args.auth,
+                'users': users,
+                'trips_per_user': args.trips_per_user,
+                'waypoints': args.waypoints,
+                'mix': dict(args.mix),
+                'elapsed': elapsed,
+                'requests_per_second': total / elapsed,
+                'results': results,
+            }, output, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
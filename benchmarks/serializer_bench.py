@@ -0,0 +1,95 @@
+"""Compare JSON encoder throughput on realistic trip documents.
+
+    python -m benchmarks.serializer_bench --trips 200 --waypoints 50
+
+Runs every available utils.serializer backend plus the old per-response
+JSONEncoder().encode pattern, and prints documents and megabytes per second.
+Pass --output to also write the numbers as JSON.
+"""
+import argparse
+import datetime
+import json
+import random
+import sys
+import time
+
+from bson.objectid import ObjectId
+
+from utils.mongo_json_encoder import JSONEncoder
+from utils.serializer import BACKENDS, get_serializer
+
+CITIES = ['london', 'paris', 'milan', 'berlin', 'madrid', 'lisbon', 'rome',
+          'vienna', 'prague', 'cairo', 'addis ababa', 'cape town']
+
+
+def make_trip(waypoint_count, rng):
+    created = datetime.datetime(2015, 9, 1) + datetime.timedelta(
+        minutes=rng.randint(0, 500000))
+    return {
+        '_id': ObjectId(),
+        'user': 'traveller{0}'.format(rng.randint(0, 1000)),
+        'name': 'trip {0}'.format(rng.randint(0, 100000)),
+        'created': created,
+        'version': rng.randint(1, 50),
+        'waypoints': [{
+            'name': rng.choice(CITIES),
+            'location': {
+                'type': 'Point',
+                'coordinates': [rng.uniform(-180, 180), rng.uniform(-90, 90)],
+            },
+        } for _ in range(waypoint_count)],
+    }
+
+
+def run(encode, documents, repeat):
+    size = 0
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for document in documents:
+            size += len(encode(document))
+    elapsed = time.perf_counter() - start
+    count = len(documents) * repeat
+    return {
+        'documents_per_second': count / elapsed,
+        'megabytes_per_second': size / elapsed / 1e6,
+        'seconds': elapsed,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--trips', type=int, default=200)
+    parser.add_argument('--waypoints', type=int, default=50)
+    parser.add_argument('--repeat', type=int, default=20)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='write results as JSON to this file')
+    args = parser.parse_args(argv)
+
+    rng = random.Random(args.seed)
+    documents = [make_trip(args.waypoints, rng) for _ in range(args.trips)]
+
+    candidates = [('JSONEncoder per response',
+                   lambda document: JSONEncoder().encode(document))]
+    for name in sorted(BACKENDS):
+        serializer = get_serializer(name)
+        if serializer.name != name:
+            print('{0}: not installed, skipped'.format(name))
+            continue
+        candidates.append((name, serializer.dumps))
+
+    results = {}
+    for label, encode in candidates:
+        results[label] = result = run(encode, documents, args.repeat)
+        print('{0:<26} {1:>10.0f} docs/s {2:>8.1f} MB/s'.format(
+            label, result['documents_per_second'],
+            result['megabytes_per_second']))
+
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump({'trips': args.trips, 'waypoints': args.waypoints,
+                       'repeat': args.repeat, 'results': results},
+                      output, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
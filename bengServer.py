@@ -1,45 +1,104 @@
+import os
+import sys
 import bcrypt
-from flask import Flask, request, make_response
+from flask import Flask, Response, request, g
+from flask import current_app
+from flask import stream_with_context
 from flask_restful import Resource, Api
-from pymongo import MongoClient
-from utils.mongo_json_encoder import JSONEncoder
+from pymongo import IndexModel, ASCENDING, GEOSPHERE, TEXT, ReturnDocument
+from pymongo import InsertOne, UpdateOne, DeleteOne
+from pymongo.errors import DuplicateKeyError, BulkWriteError
+from bson.errors import InvalidId
+from utils import asyncio_server, database, geo, metrics, query_log, routes
+from utils import serializer, waypoint_patch
+from utils.representation import json_response
+from utils.auth_cache import CredentialCache
+from utils.tokens import issue_token, verify_token, bearer_token
+from utils.hash_pool import hash_pool, PoolBusy
+from utils.bcrypt_cost import bcrypt_cost
+from utils.indexes import ensure_indexes, bootstrap_before_first_request
+from utils.lru_cache import LRUTTLCache
+from utils.etag import make_etag, etag_header, is_fresh, not_modified
+from utils.pagination import (parse_page_args, keyset_page, PageError,
+                              parse_offset, text_page, stream_json_array,
+                              STREAM_BATCH_SIZE)
 from bson.objectid import ObjectId
 from functools import wraps
 
-app = Flask(__name__)
-mongo = MongoClient('localhost', 27017)
-app.db = mongo.develop_database
-app.bcrypt_rounds = 12
-api = Api(app)
+# most trips one multi-get may ask for
+MAX_TRIP_IDS = 500
 
 
+@metrics.timed('auth')
 def check_auth(username, password):
-    user_collection = app.db.users
+    user_collection = current_app.db.users
     user = user_collection.find_one({'username': username})
 
     if user is None:
         return False
+    elif current_app.credential_cache.check(username, password,
+                                            user['password']):
+        # verified recently against this same hash, skip bcrypt
+        return True
     else:
         # check if the hash we generate based on auth matches stored hash
         encodedPassword = password.encode('utf-8')
-        if bcrypt.hashpw(encodedPassword,
-                         user['password']) == user['password']:
+        if hash_pool.hashpw(encodedPassword,
+                            user['password']) == user['password']:
+            hashed = user['password']
+            if bcrypt_cost.needs_rehash(hashed):
+                hashed = rehash_password(user, encodedPassword)
+            current_app.credential_cache.add(username, password, hashed)
             return True
         else:
             return False
 
 
+def rehash_password(user, encodedPassword):
+    # upgrade a hash made with a different cost factor while we still have
+    # the plaintext; a busy pool just postpones this to the next login
+    try:
+        hashed = hash_pool.hashpw(encodedPassword,
+                                  bcrypt.gensalt(current_app.bcrypt_rounds))
+    except PoolBusy:
+        return user['password']
+
+    result = current_app.db.users.update_one(
+        {'_id': user['_id'], 'password': user['password']},
+        {'$set': {'password': hashed}})
+    if result.modified_count:
+        bcrypt_cost.record_rehash()
+        return hashed
+    return user['password']
+
+
 def requires_auth(f):
+    # accepts either a bearer token from /login/ or Basic auth and stores the
+    # authenticated username on g.username
     @wraps(f)
     def decorated(*args, **kwargs):
-        auth = request.authorization
-        if not auth or not check_auth(auth.username, auth.password):
-            return ({'error': 'Basic Auth Required.'}, 401, None)
+        token = bearer_token(request)
+        if token is not None:
+            username = verify_token(current_app.secret_key, token,
+                                    current_app.config['AUTH_TOKEN_MAX_AGE'])
+            if username is None:
+                return ({'error': 'Invalid or expired token.'}, 401, None)
+        else:
+            auth = request.authorization
+            try:
+                if not auth or not check_auth(auth.username, auth.password):
+                    return ({'error': 'Basic Auth Required.'}, 401, None)
+            except PoolBusy:
+                return hash_pool.busy_response()
+            username = auth.username
+        g.username = username
         return f(*args, **kwargs)
     return decorated
 
 
 class User(Resource):
+    collection = 'users'
+    indexes = [IndexModel([('username', ASCENDING)], unique=True)]
 
     def post(self):
         if (request.json['username'] is None
@@ -48,95 +107,630 @@ class User(Resource):
                         400,
                         None)
 
-        user_collection = app.db.users
-        user = user_collection.find_one({'username': request.json['username']})
+        user_collection = current_app.db.users
+        encodedPassword = request.json['password'].encode('utf-8')
+        try:
+            hashed = hash_pool.hashpw(
+                encodedPassword, bcrypt.gensalt(current_app.bcrypt_rounds))
+        except PoolBusy:
+            return hash_pool.busy_response()
+        request.json['password'] = hashed
 
-        if user is not None:
-            return ({'error': 'Username already in use'}, 400, None)
-        else:
-            encodedPassword = request.json['password'].encode('utf-8')
-            hashed = bcrypt.hashpw(
-                encodedPassword, bcrypt.gensalt(app.bcrypt_rounds))
-            request.json['password'] = hashed
+        # the unique username index rejects duplicates in the same write
+        try:
             user_collection.insert_one(request.json)
+        except DuplicateKeyError:
+            return ({'error': 'Username already in use'}, 400, None)
 
     @requires_auth
     def get(self):
         return (None, 200, None)
 
 
+class Login(Resource):
+
+    def post(self):
+        auth = request.authorization
+        try:
+            if not auth or not check_auth(auth.username, auth.password):
+                return ({'error': 'Basic Auth Required.'}, 401, None)
+        except PoolBusy:
+            return hash_pool.busy_response()
+
+        max_age = current_app.config['AUTH_TOKEN_MAX_AGE']
+        return {'token': issue_token(current_app.secret_key, auth.username),
+                'expires_in': max_age}
+
+
+# Every trip carries a version that each write bumps. It backs the ETag on
+# GET /trip/<id>, and the versions of all the user's trips back the one on
+# GET /trip/.
+def trip_etag(trip):
+    return make_etag(trip['_id'], trip.get('version', 0))
+
+
+def trips_version(username):
+    # Read from the trips themselves, off the user + _id + version index, so
+    # writes need nothing extra. Creates add to the count and the newest _id,
+    # deletes take from the count and updates add to the sum of versions, so
+    # any write changes it.
+    result = list(current_app.db.trips.aggregate([
+        {'$match': {'user': username}},
+        {'$group': {'_id': None, 'count': {'$sum': 1},
+                    'versions': {'$sum': '$version'},
+                    'newest': {'$max': '$_id'}}}]))
+    if not result:
+        return (0, 0, None)
+    return (result[0]['count'], result[0]['versions'], result[0]['newest'])
+
+
+def trip_list_etag(username):
+    # different query strings are different listings
+    return make_etag(username, trips_version(username), request.query_string)
+
+
+def trips_changed(username):
+    # every trip write goes through here to drop this worker's cached list
+    current_app.trip_cache.delete(('list', username))
+
+
+def clean_waypoints(trip):
+    # raises GeoError for waypoints the 2dsphere index would reject
+    if 'waypoints' in trip:
+        trip['waypoints'] = geo.parse_waypoints(trip['waypoints'])
+
+
+def find_trip(username, trip_id):
+    # one indexed lookup; checking a cached copy is still fresh would cost
+    # the same round trip
+    return current_app.db.trips.find_one({'_id': trip_id, 'user': username})
+
+
+def find_trips(username, trip_ids):
+    # the user's trips with these ids in the order asked for, read with one
+    # $in query, and the ids that weren't found. Not from the trip cache:
+    # ?ids= answers carry the list ETag, which a stale copy would defeat.
+    if len(trip_ids) > MAX_TRIP_IDS:
+        raise ValueError('At most {0} trip ids per request'.format(
+            MAX_TRIP_IDS))
+    # requested id -> its canonical form, ids differing only in case are
+    # the same trip
+    keys = {}
+    for trip_id in trip_ids:
+        if not isinstance(trip_id, str):
+            raise ValueError('trip ids must be strings')
+        try:
+            keys[trip_id] = str(ObjectId(trip_id))
+        except InvalidId:
+            # can't exist, reported missing like any other
+            continue
+
+    found = {}
+    if keys:
+        wanted = [ObjectId(key) for key in set(keys.values())]
+        for trip in current_app.db.trips.find({'_id': {'$in': wanted},
+                                               'user': username}):
+            found[str(trip['_id'])] = trip
+
+    trips = []
+    missing = []
+    seen = set()
+    for trip_id in trip_ids:
+        key = keys.get(trip_id, trip_id)
+        if key in seen:
+            continue
+        seen.add(key)
+        if key in found:
+            trips.append(found[key])
+        else:
+            missing.append(trip_id)
+    return {'trips': trips, 'missing': missing}
+
+
 class Trip(Resource):
+    collection = 'trips'
+    # version is there for trips_version
+    indexes = [IndexModel([('user', ASCENDING), ('_id', ASCENDING),
+                           ('version', ASCENDING)]),
+               # /trip/nearby/ always filters on user too
+               IndexModel([('user', ASCENDING),
+                           ('waypoints.location', GEOSPHERE)]),
+               # GET /trip/search/; waypoints holds the plain names and
+               # waypoints.name the located ones
+               IndexModel([('user', ASCENDING), ('name', TEXT),
+                           ('waypoints', TEXT), ('waypoints.name', TEXT)],
+                          weights={'name': 5}, name='trip_search')]
 
     @requires_auth
     def get(self, trip_id=None):
         if trip_id is None:
-            trip_collection = app.db.trips
-            trips = list(trip_collection.find(
-                {'user': request.authorization.username}))
-            return trips
+            return self.list_trips()
         else:
-            trip_collection = app.db.trips
-            trip = trip_collection.find_one(
-                {'_id': ObjectId(trip_id),
-                 'user': request.authorization.username})
+            trip = find_trip(g.username, ObjectId(trip_id))
 
             if trip is None:
                 # Flask allows us to return tuple in form
                 # (response, status, headers)
                 return (None, 404, None)
-            else:
-                return trip
+
+            tag = trip_etag(trip)
+            if is_fresh(tag):
+                return not_modified(tag)
+            return (trip, 200, {'ETag': etag_header(tag)})
+
+    def list_trips(self):
+        # ?stream=1 writes the whole list straight from the cursor,
+        # ?limit=&after= returns one page at a time in _id order
+        tag = trip_list_etag(g.username)
+        if is_fresh(tag):
+            return not_modified(tag)
+        headers = {'ETag': etag_header(tag)}
+
+        if 'ids' in request.args:
+            # ?ids=a,b,c fetches just those trips, see find_trips
+            trip_ids = [trip_id for trip_id in
+                        request.args['ids'].split(',') if trip_id]
+            try:
+                return (find_trips(g.username, trip_ids), 200, headers)
+            except ValueError as e:
+                return ({'error': str(e)}, 400, None)
+
+        trip_collection = current_app.db.trips
+        query = {'user': g.username}
+
+        if request.args.get('stream'):
+            cursor = trip_collection.find(query).sort('_id', ASCENDING)
+            cursor = cursor.batch_size(STREAM_BATCH_SIZE)
+            encode = serializer.dumps
+            return Response(
+                stream_with_context(stream_json_array(cursor, encode)),
+                mimetype='application/json', headers=headers)
+
+        if 'limit' in request.args or 'after' in request.args:
+            try:
+                limit, after = parse_page_args(request.args)
+            except PageError as e:
+                return ({'error': str(e)}, 400, None)
+            trips, next_cursor = keyset_page(trip_collection, query,
+                                             limit, after)
+            return ({'trips': trips, 'next': next_cursor}, 200, headers)
+
+        # the cached list is stored with the ETag it was read under, so a
+        # write made by any worker makes it miss
+        key = ('list', g.username)
+        cached = current_app.trip_cache.get(key)
+        if cached is not None and cached[0] == tag:
+            return (cached[1], 200, headers)
+        trips = list(trip_collection.find(query))
+        current_app.trip_cache.set(key, (tag, trips))
+        return (trips, 200, headers)
 
     @requires_auth
     def post(self):
         new_trip = request.json
-        new_trip['user'] = request.authorization.username
-        trip_collection = app.db.trips
-        result = trip_collection.insert_one(request.json)
-
-        trip = trip_collection.find_one(result.inserted_id)
+        try:
+            clean_waypoints(new_trip)
+        except geo.GeoError as e:
+            return ({'error': str(e)}, 400, None)
+        new_trip['user'] = g.username
+        new_trip['version'] = 1
+        trip_collection = current_app.db.trips
+        # insert_one fills in new_trip['_id'], so it is the stored document
+        trip_collection.insert_one(new_trip)
+        trips_changed(g.username)
 
-        return (trip, 201, None)
+        return (new_trip, 201, {'ETag': etag_header(trip_etag(new_trip))})
 
     @requires_auth
     def put(self, trip_id):
         new_trip = request.json
-        new_trip['user'] = request.authorization.username
-        trip_collection = app.db.trips
+        try:
+            clean_waypoints(new_trip)
+        except geo.GeoError as e:
+            return ({'error': str(e)}, 400, None)
+        new_trip['user'] = g.username
+        trip_collection = current_app.db.trips
 
         # remove _id since we can't update it and would need to
-        # transform it into an ObjectId
-        del request.json['_id']
-        trip_collection.update_one({'_id': ObjectId(trip_id),
-                                    'user': request.authorization.username},
-                                   {'$set': request.json})
-        trip = trip_collection.find_one(ObjectId(trip_id))
+        # transform it into an ObjectId; the version is ours to bump
+        new_trip.pop('_id', None)
+        new_trip.pop('version', None)
+        trip = trip_collection.find_one_and_update(
+            {'_id': ObjectId(trip_id), 'user': g.username},
+            {'$set': new_trip, '$inc': {'version': 1}},
+            return_document=ReturnDocument.AFTER)
+
+        if trip is None:
+            return (None, 404, None)
+        trips_changed(g.username)
+        return (trip, 200, {'ETag': etag_header(trip_etag(trip))})
+
+    @requires_auth
+    def patch(self, trip_id):
+        # one waypoint operation, see utils.waypoint_patch; a version in the
+        # body makes it apply only to that version of the trip
+        body = request.json
+        try:
+            operation = waypoint_patch.parse_patch(body,
+                                                   geo.parse_waypoint)
+        except ValueError as e:
+            return ({'error': str(e)}, 400, None)
+        try:
+            trip_id = ObjectId(trip_id)
+        except InvalidId:
+            return (None, 404, None)
+        owner = {'_id': trip_id, 'user': g.username}
+        selector = dict(owner)
+        if body.get('version') is not None:
+            selector['version'] = body['version']
 
-        return trip
+        waypoints = None
+        if waypoint_patch.needs_waypoints(operation):
+            trip = find_trip(g.username, trip_id)
+            if trip is None:
+                return (None, 404, None)
+            waypoints = trip.get('waypoints')
+        try:
+            steps = waypoint_patch.plan_patch(operation, waypoints)
+        except waypoint_patch.PatchError as e:
+            return ({'error': str(e)}, 400, None)
+
+        # the first step carries the version check and bump, later ones
+        # only finish what it started
+        trip_collection = current_app.db.trips
+        for n, (conditions, update) in enumerate(steps):
+            query = dict(selector if n == 0 else owner)
+            query.update(conditions)
+            if n == 0:
+                update = dict(update)
+                update['$inc'] = {'version': 1}
+            trip = trip_collection.find_one_and_update(
+                query, update, return_document=ReturnDocument.AFTER)
+            if trip is None:
+                break
+        if trip is None:
+            if trip_collection.find_one(owner, {'_id': True}) is None:
+                return (None, 404, None)
+            return ({'error': 'Trip has changed, fetch it and retry'},
+                    409, None)
+        trips_changed(g.username)
+        return (trip, 200, {'ETag': etag_header(trip_etag(trip))})
 
     @requires_auth
     def delete(self, trip_id):
-        trip_collection = app.db.trips
-        trip_collection.delete_one(
+        trip_collection = current_app.db.trips
+        result = trip_collection.delete_one(
             {'_id': ObjectId(trip_id),
-             'user': request.authorization.username}
+             'user': g.username}
         )
+        if result.deleted_count:
+            trips_changed(g.username)
 
         return {"tripIdentifier": trip_id}
 
-api.add_resource(Trip, '/trip/', '/trip/<string:trip_id>')
-api.add_resource(User, '/user/')
+
+class TripLookup(Resource):
+    # POST /trip/lookup/ {"ids": [...]}, the same as GET /trip/?ids= for id
+    # lists too long for a query string
+
+    @requires_auth
+    def post(self):
+        trip_ids = (request.json or {}).get('ids')
+        if not isinstance(trip_ids, list):
+            return ({'error': 'Request requires a list of ids'}, 400, None)
+        try:
+            return find_trips(g.username, trip_ids)
+        except ValueError as e:
+            return ({'error': str(e)}, 400, None)
+
+
+class TripBatch(Resource):
+    # Applies a list of create/update/delete operations on the user's trips
+    # with one ownership lookup and one bulk_write:
+    #
+    #   {"ordered": true,
+    #    "operations": [{"op": "create", "trip": {...}},
+    #                   {"op": "update", "id": "...", "trip": {...}},
+    #                   {"op": "delete", "id": "..."}]}
+    #
+    # and answers with a status per operation: ok, not_found, error, or
+    # skipped (ordered batches stop at the first failure).
+    MAX_OPERATIONS = 500
+    OPERATIONS = ('create', 'update', 'delete')
+
+    @requires_auth
+    def post(self):
+        body = request.json or {}
+        operations = body.get('operations')
+        ordered = bool(body.get('ordered', True))
+        if not isinstance(operations, list) or not operations:
+            return ({'error': 'Request requires a list of operations'},
+                    400, None)
+        if len(operations) > self.MAX_OPERATIONS:
+            return ({'error': 'At most {0} operations per batch'.format(
+                self.MAX_OPERATIONS)}, 400, None)
+
+        try:
+            operations = [self.parse_operation(operation)
+                          for operation in operations]
+        except ValueError as e:
+            return ({'error': str(e)}, 400, None)
+
+        trip_collection = current_app.db.trips
+        referenced = [operation['id'] for operation in operations
+                      if operation['op'] != 'create']
+        owned = set(trip['_id'] for trip in trip_collection.find(
+            {'_id': {'$in': referenced}, 'user': g.username}, {'_id': True}))
+
+        results = []
+        requests = []
+        # position in requests -> position in results
+        request_results = []
+        for operation in operations:
+            result = {'op': operation['op'], 'status': 'skipped'}
+            results.append(result)
+            if operation['op'] == 'create':
+                trip = operation['trip']
+                trip['_id'] = ObjectId()
+                trip['user'] = g.username
+                trip['version'] = 1
+                owned.add(trip['_id'])
+                result['id'] = str(trip['_id'])
+                requests.append(InsertOne(trip))
+            else:
+                result['id'] = str(operation['id'])
+                if operation['id'] not in owned:
+                    result['status'] = 'not_found'
+                    if ordered:
+                        break
+                    continue
+                selector = {'_id': operation['id'], 'user': g.username}
+                if operation['op'] == 'update':
+                    requests.append(UpdateOne(
+                        selector,
+                        {'$set': operation['trip'], '$inc': {'version': 1}}))
+                else:
+                    owned.discard(operation['id'])
+                    requests.append(DeleteOne(selector))
+            request_results.append(len(results) - 1)
+
+        # everything after an ordered batch stopped is reported as skipped
+        for operation in operations[len(results):]:
+            skipped = {'op': operation['op'], 'status': 'skipped', 'id': None}
+            if 'id' in operation:
+                skipped['id'] = str(operation['id'])
+            results.append(skipped)
+
+        errors = {}
+        if requests:
+            try:
+                trip_collection.bulk_write(requests, ordered=ordered)
+            except BulkWriteError as e:
+                for error in e.details['writeErrors']:
+                    errors[error['index']] = error['errmsg']
+            trips_changed(g.username)
+
+        first_error = min(errors) if errors else None
+        for index, result_index in enumerate(request_results):
+            result = results[result_index]
+            if index in errors:
+                result['status'] = 'error'
+                result['error'] = errors[index]
+            elif ordered and first_error is not None and index > first_error:
+                result['status'] = 'skipped'
+            else:
+                result['status'] = 'ok'
+
+        return {'results': results}
+
+    def parse_operation(self, operation):
+        if not isinstance(operation, dict):
+            raise ValueError('Each operation must be an object')
+        op = operation.get('op')
+        if op not in self.OPERATIONS:
+            raise ValueError('op must be one of ' + ', '.join(self.OPERATIONS))
+
+        parsed = {'op': op}
+        if op != 'create':
+            try:
+                parsed['id'] = ObjectId(operation.get('id'))
+            except (InvalidId, TypeError):
+                raise ValueError('{0} requires a valid trip id'.format(op))
+        if op != 'delete':
+            trip = operation.get('trip')
+            if not isinstance(trip, dict):
+                raise ValueError('{0} requires a trip object'.format(op))
+            # the owner and _id are ours to set
+            trip = dict(trip)
+            trip.pop('_id', None)
+            trip.pop('user', None)
+            trip.pop('version', None)
+            clean_waypoints(trip)
+            parsed['trip'] = trip
+        return parsed
+
+
+class NearbyTrips(Resource):
+    # The user's trips with a waypoint near a point or inside a box, found
+    # through the user + waypoints.location 2dsphere index:
+    #
+    #   GET /trip/nearby/?near=<lng>,<lat>&radius=<metres>  closest first
+    #   GET /trip/nearby/?box=<west>,<south>,<east>,<north>  at most 5 degrees
+    #
+    # ?waypoints=1 answers with the matching waypoints of those trips
+    # instead, each with its trip id and position in the trip.
+
+    @requires_auth
+    def get(self):
+        args = request.args
+        try:
+            limit, _ = parse_page_args(args)
+            if 'near' in args:
+                point = geo.parse_pair(args['near'], 'near')
+                try:
+                    radius = float(args.get('radius', geo.DEFAULT_RADIUS))
+                except ValueError:
+                    raise geo.GeoError('radius must be a number of metres')
+                if not 0 < radius <= geo.MAX_RADIUS:
+                    raise geo.GeoError('radius must be between 0 and {0} '
+                                       'metres'.format(geo.MAX_RADIUS))
+                condition = geo.near_query(point, radius)
+            elif 'box' in args:
+                box = geo.parse_box(args['box'])
+                condition = geo.within_query(box)
+            else:
+                return ({'error': 'Request requires near or box'}, 400, None)
+        except ValueError as e:
+            return ({'error': str(e)}, 400, None)
+
+        trips = list(current_app.db.trips.find(
+            {'user': g.username, 'waypoints.location': condition}
+        ).limit(limit))
+        if not args.get('waypoints'):
+            return {'trips': trips}
+
+        waypoints = []
+        for trip in trips:
+            for index, waypoint in geo.located(trip):
+                coordinates = waypoint['location']['coordinates']
+                match = {'trip': trip['_id'], 'index': index,
+                         'waypoint': waypoint}
+                if 'near' in args:
+                    match['distance'] = geo.haversine(
+                        point['coordinates'], coordinates)
+                    if match['distance'] > radius:
+                        continue
+                elif not geo.in_box(coordinates, box):
+                    continue
+                waypoints.append(match)
+        if 'near' in args:
+            waypoints.sort(key=lambda match: match['distance'])
+        return {'waypoints': waypoints}
+
+
+class TripSearch(Resource):
+    # The user's trips matching words in their name or waypoint names,
+    # best match first, through the trip_search text index:
+    #
+    #   GET /trip/search/?q=<words>&limit=&offset=
+    #
+    # Matches in the name count five times a waypoint's. Each trip carries
+    # its score and next is the offset of the following page.
+    MAX_QUERY_LENGTH = 200
+
+    @requires_auth
+    def get(self):
+        search = request.args.get('q', '').strip()
+        if not search:
+            return ({'error': 'Request requires a search query q'}, 400, None)
+        if len(search) > self.MAX_QUERY_LENGTH:
+            return ({'error': 'q must be at most {0} characters'.format(
+                self.MAX_QUERY_LENGTH)}, 400, None)
+        try:
+            limit, _ = parse_page_args(request.args)
+            offset = parse_offset(request.args)
+        except PageError as e:
+            return ({'error': str(e)}, 400, None)
+
+        trips, next_offset = text_page(current_app.db.trips,
+                                       {'user': g.username}, search,
+                                       limit, offset)
+        return {'trips': trips, 'next': next_offset}
+
+
+class TripRoute(Resource):
+    # Total distance of the trip's located waypoints in their current order
+    # and a shorter order for visiting them, see utils.routes. A route only
+    # changes with its trip's version, so it is cached and tagged by it.
+
+    @requires_auth
+    def get(self, trip_id):
+        try:
+            trip = find_trip(g.username, ObjectId(trip_id))
+        except InvalidId:
+            return (None, 404, None)
+        if trip is None:
+            return (None, 404, None)
+
+        version = trip.get('version', 0)
+        tag = make_etag(trip['_id'], version, 'route')
+        if is_fresh(tag):
+            return not_modified(tag)
+        headers = {'ETag': etag_header(tag)}
+
+        key = ('route', g.username, trip_id, version)
+        route = current_app.route_cache.get(key)
+        if route is None:
+            try:
+                route = routes.plan_route(trip)
+            except routes.RouteError as e:
+                return ({'error': str(e)}, 400, None)
+            route['trip'] = trip['_id']
+            route['version'] = version
+            current_app.route_cache.set(key, route)
+        return (route, 200, headers)
+
+
+def bootstrap_indexes(app):
+    ensure_indexes(app.db, [User, Trip])
 
 
 # provide a custom JSON serializer for flaks_restful
-@api.representation('application/json')
 def output_json(data, code, headers=None):
-    resp = make_response(JSONEncoder().encode(data), code)
-    resp.headers.extend(headers or {})
-    return resp
+    return json_response(data, code, headers)
+
+
+def create_app(config=None):
+    app = Flask(__name__)
+    # MONGO_* settings from the environment, overridden by config
+    app.config.update(database.config_from_env())
+    # tokens signed with a per-process key only work against this process,
+    # so set SECRET_KEY when running more than one worker
+    app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY') or os.urandom(24)
+    app.config['AUTH_TOKEN_MAX_AGE'] = 3600
+    app.config.update(config or {})
+
+    # the process-wide client, shared by every app built here
+    app.db = database.AppDatabase(app.config)
+    # fixed by BCRYPT_ROUNDS or calibrated to BCRYPT_BUDGET_MS at startup
+    app.bcrypt_rounds = bcrypt_cost.rounds
+    app.credential_cache = CredentialCache()
+    # read-through cache of trip lists, sized with the
+    # TRIP_CACHE_MAX_ENTRIES / TRIP_CACHE_MAX_BYTES / TRIP_CACHE_TTL variables
+    app.trip_cache = LRUTTLCache.from_env('TRIP_CACHE')
+    # planned routes by trip version, sized with the ROUTE_CACHE_* variables
+    app.route_cache = LRUTTLCache.from_env('ROUTE_CACHE')
+
+    api = Api(app)
+    api.add_resource(Trip, '/trip/', '/trip/<string:trip_id>')
+    api.add_resource(TripBatch, '/trip/batch/')
+    api.add_resource(TripLookup, '/trip/lookup/')
+    api.add_resource(NearbyTrips, '/trip/nearby/')
+    api.add_resource(TripSearch, '/trip/search/')
+    api.add_resource(TripRoute, '/trip/<string:trip_id>/route/')
+    api.add_resource(User, '/user/')
+    api.add_resource(Login, '/login/')
+    api.representation('application/json')(output_json)
+
+    bootstrap_before_first_request(app, lambda: bootstrap_indexes(app))
+    # slow queries, request query counts and collection scans
+    query_log.init_app(app)
+    # per-endpoint auth/db/serialization timings on GET /metrics
+    metrics.init_app(app, [
+        metrics.cache_stats('trip', app.trip_cache),
+        metrics.cache_stats('route', app.route_cache),
+        metrics.cache_stats('credential', app.credential_cache)])
+    return app
+
+app = create_app()
 
 if __name__ == '__main__':
-    # Turn this on in debug mode to get detailled information about request
-    # related exceptions: http://flask.pocoo.org/docs/0.10/config/
-    app.config['TRAP_BAD_REQUEST_ERRORS'] = True
-    app.run(debug=True)
+    if '--asyncio' in sys.argv:
+        # one event loop holds the connections, the views run in its
+        # executor threads
+        asyncio_server.serve(app)
+    else:
+        # Turn this on in debug mode to get detailled information about
+        # request related exceptions: http://flask.pocoo.org/docs/0.10/config/
+        app.config['TRAP_BAD_REQUEST_ERRORS'] = True
+        app.run(debug=True)
@@ -0,0 +1,381 @@
+import bengServer
+import unittest
+import json
+import base64
+import http.client
+from werkzeug.test import Client
+from utils.asyncio_server import start_in_thread, stop_in_thread
+
+
+def auth_header(username, password):
+    credentials = '{0}:{1}'.format(username, password).encode('utf-8')
+    encode_login = base64.b64encode(credentials).decode()
+    return dict(Authorization="Basic " + encode_login)
+
+
+class BengServerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        # Run app in testing mode to retrieve exceptions and stack traces,
+        # against the test database on the process-wide client
+        self.server = bengServer.create_app({'TESTING': True,
+                                             'MONGO_DBNAME': 'test_database'})
+        self.app = self.server.test_client()
+        db = self.server.db
+
+        # Drop collection (significantly faster than dropping entire db)
+        db.drop_collection('users')
+        db.drop_collection('trips')
+        # dropping a collection drops its indexes too
+        bengServer.bootstrap_indexes(self.server)
+
+    def create_user(self, username='doge', password='1234'):
+        return self.app.post('/user/',
+                             data=json.dumps(dict(username=username,
+                                                  password=password)),
+                             content_type='application/json')
+
+    def post_trip(self, trip, username='doge', password='1234'):
+        return self.app.post('/trip/',
+                             data=json.dumps(trip),
+                             content_type='application/json',
+                             headers=auth_header(username, password))
+
+    # User tests
+    def test_duplicate_username_rejected(self):
+        response = self.create_user()
+        self.assertEqual(response.status_code, 200)
+
+        response = self.create_user()
+        responseJSON = json.loads(response.data.decode())
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(responseJSON['error'], 'Username already in use')
+
+    def test_token_auth(self):
+        self.create_user()
+        response = self.app.post('/login/', headers=auth_header('doge', '1234'))
+        self.assertEqual(response.status_code, 200)
+        token = json.loads(response.data.decode())['token']
+
+        response = self.app.get('/user/',
+                                headers={'Authorization': 'Bearer ' + token})
+        self.assertEqual(response.status_code, 200)
+
+        response = self.app.get('/user/',
+                                headers={'Authorization': 'Bearer nope'})
+        self.assertEqual(response.status_code, 401)
+
+    # Trip tests
+    def test_posting_and_getting_trip(self):
+        self.create_user()
+        response = self.post_trip(dict(name='europe',
+                                       waypoints=['london', 'paris', 'milan']))
+        self.assertEqual(response.status_code, 201)
+        trip_id = json.loads(response.data.decode())['_id']
+
+        response = self.app.get('/trip/' + trip_id,
+                                headers=auth_header('doge', '1234'))
+        responseJSON = json.loads(response.data.decode())
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(responseJSON['name'], 'europe')
+
+    def test_paginated_trip_listing(self):
+        self.create_user()
+        for name in ['a', 'b', 'c']:
+            self.post_trip(dict(name=name, waypoints=[]))
+
+        response = self.app.get('/trip/?limit=2',
+                                headers=auth_header('doge', '1234'))
+        page = json.loads(response.data.decode())
+        self.assertEqual([t['name'] for t in page['trips']], ['a', 'b'])
+
+        response = self.app.get('/trip/?limit=2&after=' + page['next'],
+                                headers=auth_header('doge', '1234'))
+        page = json.loads(response.data.decode())
+        self.assertEqual([t['name'] for t in page['trips']], ['c'])
+        self.assertIsNone(page['next'])
+
+    def test_streamed_trip_listing(self):
+        self.create_user()
+        for name in ['a', 'b']:
+            self.post_trip(dict(name=name, waypoints=[]))
+
+        response = self.app.get('/trip/?stream=1',
+                                headers=auth_header('doge', '1234'))
+        trips = json.loads(response.data.decode())
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(sorted(t['name'] for t in trips), ['a', 'b'])
+
+    def test_batch_operations(self):
+        self.create_user()
+        response = self.post_trip(dict(name='old', waypoints=[]))
+        old_id = json.loads(response.data.decode())['_id']
+
+        operations = [
+            dict(op='create', trip=dict(name='new', waypoints=[])),
+            dict(op='update', id=old_id, trip=dict(name='renamed')),
+            dict(op='delete', id='55f0cbb4236f44b7f0e3cb23'),
+        ]
+        response = self.app.post('/trip/batch/',
+                                 data=json.dumps(dict(ordered=False,
+                                                      operations=operations)),
+                                 content_type='application/json',
+                                 headers=auth_header('doge', '1234'))
+        results = json.loads(response.data.decode())['results']
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([r['status'] for r in results],
+                         ['ok', 'ok', 'not_found'])
+
+        response = self.app.get('/trip/' + old_id,
+                                headers=auth_header('doge', '1234'))
+        self.assertEqual(json.loads(response.data.decode())['name'], 'renamed')
+
+    def test_conditional_get(self):
+        self.create_user()
+        response = self.post_trip(dict(name='europe', waypoints=[]))
+        trip_id = json.loads(response.data.decode())['_id']
+
+        headers = auth_header('doge', '1234')
+        response = self.app.get('/trip/' + trip_id, headers=headers)
+        etag = response.headers['ETag']
+
+        headers['If-None-Match'] = etag
+        response = self.app.get('/trip/' + trip_id, headers=headers)
+        self.assertEqual(response.status_code, 304)
+
+        self.app.put('/trip/' + trip_id,
+                     data=json.dumps(dict(name='asia')),
+                     content_type='application/json',
+                     headers=auth_header('doge', '1234'))
+        response = self.app.get('/trip/' + trip_id, headers=headers)
+        self.assertEqual(response.status_code, 200)
+
+    def test_cached_trip_sees_other_workers_writes(self):
+        self.create_user()
+        response = self.post_trip(dict(name='europe', waypoints=[]))
+        trip_id = json.loads(response.data.decode())['_id']
+        headers = auth_header('doge', '1234')
+        self.app.get('/trip/' + trip_id, headers=headers)
+
+        # another worker, with its own trip cache, renames the trip
+        other = bengServer.create_app({'TESTING': True,
+                                       'MONGO_DBNAME': 'test_database'})
+        other.test_client().put('/trip/' + trip_id,
+                                data=json.dumps(dict(name='asia')),
+                                content_type='application/json',
+                                headers=headers)
+
+        response = self.app.get('/trip/' + trip_id, headers=headers)
+        self.assertEqual(json.loads(response.data.decode())['name'], 'asia')
+
+    def test_conditional_list(self):
+        self.create_user()
+        headers = auth_header('doge', '1234')
+        etag = self.app.get('/trip/', headers=headers).headers['ETag']
+
+        headers['If-None-Match'] = etag
+        self.assertEqual(self.app.get('/trip/', headers=headers).status_code,
+                         304)
+
+        response = self.post_trip(dict(name='europe', waypoints=[]))
+        trip_id = json.loads(response.data.decode())['_id']
+        response = self.app.get('/trip/', headers=headers)
+        self.assertEqual(response.status_code, 200)
+
+        # updates and deletes change the list's ETag too
+        for write in (self.app.put, self.app.delete):
+            headers['If-None-Match'] = response.headers['ETag']
+            write('/trip/' + trip_id, data=json.dumps(dict(name='asia')),
+                  content_type='application/json',
+                  headers=auth_header('doge', '1234'))
+            response = self.app.get('/trip/', headers=headers)
+            self.assertEqual(response.status_code, 200)
+
+    def test_multi_get(self):
+        self.create_user()
+        trip_ids = [json.loads(self.post_trip(dict(name=name, waypoints=[]))
+                               .data.decode())['_id']
+                    for name in ['a', 'b', 'c']]
+        missing = '55f0cbb4236f44b7f0e3cb23'
+        headers = auth_header('doge', '1234')
+
+        ids = [trip_ids[2], missing, trip_ids[0]]
+        response = self.app.get('/trip/?ids=' + ','.join(ids),
+                                headers=headers)
+        result = json.loads(response.data.decode())
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([t['name'] for t in result['trips']], ['c', 'a'])
+        self.assertEqual(result['missing'], [missing])
+
+        response = self.app.post('/trip/lookup/',
+                                 data=json.dumps(dict(ids=ids + ['nope'])),
+                                 content_type='application/json',
+                                 headers=headers)
+        result = json.loads(response.data.decode())
+        self.assertEqual([t['name'] for t in result['trips']], ['c', 'a'])
+        self.assertEqual(result['missing'], [missing, 'nope'])
+
+        # the same trip in another hex case is still one trip
+        response = self.app.get('/trip/?ids={0},{1}'.format(
+            trip_ids[0], trip_ids[0].upper()), headers=headers)
+        result = json.loads(response.data.decode())
+        self.assertEqual([t['name'] for t in result['trips']], ['a'])
+        self.assertEqual(result['missing'], [])
+
+    def test_nearby_trips(self):
+        self.create_user()
+        self.post_trip(dict(name='europe', waypoints=[
+            'home',
+            dict(name='london', location=[-0.1276, 51.5072]),
+            dict(name='paris', location=[2.3522, 48.8566])]))
+        self.post_trip(dict(name='africa', waypoints=[
+            dict(name='cairo', location=[31.2357, 30.0444])]))
+        headers = auth_header('doge', '1234')
+
+        response = self.app.get('/trip/nearby/?near=2.35,48.85&radius=10000',
+                                headers=headers)
+        trips = json.loads(response.data.decode())['trips']
+        self.assertEqual([trip['name'] for trip in trips], ['europe'])
+
+        response = self.app.get('/trip/nearby/?box=-1,48,3,52&waypoints=1',
+                                headers=headers)
+        waypoints = json.loads(response.data.decode())['waypoints']
+        self.assertEqual(sorted(match['index'] for match in waypoints),
+                         [1, 2])
+
+        response = self.post_trip(dict(name='bad', waypoints=[
+            dict(name='nowhere', location=[200, 0])]))
+        self.assertEqual(response.status_code, 400)
+        response = self.app.get('/trip/nearby/?box=5,45,-5,55',
+                                headers=headers)
+        self.assertEqual(response.status_code, 400)
+
+    def test_waypoint_patch(self):
+        self.create_user()
+        response = self.post_trip(dict(name='europe',
+                                       waypoints=['london', 'paris']))
+        trip_id = json.loads(response.data.decode())['_id']
+
+        def patch(operation):
+            return self.app.patch('/trip/' + trip_id,
+                                  data=json.dumps(operation),
+                                  content_type='application/json',
+                                  headers=auth_header('doge', '1234'))
+
+        patch(dict(op='append', waypoint='milan'))
+        patch(dict(op='insert', position=0, waypoint='home'))
+        patch(dict(op='move', **{'from': 3, 'to': 1}))
+        response = patch(dict(op='remove', position=2))
+        trip = json.loads(response.data.decode())
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(trip['waypoints'], ['home', 'milan', 'paris'])
+        self.assertEqual(trip['version'], 5)
+
+        # an edit made against an older version is refused
+        response = patch(dict(op='append', waypoint='rome', version=1))
+        self.assertEqual(response.status_code, 409)
+        response = patch(dict(op='move', **{'from': 0, 'to': 5}))
+        self.assertEqual(response.status_code, 400)
+        response = self.app.patch('/trip/nope',
+                                  data=json.dumps(dict(op='append',
+                                                       waypoint='rome')),
+                                  content_type='application/json',
+                                  headers=auth_header('doge', '1234'))
+        self.assertEqual(response.status_code, 404)
+
+    def test_trip_search(self):
+        self.create_user()
+        self.post_trip(dict(name='paris weekend', waypoints=['louvre']))
+        self.post_trip(dict(name='europe', waypoints=[
+            'london', dict(name='paris', location=[2.3522, 48.8566])]))
+        self.post_trip(dict(name='asia', waypoints=['tokyo']))
+        headers = auth_header('doge', '1234')
+
+        response = self.app.get('/trip/search/?q=paris&limit=1',
+                                headers=headers)
+        page = json.loads(response.data.decode())
+        self.assertEqual(response.status_code, 200)
+        # a match in the name ranks above one in a waypoint
+        self.assertEqual([t['name'] for t in page['trips']], ['paris weekend'])
+        self.assertEqual(page['next'], 1)
+
+        response = self.app.get('/trip/search/?q=paris&limit=1&offset=1',
+                                headers=headers)
+        page = json.loads(response.data.decode())
+        self.assertEqual([t['name'] for t in page['trips']], ['europe'])
+        self.assertIsNone(page['next'])
+
+        response = self.app.get('/trip/search/', headers=headers)
+        self.assertEqual(response.status_code, 400)
+
+    def test_trip_route(self):
+        self.create_user()
+        response = self.post_trip(dict(name='europe', waypoints=[
+            dict(name='london', location=[-0.1276, 51.5072]),
+            dict(name='cairo', location=[31.2357, 30.0444]),
+            dict(name='paris', location=[2.3522, 48.8566]),
+            'home']))
+        trip_id = json.loads(response.data.decode())['_id']
+        headers = auth_header('doge', '1234')
+
+        response = self.app.get('/trip/' + trip_id + '/route/',
+                                headers=headers)
+        route = json.loads(response.data.decode())
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(route['optimized_order'], [0, 2, 1])
+        self.assertEqual(route['unlocated'], [3])
+        self.assertLess(route['optimized_distance'], route['distance'])
+
+        headers['If-None-Match'] = response.headers['ETag']
+        response = self.app.get('/trip/' + trip_id + '/route/',
+                                headers=headers)
+        self.assertEqual(response.status_code, 304)
+
+        response = self.app.get('/trip/nope/route/',
+                                headers=auth_header('doge', '1234'))
+        self.assertEqual(response.status_code, 404)
+
+
+def forward_to(port):
+    # WSGI app that replays each test client request over HTTP, so the tests
+    # above can run unchanged against the asyncio server
+    def proxy(environ, start_response):
+        path = environ['PATH_INFO']
+        if environ.get('QUERY_STRING'):
+            path += '?' + environ['QUERY_STRING']
+        headers = dict((key[5:].replace('_', '-').title(), value)
+                       for key, value in environ.items()
+                       if key.startswith('HTTP_'))
+        if environ.get('CONTENT_TYPE'):
+            headers['Content-Type'] = environ['CONTENT_TYPE']
+        length = int(environ.get('CONTENT_LENGTH') or 0)
+        body = environ['wsgi.input'].read(length) if length else None
+
+        conn = http.client.HTTPConnection('127.0.0.1', port)
+        conn.request(environ['REQUEST_METHOD'], path, body, headers)
+        response = conn.getresponse()
+        data = response.read()
+        conn.close()
+        start_response('{0} {1}'.format(response.status, response.reason),
+                       [(name, value) for name, value in response.getheaders()
+                        if name.lower() not in ('connection',
+                                                'transfer-encoding')])
+        return [data]
+    return proxy
+
+
+class AsyncioBengServerTestCase(BengServerTestCase):
+    # every test again, served by utils.asyncio_server
+
+    def setUp(self):
+        super(AsyncioBengServerTestCase, self).setUp()
+        self.http_server = start_in_thread(self.server)
+        self.app = Client(forward_to(self.http_server.port),
+                          self.server.response_class)
+
+    def tearDown(self):
+        stop_in_thread(self.http_server)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -3,18 +3,32 @@ import bcrypt
 
 
 # """ PYMONGO IMPORTS """
-from pymongo import MongoClient
-
-
-# """ PYMONGO SETUP """
-mongo = MongoClient('localhost', 27017)
-db = mongo.develop_database
+from pymongo import IndexModel, ASCENDING, InsertOne, UpdateOne
+from pymongo.errors import DuplicateKeyError, BulkWriteError
 
 
 # """ BSON IMPORTS """
 from bson.objectid import ObjectId
 
 
+# """ FLASK IMPORTS """
+from flask import current_app, has_app_context
+
+
+# """ LOCAL IMPORTS """
+from utils import database
+from utils.auth_cache import CredentialCache
+from utils.hash_pool import hash_pool
+from utils.bcrypt_cost import bcrypt_cost
+from utils.indexes import create_indexes
+from utils.queryset import QuerySet
+from utils.unit_of_work import current_unit_of_work
+
+
+# """ AUTH CACHE """
+credential_cache = CredentialCache()
+
+
 # """ EXCEPTIONS """
 class NullDocumentException(Exception):
     pass
@@ -27,8 +41,16 @@ class DBModel(object):
     ' May be extended to provide additional functionality.
     ' NOTES
     ' 1. MongoDB collection based on class (or extended class) name.
+    ' 2. Subclasses list the indexes their queries need in INDEXES.
+    ' 3. Inside a request of an app using utils.unit_of_work, loads go
+    '    through a per-request identity map and saves are deferred until
+    '    the end of the request unless DEFERRED_SAVE is False.
     """
 
+    """ CLASS CONSTANTS """
+    INDEXES = []
+    DEFERRED_SAVE = True
+
     def __init__(self, identifier=None, rawdata=None):
         """
         ' PURPOSE
@@ -43,6 +65,7 @@ class DBModel(object):
         '   <DBModel model>
         """
         self.is_saved = False
+        self._clear_changes()
         if identifier:
             self._queryload({'_id': ObjectId(identifier)})
         elif rawdata:
@@ -61,6 +84,49 @@ class DBModel(object):
         """
         self.is_saved = True
         self.data = data
+        self._clear_changes()
+
+    def _clear_changes(self):
+        """
+        ' PURPOSE
+        '   Private method which forgets the keys changed since the last
+        '   load or save.
+        ' PARAMETERS
+        '   None
+        ' RETURNS
+        '   None
+        """
+        self._dirty = set()
+        self._unset = set()
+
+    def is_dirty(self):
+        """
+        ' PURPOSE
+        '   Tells whether the model has changes that haven't been saved.
+        ' PARAMETERS
+        '   None
+        ' RETURNS
+        '   <bool dirty>
+        """
+        return bool(self._dirty or self._unset)
+
+    def _changes(self):
+        """
+        ' PURPOSE
+        '   Private method building the minimal update document for the
+        '   keys set or unset since the last load or save.
+        ' PARAMETERS
+        '   None
+        ' RETURNS
+        '   <dict update> with $set and/or $unset, empty if nothing changed
+        """
+        changes = {}
+        updated = self._dirty - {'_id'}
+        if updated:
+            changes['$set'] = dict((key, self.data[key]) for key in updated)
+        if self._unset:
+            changes['$unset'] = dict((key, '') for key in self._unset)
+        return changes
 
     def _queryload(self, query):
         """
@@ -72,12 +138,67 @@ class DBModel(object):
         '   None
         ' EXCEPTIONS
         '   NullDocumentException
+        ' NOTES
+        '   1. Answered from the request's identity map when the same
+        '      document was already loaded, in which case the model shares
+        '      the mapped instance's state.
         """
+        uow = current_unit_of_work()
+        if uow is not None:
+            loaded = uow.get(type(self), query)
+            if loaded is not None:
+                # a constructor can't hand back the mapped instance, so this
+                # one takes over its state: data, changes and saved flag
+                self.__dict__ = loaded.__dict__
+                return
+
         collection = self._collection()
         entity = collection.find_one(query)
         if not entity:
             raise NullDocumentException()
         self._rawload(entity)
+        if uow is not None:
+            uow.add(self, query)
+
+    @classmethod
+    def _from_document(cls, document, partial=False):
+        """
+        ' PURPOSE
+        '   Private method which returns the model for a fetched document,
+        '   reusing the instance already in the request's identity map.
+        ' PARAMETERS
+        '   <dict document>
+        '   optional <bool partial> True for projected documents, which are
+        '   never added to the identity map.
+        ' RETURNS
+        '   <DBModel model>
+        """
+        uow = None if partial else current_unit_of_work()
+        if uow is not None:
+            loaded = uow.get_identity(cls, document.get('_id'))
+            if loaded is not None:
+                return loaded
+        model = cls(rawdata=document)
+        if uow is not None:
+            uow.add(model)
+        return model
+
+    @classmethod
+    def database(cls):
+        """
+        ' PURPOSE
+        '   Returns the current app's database, or the default database of
+        '   the shared client outside an app
+        ' PARAMETERS
+        '   None
+        ' RETURNS
+        '   <pymongo.database.Database db>
+        ' NOTES
+        '   1. Apps made by a factory set app.db, so each keeps its own
+        """
+        if has_app_context() and getattr(current_app, 'db', None) is not None:
+            return current_app.db
+        return database.get_database()
 
     @classmethod
     def _collection(cls):
@@ -89,7 +210,24 @@ class DBModel(object):
         ' RETURNS
         '   None
         """
-        return db[cls.__name__]
+        return cls.database()[cls.__name__]
+
+    @classmethod
+    def ensure_indexes(cls):
+        """
+        ' PURPOSE
+        '   Creates the indexes listed in INDEXES on this model's collection.
+        '   Indexes that already exist are left alone.
+        ' PARAMETERS
+        '   None
+        ' RETURNS
+        '   None
+        ' NOTES
+        '   1. An index the data can't satisfy is logged and skipped, see
+        '      utils.indexes.
+        """
+        if cls.INDEXES:
+            create_indexes(cls._collection(), cls.INDEXES)
 
     def save(self):
         """
@@ -100,28 +238,127 @@ class DBModel(object):
         '   None
         ' RETURNS
         '   <bool success> True if saved, False if not.
+        ' NOTES
+        '   1. During a request with a unit of work the write is queued and
+        '      flushed with the request's other saves; the _id is assigned
+        '      immediately.
+        '   2. A loaded model with no changes is not written at all.
         """
+        if self.is_saved and not self.is_dirty():
+            return True
+
+        uow = current_unit_of_work()
+        if uow is not None and self.DEFERRED_SAVE:
+            self.data.setdefault('_id', ObjectId())
+            uow.register_save(self)
+            return True
+
         if self.is_saved:
             self._update()
         else:
             self._insert()
         return True
 
+    def _write_op(self):
+        """
+        ' PURPOSE
+        '   Private method returning the bulk write operation that saves the
+        '   current model.
+        ' PARAMETERS
+        '   None
+        ' RETURNS
+        '   <InsertOne or UpdateOne operation> or None if nothing changed
+        """
+        if not self.is_saved:
+            return InsertOne(self.data)
+        changes = self._changes()
+        if changes:
+            return UpdateOne({'_id': self.data['_id']}, changes)
+        return None
+
+    @classmethod
+    def save_many(cls, models, ordered=True):
+        """
+        ' PURPOSE
+        '   Saves several models of this class with a single bulk_write of
+        '   their inserts and minimal updates.
+        ' PARAMETERS
+        '   [DBModel model1, model2, ... modelN]
+        '   optional <bool ordered> stop at the first failed write
+        ' RETURNS
+        '   <BulkWriteResult result> or None if nothing needed writing
+        ' EXCEPTIONS
+        '   BulkWriteError, after marking the models that were written
+        """
+        written = []
+        operations = []
+        for model in models:
+            if not model.is_saved:
+                model.data.setdefault('_id', ObjectId())
+            operation = model._write_op()
+            if operation:
+                written.append(model)
+                operations.append(operation)
+        if not operations:
+            return None
+
+        try:
+            result = cls._collection().bulk_write(operations, ordered=ordered)
+        except BulkWriteError as e:
+            failed = set(error['index'] for error in e.details['writeErrors'])
+            first_failure = min(failed)
+            for index, model in enumerate(written):
+                if index in failed or (ordered and index > first_failure):
+                    continue
+                model.is_saved = True
+                model._clear_changes()
+            raise
+
+        for model in written:
+            model.is_saved = True
+            model._clear_changes()
+        return result
+
+    @classmethod
+    def delete_many(cls, models):
+        """
+        ' PURPOSE
+        '   Removes several saved models of this class with one delete.
+        ' PARAMETERS
+        '   [DBModel model1, model2, ... modelN]
+        ' RETURNS
+        '   <DeleteResult result> or None if none of the models were saved
+        """
+        uow = current_unit_of_work()
+        identifiers = []
+        for model in models:
+            if uow is not None:
+                uow.discard(model)
+            if model.is_saved:
+                identifiers.append(model.data['_id'])
+                model.is_saved = False
+        if not identifiers:
+            return None
+        return cls._collection().delete_many({'_id': {'$in': identifiers}})
+
     def _update(self):
         """
         ' PURPOSE
         '   Private method to update the current model's document.
+        '   Only the keys changed since the last load or save are sent.
         ' PARAMETERS
         '   None
         ' RETURNS
         '   None
         """
+        changes = self._changes()
+        if not changes:
+            return
         collection = self._collection()
         collection.update_one({
             '_id': self.data['_id']
-        }, {
-            '$set': self.data
-        })
+        }, changes)
+        self._clear_changes()
 
     def _insert(self):
         """
@@ -135,6 +372,7 @@ class DBModel(object):
         collection = self._collection()
         collection.insert_one(self.data)
         self.is_saved = True
+        self._clear_changes()
 
     def set(self, key, value):
         """
@@ -145,8 +383,26 @@ class DBModel(object):
         '   <object value>
         ' RETURNS
         '   None
+        ' NOTES
+        '   1. The key is marked dirty. Nested values changed in place are
+        '      not noticed, so set() them again after mutating.
         """
         self.data[key] = value
+        self._dirty.add(key)
+        self._unset.discard(key)
+
+    def unset(self, key):
+        """
+        ' PURPOSE
+        '   Removes a key from the current model's document
+        ' PARAMETERS
+        '   <str key>
+        ' RETURNS
+        '   None
+        """
+        self.data.pop(key, None)
+        self._unset.add(key)
+        self._dirty.discard(key)
 
     def get(self, key):
         """
@@ -179,11 +435,13 @@ class DBModel(object):
         ' PARAMETERS
         '   <dict query>
         ' RETURNS
-        '   [DBModel model1, model2, ... modelN]
+        '   <QuerySet query_set> lazy query yielding DBModel instances
+        ' NOTES
+        '   1. Nothing is read until the query set is iterated, counted or
+        '      checked with exists(). Narrow it first with limit, skip, sort,
+        '      projection and batch_size.
         """
-        collection = cls._collection()
-        entities = collection.find(query)
-        return [cls(rawdata=entity) for entity in entities]
+        return QuerySet(cls, query)
 
 
 class User(DBModel):
@@ -193,7 +451,9 @@ class User(DBModel):
     """
 
     """ CLASS CONSTANTS """
-    BCRYPT_ROUNDS = 12
+    BCRYPT_ROUNDS = bcrypt_cost.rounds
+    DEFERRED_SAVE = False
+    INDEXES = [IndexModel([('username', ASCENDING)], unique=True)]
 
     def __init__(self, *args, username=None, **kwargs):
         """
@@ -221,11 +481,16 @@ class User(DBModel):
         ' RETURNS
         '   None
         ' NOTES
-        '   1. Uses bcrypt library
+        '   1. Uses bcrypt library, hashed in the shared hash_pool
+        '   2. Drops any cached verification for this user
+        ' EXCEPTIONS
+        '   PoolBusy when the hash pool's queue is full
         """
         encodedpassword = password.encode('utf-8')
-        hashed = bcrypt.hashpw(encodedpassword, bcrypt.gensalt(self.BCRYPT_ROUNDS))
+        hashed = hash_pool.hashpw(encodedpassword, bcrypt.gensalt(self.BCRYPT_ROUNDS))
         self.set('password', hashed)
+        if 'username' in self.data:
+            credential_cache.invalidate(self.get('username'))
 
     def compare_password(self, password):
         """
@@ -235,24 +500,91 @@ class User(DBModel):
         '   <str password>
         ' RETURNS
         '   <bool is_same> True if passwords match, False if not.
+        ' EXCEPTIONS
+        '   PoolBusy when the hash pool's queue is full
+        ' NOTES
+        '   1. Recently verified passwords are answered from credential_cache
+        '      without running bcrypt again.
+        """
+        username = self.data.get('username')
+        hashed = self.get('password')
+        if credential_cache.check(username, password, hashed):
+            return True
+        encodedpassword = password.encode('utf-8')
+        if hash_pool.hashpw(encodedpassword, hashed) == hashed:
+            credential_cache.add(username, password, hashed)
+            return True
+        return False
+
+    def needs_rehash(self):
+        """
+        ' PURPOSE
+        '   Checks whether the saved password was hashed with a different
+        '   bcrypt cost than the one this process is configured for.
+        ' PARAMETERS
+        '   None
+        ' RETURNS
+        '   <bool stale> True if set_password should be run again.
+        """
+        return bcrypt_cost.needs_rehash(self.get('password'))
+
+    def rehash_password(self, password):
+        """
+        ' PURPOSE
+        '   Hashes the password again at the current bcrypt cost and
+        '   stores it, unless the saved hash changed since it was read.
+        ' PARAMETERS
+        '   <str password>
+        ' RETURNS
+        '   <bool stored> True if this call stored the new hash.
+        ' EXCEPTIONS
+        '   PoolBusy when the hash pool's queue is full
+        ' NOTES
+        '   1. Conditional on the old hash, so a concurrent login or
+        '      password change isn't overwritten.
         """
+        old = self.get('password')
         encodedpassword = password.encode('utf-8')
-        return bcrypt.hashpw(encodedpassword, self.get('password')) == self.get('password')
+        hashed = hash_pool.hashpw(encodedpassword, bcrypt.gensalt(self.BCRYPT_ROUNDS))
+        result = self._collection().update_one(
+            {'_id': self.data['_id'], 'password': old},
+            {'$set': {'password': hashed}})
+        if not result.modified_count:
+            return False
+        self.data['password'] = hashed
+        credential_cache.invalidate(self.get('username'))
+        return True
 
     def save(self):
         """
         ' PURPOSE
         '   Saves the current model using DBModel's inherited save method
         '   with the added functionality of rejecting a username that already
-        '   exists in the database if this model has not been loaded from an
-        '   existing document.
+        '   exists in the database.
         ' PARAMETERS
         '   None
         ' RETURNS
         '   <bool success> True if saved, False if not.
+        ' NOTES
+        '   1. Relies on the unique username index, so the check and the
+        '      write are a single operation.
         """
-        if not self.is_saved:
-            query = self.fetch({'username': self.get('username')})
-            if len(query) > 0:
-                return False
-        return super(User, self).save()
+        try:
+            return super(User, self).save()
+        except DuplicateKeyError:
+            self.data.pop('_id', None)
+            return False
+
+
+def ensure_all_indexes():
+    """
+    ' PURPOSE
+    '   Creates the indexes of every model in this module. Run once at
+    '   startup.
+    ' PARAMETERS
+    '   None
+    ' RETURNS
+    '   None
+    """
+    for model in (User,):
+        model.ensure_indexes()
@@ -3,7 +3,7 @@ from functools import wraps
 
 
 """ FLASK IMPORTS """
-from flask import Flask, request, make_response, jsonify
+from flask import Flask, request, jsonify
 from flask_restful import Resource, Api
 
 
@@ -13,7 +13,11 @@ api = Api(app)
 
 
 """ LOCAL IMPORTS """
-from models import *
+from hunterModel import *
+from utils.hash_pool import hash_pool, PoolBusy
+from utils.bcrypt_cost import bcrypt_cost
+from utils.indexes import bootstrap_before_first_request
+from utils.representation import json_response
 
 
 # """ DECORATORS """
@@ -36,8 +40,19 @@ def require_auth(f):
             user = User(username=auth.username)
         except:
             return ({'error': 'Invalid Auth.'}, 401, None)
-        if not user.compare_password(auth.password):
-            return ({'error': 'Invalid Auth.'}, 401, None)
+        try:
+            if not user.compare_password(auth.password):
+                return ({'error': 'Invalid Auth.'}, 401, None)
+        except PoolBusy:
+            return hash_pool.busy_response()
+        if user.needs_rehash():
+            # upgrade to the current bcrypt cost while we have the plaintext,
+            # a busy pool just leaves it for the next login
+            try:
+                if user.rehash_password(auth.password):
+                    bcrypt_cost.record_rehash()
+            except PoolBusy:
+                pass
 
         return f(*args, **kwargs)
     return helper
@@ -76,7 +91,10 @@ class Users(Resource):
     def post(self, username=None, password=None):
         user = User()
         user.set('username', username)
-        user.set_password(password)
+        try:
+            user.set_password(password)
+        except PoolBusy:
+            return hash_pool.busy_response()
         was_saved = user.save()
 
         if not was_saved:
@@ -93,15 +111,14 @@ class Users(Resource):
 
 """ ADD REST RESOURCE TO API """
 api.add_resource(Users, '/users/')
+# User.save relies on the unique username index to reject duplicates
+bootstrap_before_first_request(app, ensure_all_indexes)
 
 
 # """ API RESPONSE ENCODING """
 @api.representation('application/json')
 def output_json(data, code, headers=None):
-    from json import dumps as stringify
-    resp = make_response(stringify(data), code)
-    resp.headers.extend(headers or {})
-    return resp
+    return json_response(data, code, headers)
 
 
 # """ START SERVER COMMANDS """
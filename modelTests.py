@@ -0,0 +1,168 @@
+import unittest
+
+from bson.objectid import ObjectId
+from flask import Flask
+
+import hunterModel
+from OOPModel import Trip, User
+from utils import unit_of_work
+
+
+class RecordingCollection(object):
+    # just enough of a pymongo collection to see what a model sends
+
+    name = 'RecordedTrip'
+
+    def __init__(self, documents=()):
+        self.documents = list(documents)
+        self.finds = []
+        self.bulk_writes = []
+        self.updates = []
+
+    def find_one(self, query):
+        self.finds.append(query)
+        for document in self.documents:
+            if all(document.get(key) == value
+                   for key, value in query.items()):
+                return dict(document)
+        return None
+
+    def bulk_write(self, operations, ordered=True):
+        self.bulk_writes.append(operations)
+
+    def update_one(self, query, update):
+        self.updates.append((query, update))
+        matched = self.find_one(query) is not None
+
+        class Result(object):
+            modified_count = int(matched)
+        return Result()
+
+
+class RecordedTrip(Trip):
+
+    collection = None
+
+    @classmethod
+    def _collection(cls):
+        return cls.collection
+
+
+class RecordedUser(User):
+
+    BCRYPT_ROUNDS = 4
+    collection = None
+
+    @classmethod
+    def _collection(cls):
+        return cls.collection
+
+
+class RecordedHunterUser(hunterModel.User):
+
+    BCRYPT_ROUNDS = 4
+    collection = None
+
+    @classmethod
+    def _collection(cls):
+        return cls.collection
+
+
+class DBModelTestCase(unittest.TestCase):
+
+    def test_loaded_model_starts_clean(self):
+        trip = Trip(rawdata={'_id': 1, 'name': 'europe', 'waypoints': []})
+        assert not trip.is_dirty()
+        self.assertEqual(trip._changes(), {})
+        # nothing changed, so no database round trip is needed
+        assert trip.save()
+
+    def test_changes_only_include_touched_keys(self):
+        trip = Trip(rawdata={'_id': 1, 'name': 'europe', 'waypoints': []})
+        trip.set('name', 'asia')
+        trip.unset('waypoints')
+        self.assertEqual(trip._changes(), {
+            '$set': {'name': 'asia'},
+            '$unset': {'waypoints': ''},
+        })
+
+    def test_setting_id_is_never_sent(self):
+        trip = Trip(rawdata={'_id': 1})
+        trip.set('_id', 1)
+        self.assertEqual(trip._changes(), {})
+
+
+class UnitOfWorkTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.trip_id = ObjectId()
+        RecordedTrip.collection = RecordingCollection(
+            [{'_id': self.trip_id, 'name': 'europe'}])
+        self.app = Flask(__name__)
+        unit_of_work.init_app(self.app)
+
+        @self.app.route('/save/<int:status>')
+        def save(status):
+            trip = RecordedTrip()
+            trip.set('name', 'asia')
+            trip.save()
+            return '', status
+
+    def test_flushes_after_success(self):
+        self.app.test_client().get('/save/200')
+        writes = RecordedTrip.collection.bulk_writes
+        self.assertEqual(len(writes), 1)
+        self.assertEqual(writes[0][0]._doc['name'], 'asia')
+
+    def test_discards_after_error(self):
+        self.app.test_client().get('/save/400')
+        self.assertEqual(RecordedTrip.collection.bulk_writes, [])
+
+    def test_one_state_per_document(self):
+        with self.app.test_request_context():
+            first = RecordedTrip(str(self.trip_id))
+            second = RecordedTrip(str(self.trip_id))
+            # the second load never reached the collection
+            self.assertEqual(len(RecordedTrip.collection.finds), 1)
+            first.set('name', 'asia')
+            self.assertEqual(second.get('name'), 'asia')
+            assert second.is_dirty()
+            first.save()
+            second.save()
+            uow = unit_of_work.current_unit_of_work()
+            self.assertEqual(len(uow.pending), 1)
+
+
+class RehashTestCase(unittest.TestCase):
+
+    def test_rehash_only_replaces_the_hash_it_read(self):
+        document = {'_id': 1, 'username': 'doge', 'password': b'old'}
+        RecordedUser.collection = RecordingCollection([dict(document)])
+        user = RecordedUser(rawdata=dict(document))
+        assert user.rehash_password('1234')
+        query, update = RecordedUser.collection.updates[0]
+        self.assertEqual(query, {'_id': 1, 'password': b'old'})
+        self.assertEqual(user.get('password'), update['$set']['password'])
+
+        # another login got there first
+        RecordedUser.collection.documents[0]['password'] = b'newer'
+        user = RecordedUser(rawdata=dict(document))
+        assert not user.rehash_password('1234')
+        self.assertEqual(user.get('password'), b'old')
+
+    def test_hunter_rehash_only_replaces_the_hash_it_read(self):
+        document = {'_id': 1, 'username': 'doge', 'password': b'old'}
+        RecordedHunterUser.collection = RecordingCollection([dict(document)])
+        user = RecordedHunterUser(rawdata=dict(document))
+        assert user.rehash_password('1234')
+        query, update = RecordedHunterUser.collection.updates[0]
+        self.assertEqual(query, {'_id': 1, 'password': b'old'})
+
+        RecordedHunterUser.collection.documents[0]['password'] = b'newer'
+        user = RecordedHunterUser(rawdata=dict(document))
+        assert not user.rehash_password('1234')
+        self.assertEqual(user.get('password'), b'old')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,41 +1,63 @@
-from flask import Flask, request, make_response, jsonify
+import os
+from flask import Flask, request, jsonify, g
+from flask import current_app
 from flask_restful import Resource, Api
-from pymongo import MongoClient
+from pymongo import IndexModel, ASCENDING, ReturnDocument
+from pymongo.errors import DuplicateKeyError
 from bson.objectid import ObjectId
-from utils.mongo_json_encoder import JSONEncoder
-from bcrypt import hashpw, gensalt
+from bson.errors import InvalidId
+from utils import database, metrics, query_log, waypoint_patch
+from utils.representation import json_response
+from utils.auth_cache import CredentialCache
+from utils.tokens import issue_token, verify_token, bearer_token
+from utils.hash_pool import hash_pool, PoolBusy
+from utils.bcrypt_cost import bcrypt_cost
+from utils.indexes import ensure_indexes, bootstrap_before_first_request
+from bcrypt import gensalt
 from functools import wraps
 
-# # Basic Setup # #
-# assign var app to new flask instance
-app = Flask(__name__)
-# establish connection to mongodb run locally
-mongo = MongoClient('localhost', 27017)
-# specify database to use
-app.db = mongo.develop_database
-# create instance of flask_restful API
-api = Api(app)
-
-app.bcrypt_rounds = 12
-
 
 def hash_pw(password, salt=None):
-    salt = gensalt(app.bcrypt_rounds)
+    # hashing against an existing hash reuses its salt, which is how we verify
+    salt = salt or gensalt(current_app.bcrypt_rounds)
     encoded_pass = password.encode(encoding='UTF-8', errors='strict')
-    return hashpw(encoded_pass, salt)
+    # runs in the shared bcrypt process pool, raises PoolBusy when it's full
+    return hash_pool.hashpw(encoded_pass, salt)
 
 
 # User Auth code
+@metrics.timed('auth')
 def check_auth(username, password):
-    user_collection = app.db.user
+    user_collection = current_app.db.user
     user = user_collection.find_one({'username': username})
-    if user is None:
+    if user is None or 'password' not in user:
         return False
-    try:
-        hash_pw(password, user['password']) == user['password']
+    cache = current_app.credential_cache
+    if cache.check(username, password, user['password']):
         return True
-    except KeyError:
-        return False
+    if hash_pw(password, user['password']) == user['password']:
+        hashed = user['password']
+        if bcrypt_cost.needs_rehash(hashed):
+            hashed = rehash_pw(user, password)
+        cache.add(username, password, hashed)
+        return True
+    return False
+
+
+def rehash_pw(user, password):
+    # stored hash uses a different cost, upgrade it now that we know the
+    # password; if the pool is busy we try again next login
+    try:
+        hashed = hash_pw(password)
+    except PoolBusy:
+        return user['password']
+    result = current_app.db.user.update_one(
+        {'_id': user['_id'], 'password': user['password']},
+        {'$set': {'password': hashed}})
+    if result.modified_count:
+        bcrypt_cost.record_rehash()
+        return hashed
+    return user['password']
 
 
 # # User Auth code
@@ -51,36 +73,83 @@ def check_auth(username, password):
 #             return False
 
 
+def token_generation(username):
+    # bumped by every password change, so older tokens stop working; None
+    # once the user is deleted
+    user = current_app.db.user.find_one({'username': username},
+                                        {'token_generation': True})
+    if user is None:
+        return None
+    return user.get('token_generation', 0)
+
+
 def requires_auth(f):
     @wraps(f)
     def decorated(*args, **kwargs):
-        auth = request.authorization
-        if not auth or not check_auth(auth.username, auth.password):
-            message = {'error': 'Basic Auth Required.'}
-            resp = jsonify(message)
-            resp.status_code = 401
-            return resp
+        token = bearer_token(request)
+        if token is not None:
+            username = verify_token(current_app.secret_key, token,
+                                    current_app.config['AUTH_TOKEN_MAX_AGE'],
+                                    generation_of=token_generation)
+            if username is None:
+                resp = jsonify({'error': 'Invalid or expired token.'})
+                resp.status_code = 401
+                return resp
+        else:
+            auth = request.authorization
+            try:
+                authorized = auth and check_auth(auth.username, auth.password)
+            except PoolBusy:
+                return hash_pool.busy_response()
+            if not authorized:
+                message = {'error': 'Basic Auth Required.'}
+                resp = jsonify(message)
+                resp.status_code = 401
+                return resp
+            username = auth.username
 
+        # handlers read the authenticated user from here
+        g.username = username
         return f(*args, **kwargs)
     return decorated
 
 
+class Login(Resource):
+    def post(self):
+        auth = request.authorization
+        try:
+            authorized = auth and check_auth(auth.username, auth.password)
+        except PoolBusy:
+            return hash_pool.busy_response()
+        if not authorized:
+            resp = jsonify({'error': 'Basic Auth Required.'})
+            resp.status_code = 401
+            return resp
+        return {
+            'token': issue_token(current_app.secret_key, auth.username,
+                                 token_generation(auth.username)),
+            'expires_in': current_app.config['AUTH_TOKEN_MAX_AGE']
+        }
+
+
 class Trip(Resource):
+    collection = 'trip'
+    indexes = [IndexModel([('username', ASCENDING), ('_id', ASCENDING)])]
+
     @requires_auth
     def post(self):
         trip_info = request.json
-        trip_info["username"] = request.authorization.username
-        trip_collection = app.db.trip
-        result = trip_collection.insert_one(trip_info)
-        post_info = trip_collection.find_one(
-            {'_id': ObjectId(result.inserted_id)})
-        return post_info
+        trip_info["username"] = g.username
+        trip_collection = current_app.db.trip
+        # insert_one adds the new _id to trip_info
+        trip_collection.insert_one(trip_info)
+        return trip_info
 
     @requires_auth
     def get(self, trip_id=None):
-        trip_collection = app.db.Trip
+        trip_collection = current_app.db.trip
         get_info = trip_collection.find_one(
-            {'_id': ObjectId(trip_id)})
+            {'_id': ObjectId(trip_id), 'username': g.username})
         if get_info is None:
             response = jsonify(data=[])
             response.status_code = 404
@@ -90,9 +159,11 @@ class Trip(Resource):
 
     def put(self, trip_id):
         trip_info = request.json
-        trip_collection = app.db.trip
-        update_info = trip_collection.update_one(
-            {'_id': ObjectId(trip_id)}, {'$set': trip_info})
+        trip_info.pop('_id', None)
+        trip_collection = current_app.db.trip
+        update_info = trip_collection.find_one_and_update(
+            {'_id': ObjectId(trip_id)}, {'$set': trip_info},
+            return_document=ReturnDocument.AFTER)
 
         if update_info is None:
             response = jsonify(data=[])
@@ -101,11 +172,64 @@ class Trip(Resource):
         else:
             return update_info
 
+    @requires_auth
+    def patch(self, trip_id):
+        # append, insert, move or remove waypoints without resending the
+        # trip, see utils.waypoint_patch
+        try:
+            operation = waypoint_patch.parse_patch(request.json)
+        except waypoint_patch.PatchError as e:
+            response = jsonify({'error': str(e)})
+            response.status_code = 400
+            return response
+        try:
+            trip_id = ObjectId(trip_id)
+        except InvalidId:
+            response = jsonify(data=[])
+            response.status_code = 404
+            return response
+        trip_collection = current_app.db.trip
+        owner = {'_id': trip_id, 'username': g.username}
+
+        waypoints = None
+        if waypoint_patch.needs_waypoints(operation):
+            trip_info = trip_collection.find_one(owner, {'waypoints': True})
+            if trip_info is None:
+                response = jsonify(data=[])
+                response.status_code = 404
+                return response
+            waypoints = trip_info.get('waypoints')
+        try:
+            steps = waypoint_patch.plan_patch(operation, waypoints)
+        except waypoint_patch.PatchError as e:
+            response = jsonify({'error': str(e)})
+            response.status_code = 400
+            return response
+
+        update_info = None
+        for conditions, update in steps:
+            query = dict(owner)
+            query.update(conditions)
+            update_info = trip_collection.find_one_and_update(
+                query, update, return_document=ReturnDocument.AFTER)
+            if update_info is None:
+                break
+
+        if update_info is None:
+            if trip_collection.find_one(owner, {'_id': True}) is None:
+                response = jsonify(data=[])
+                response.status_code = 404
+            else:
+                # the waypoints moved under us between the read and the write
+                response = jsonify({'error': 'Trip has changed, retry'})
+                response.status_code = 409
+            return response
+        return update_info
+
     def delete(self, trip_id):
-        trip_collection = app.db.trip
-        delete_me = trip_collection.find_one(
+        trip_collection = current_app.db.trip
+        delete_me = trip_collection.find_one_and_delete(
             {'_id': ObjectId(trip_id)})
-        trip_collection.delete_one(delete_me)
 
         if delete_me is None:
             response = jsonify(data=[])
@@ -116,24 +240,30 @@ class Trip(Resource):
 
 
 class User(Resource):
-    app.bcrypt_rounds = 12
+    collection = 'user'
+    indexes = [IndexModel([('username', ASCENDING)], unique=True)]
 
     def post(self):
         user_info = request.json
-        user_collection = app.db.user
+        user_collection = current_app.db.user
         freshpw = user_info["password"]
-        user_info['password'] = hash_pw(freshpw)
-        insert_user = user_collection.insert_one(user_info)
-        post_info = user_collection.find_one(
-            {'_id': ObjectId(insert_user.inserted_id)})
-        # decode byte to str
-        post_info['password'] = post_info['password'].decode('utf-8')
-        return post_info
+        user_info.pop('token_generation', None)
+        try:
+            user_info['password'] = hash_pw(freshpw)
+        except PoolBusy:
+            return hash_pool.busy_response()
+        try:
+            user_collection.insert_one(user_info)
+        except DuplicateKeyError:
+            return ({'error': 'Username already in use'}, 400, None)
+        # user_info now carries its _id; the hash stays out of responses
+        user_info.pop('password')
+        return user_info
 
     @requires_auth
     def get(self):
-        username = request.authorization.username
-        user_collection = app.db.user
+        username = g.username
+        user_collection = current_app.db.user
         retrieve_user = user_collection.find_one({'username': username})
         if not retrieve_user:
             # return error response
@@ -146,34 +276,87 @@ class User(Resource):
 
     @requires_auth
     def put(self):
-        username = request.authorization.username
+        username = g.username
         user_info = request.json
-        user_collection = app.db.user
-        update_user = user_collection.update_one(
-            {'username': username}, {'$set': user_info})
+        user_collection = current_app.db.user
+        if 'password' in user_info:
+            try:
+                user_info['password'] = hash_pw(user_info['password'])
+            except PoolBusy:
+                return hash_pool.busy_response()
+        user_info.pop('_id', None)
+        user_info.pop('token_generation', None)
+        update = {'$set': user_info}
+        if 'password' in user_info:
+            # tokens issued under the old password stop working
+            update['$inc'] = {'token_generation': 1}
+        update_user = user_collection.find_one_and_update(
+            {'username': username}, update,
+            projection={'password': False},
+            return_document=ReturnDocument.AFTER)
+        current_app.credential_cache.invalidate(username)
+        if update_user is None:
+            response = jsonify(data=[])
+            response.status_code = 404
+            return response
         return update_user
 
     @requires_auth
     def delete(self):
-        username = request.authorization.username
-        user_collection = app.db.user
-        retrieve_user = user_collection.find_one(
-            {'username': username})
-        user_collection.delete_one(retrieve_user)
+        username = g.username
+        user_collection = current_app.db.user
+        retrieve_user = user_collection.find_one_and_delete(
+            {'username': username}, projection={'password': False})
+        current_app.credential_cache.invalidate(username)
+        if retrieve_user is None:
+            response = jsonify(data=[])
+            response.status_code = 404
+            return response
         return retrieve_user
 
 
-# Add REST resource to API
-api.add_resource(Trip, '/trip/', '/trip/<string:trip_id>', endpoint='trip')
-api.add_resource(User, '/user/', endpoint='user')
+def bootstrap_indexes(app):
+    ensure_indexes(app.db, [User, Trip])
 
 
 # provide a custom JSON serializer for flaks_restful
-@api.representation('application/json')
 def output_json(data, code, headers=None):
-    resp = make_response(JSONEncoder().encode(data), code)
-    resp.headers.extend(headers or {})
-    return resp
+    return json_response(data, code, headers)
+
+
+# # Basic Setup # #
+def create_app(config=None):
+    # assign var app to new flask instance
+    app = Flask(__name__)
+    # MONGO_* settings from the environment, overridden by config
+    app.config.update(database.config_from_env())
+    # set SECRET_KEY so tokens stay valid across workers and restarts
+    app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY') or os.urandom(24)
+    app.config['AUTH_TOKEN_MAX_AGE'] = 3600
+    app.config.update(config or {})
+    # specify database to use, from the one client shared by this process
+    app.db = database.AppDatabase(app.config)
+    # fixed by BCRYPT_ROUNDS or calibrated to BCRYPT_BUDGET_MS at startup
+    app.bcrypt_rounds = bcrypt_cost.rounds
+    app.credential_cache = CredentialCache()
+
+    # create instance of flask_restful API
+    api = Api(app)
+    # Add REST resource to API
+    api.add_resource(Trip, '/trip/', '/trip/<string:trip_id>', endpoint='trip')
+    api.add_resource(User, '/user/', endpoint='user')
+    api.add_resource(Login, '/login/', endpoint='login')
+    api.representation('application/json')(output_json)
+
+    bootstrap_before_first_request(app, lambda: bootstrap_indexes(app))
+    # slow queries, request query counts and collection scans
+    query_log.init_app(app)
+    # per-endpoint auth/db/serialization timings on GET /metrics
+    metrics.init_app(app, [
+        metrics.cache_stats('credential', app.credential_cache)])
+    return app
+
+app = create_app()
 
 if __name__ == '__main__':
     # Turn this on in debug mode to get detailled information about request related exceptions: http://flask.pocoo.org/docs/0.10/config/
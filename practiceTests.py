@@ -1,7 +1,6 @@
 import practiceServer
 import unittest
 import json
-from pymongo import MongoClient
 import base64
 
 
@@ -14,14 +13,12 @@ def auth_header(username, password):
 class FlaskrTestCase(unittest.TestCase):
 
     def setUp(self):
-        self.app = practiceServer.app.test_client()
-        # Run app in testing mode to retrieve exceptions and stack traces
-        practiceServer.app.config['TESTING'] = True
-
-        # Inject test database into application
-        mongo = MongoClient('localhost', 27017)
-        db = mongo.test_database
-        practiceServer.app.db = db
+        # Run app in testing mode to retrieve exceptions and stack traces,
+        # against the test database on the process-wide client
+        self.server = practiceServer.create_app({'TESTING': True,
+                                                 'MONGO_DBNAME': 'test_database'})
+        self.app = self.server.test_client()
+        db = self.server.db
 
         # Drop collection (significantly faster than dropping entire db)
         db.drop_collection('user')
@@ -66,6 +63,44 @@ class FlaskrTestCase(unittest.TestCase):
         self.assertEqual(response.status_code, 200)
         print(responseJSON)
 
+    def test_trip_waypoint_patch(self):
+        self.app.post('/user/', data=json.dumps(
+            dict(username='doge', password='1234')),
+            content_type='application/json')
+        response = self.app.post('/trip/', data=json.dumps(
+            dict(trip='europe', waypoints=['london', 'paris'])),
+            content_type='application/json',
+            headers=auth_header('doge', '1234'))
+        trip_id = json.loads(response.data.decode())['_id']
+
+        response = self.app.patch('/trip/' + trip_id, data=json.dumps(
+            dict(op='insert', position=1, waypoint='calais')),
+            content_type='application/json',
+            headers=auth_header('doge', '1234'))
+        responseJSON = json.loads(response.data.decode())
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(responseJSON['waypoints'],
+                         ['london', 'calais', 'paris'])
+
+        # removing by position leaves other null waypoints alone
+        response = self.app.post('/trip/', data=json.dumps(
+            dict(trip='gaps', waypoints=['london', None, 'paris'])),
+            content_type='application/json',
+            headers=auth_header('doge', '1234'))
+        gaps_id = json.loads(response.data.decode())['_id']
+        response = self.app.patch('/trip/' + gaps_id, data=json.dumps(
+            dict(op='remove', position=2)),
+            content_type='application/json',
+            headers=auth_header('doge', '1234'))
+        responseJSON = json.loads(response.data.decode())
+        self.assertEqual(responseJSON['waypoints'], ['london', None])
+
+        response = self.app.patch('/trip/not-an-id', data=json.dumps(
+            dict(op='append', waypoint='rome')),
+            content_type='application/json',
+            headers=auth_header('doge', '1234'))
+        self.assertEqual(response.status_code, 404)
+
     # # Trip tests
     # def test_posting_trip(self):
     #     # create new user
@@ -1,7 +1,6 @@
 import practiceServer
 import unittest
 import json
-from pymongo import MongoClient
 import base64
 
 
@@ -14,14 +13,12 @@ def auth_header(username, password):
 class FlaskrTestCase(unittest.TestCase):
 
     def setUp(self):
-        self.app = practiceServer.app.test_client()
-        # Run app in testing mode to retrieve exceptions and stack traces
-        practiceServer.app.config['TESTING'] = True
-
-        # Inject test database into application
-        mongo = MongoClient('localhost', 27017)
-        db = mongo.test_database
-        practiceServer.app.db = db
+        # Run app in testing mode to retrieve exceptions and stack traces,
+        # against the test database on the process-wide client
+        self.server = practiceServer.create_app({'TESTING': True,
+                                                 'MONGO_DBNAME': 'test_database'})
+        self.app = self.server.test_client()
+        db = self.server.db
 
         # Drop collection (significantly faster than dropping entire db)
         db.drop_collection('user')
@@ -43,6 +40,7 @@ class FlaskrTestCase(unittest.TestCase):
         self.assertEqual(response.status_code, 200)
         assert 'application/json' in response.content_type
         assert 'doge' in responseJSON["username"]
+        assert 'password' not in responseJSON
 
     # def test_getting_non_existent_user(self):
     #     response = self.app.get('/user/55f0cbb4236f44b7f0e3cb23')
@@ -63,6 +61,27 @@ class FlaskrTestCase(unittest.TestCase):
         self.assertEqual(response.status_code, 200)
         assert 'dogey' in responseJSON["username"]
 
+        response = self.app.delete('/user/',
+                                   headers=auth_header('dogey', '1234'))
+        responseJSON = json.loads(response.data.decode())
+        self.assertEqual(responseJSON['username'], 'dogey')
+        assert 'password' not in responseJSON
+
+    def test_password_change_revokes_tokens(self):
+        self.app.post('/user/', data=json.dumps(dict(username='doge',
+                                                     password='1234')),
+                      content_type='application/json')
+        response = self.app.post('/login/', headers=auth_header('doge', '1234'))
+        token = json.loads(response.data.decode())['token']
+        bearer = {'Authorization': 'Bearer ' + token}
+        self.assertEqual(self.app.get('/user/', headers=bearer).status_code,
+                         200)
+
+        self.app.put('/user/', data=json.dumps(dict(password='5678')),
+                     content_type='application/json', headers=bearer)
+        self.assertEqual(self.app.get('/user/', headers=bearer).status_code,
+                         401)
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -1,29 +1,23 @@
-from flask import Flask, request, make_response, jsonify
+from flask import Flask, request, jsonify, current_app
 from flask_restful import Resource, Api
-from pymongo import MongoClient
 from bson.objectid import ObjectId
-from utils.mongo_json_encoder import JSONEncoder
-
-# Basic Setup
-app = Flask(__name__)
-mongo = MongoClient('localhost', 27017)
-app.db = mongo.develop_database
-api = Api(app)
+from utils import database
+from utils.representation import json_response
 
 #Implement REST Resource
 class MyObject(Resource):
 
     def post(self):
       new_myobject = request.json
-      myobject_collection = app.db.myobjects
-      result = myobject_collection.insert_one(request.json)
+      myobject_collection = current_app.db.myobjects
+      # insert_one adds the generated _id to the document we pass in,
+      # so there's no need to read it back
+      myobject_collection.insert_one(new_myobject)
 
-      myobject = myobject_collection.find_one({"_id": ObjectId(result.inserted_id)})
-
-      return myobject
+      return new_myobject
 
     def get(self, myobject_id):
-      myobject_collection = app.db.myobjects
+      myobject_collection = current_app.db.myobjects
       myobject = myobject_collection.find_one({"_id": ObjectId(myobject_id)})
 
       if myobject is None:
@@ -33,15 +27,27 @@ class MyObject(Resource):
       else:
         return myobject
 
-# Add REST resource to API
-api.add_resource(MyObject, '/myobject/','/myobject/<string:myobject_id>')
-
 # provide a custom JSON serializer for flaks_restful
-@api.representation('application/json')
 def output_json(data, code, headers=None):
-    resp = make_response(JSONEncoder().encode(data), code)
-    resp.headers.extend(headers or {})
-    return resp
+    return json_response(data, code, headers)
+
+
+# Basic Setup
+def create_app(config=None):
+    app = Flask(__name__)
+    # MONGO_* settings from the environment, overridden by config
+    app.config.update(database.config_from_env())
+    app.config.update(config or {})
+    # the process-wide client, shared by every app built here
+    app.db = database.AppDatabase(app.config)
+    api = Api(app)
+
+    # Add REST resource to API
+    api.add_resource(MyObject, '/myobject/','/myobject/<string:myobject_id>')
+    api.representation('application/json')(output_json)
+    return app
+
+app = create_app()
 
 if __name__ == '__main__':
     # Turn this on in debug mode to get detailled information about request related exceptions: http://flask.pocoo.org/docs/0.10/config/
@@ -1,19 +1,16 @@
 import server
 import unittest
 import json
-from pymongo import MongoClient
 
 class FlaskrTestCase(unittest.TestCase):
 
     def setUp(self):
-      self.app = server.app.test_client()
-      # Run app in testing mode to retrieve exceptions and stack traces
-      server.app.config['TESTING'] = True
-
-      # Inject test database into application
-      mongo = MongoClient('localhost', 27017)
-      db = mongo.test_database
-      server.app.db = db
+      # Run app in testing mode to retrieve exceptions and stack traces,
+      # against the test database on the process-wide client
+      self.server = server.create_app({'TESTING': True,
+                                       'MONGO_DBNAME': 'test_database'})
+      self.app = self.server.test_client()
+      db = self.server.db
 
       # Drop collection (significantly faster than dropping entire db)
       db.drop_collection('myobjects')
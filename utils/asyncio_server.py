@@ -0,0 +1,443 @@
+import asyncio
+import io
+import logging
+import os
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import unquote
+
+# asyncio HTTP/1.1 front end for a WSGI app.
+#
+# The event loop owns every connection: reading requests, writing responses
+# and waiting on keep-alive connections cost no thread, so one process can
+# hold many slow clients. Only a complete request reaches the app, which runs
+# in a thread pool where its Mongo calls share the client's connection pool
+# and bcrypt goes on to the hash process pool. The app is the same Flask app
+# the threaded server runs, so routes behave identically in both modes.
+#
+# Requests may carry a Content-Length or a chunked body, and get a
+# 100 Continue when they ask for one. Conflicting framing, such as two
+# different Content-Lengths or a Content-Length next to Transfer-Encoding,
+# is refused with 400 rather than guessed at.
+#
+#     python bengServer.py --asyncio
+#
+# Configured from the environment:
+#   ASYNC_WORKERS      threads running the app (default 32)
+#   ASYNC_MAX_BODY     largest request body in bytes (default 16MB)
+#   ASYNC_KEEP_ALIVE   seconds an idle connection is kept open (default 75)
+#   ASYNC_READ_TIMEOUT seconds a request's headers and body have to arrive
+#                      once its request line has (default 30)
+#   ASYNC_MAX_HEADERS  most header lines in a request (default 100)
+#   ASYNC_MAX_HEADER_BYTES  largest request head in bytes (default 64KB)
+
+log = logging.getLogger(__name__)
+
+STATUS_TEXT = {
+    400: 'Bad Request',
+    408: 'Request Timeout',
+    413: 'Request Entity Too Large',
+    414: 'Request-URI Too Long',
+    417: 'Expectation Failed',
+    431: 'Request Header Fields Too Large',
+    501: 'Not Implemented',
+}
+# response chunks buffered ahead of a slow reader before the app's thread
+# waits for it
+STREAM_QUEUE = 16
+_END = object()
+_ABORT = object()
+# asyncio.Task.current_task before Python 3.7
+current_task = getattr(asyncio, 'current_task', None) or \
+    asyncio.Task.current_task
+
+
+class RequestError(Exception):
+    # a request we answer with an error status and then close
+    def __init__(self, code):
+        super(RequestError, self).__init__(code)
+        self.code = code
+
+
+class AsyncioWSGIServer(object):
+
+    def __init__(self, app, host='127.0.0.1', port=5000, workers=32,
+                 max_body=16 * 1024 * 1024, keep_alive=75, max_headers=100,
+                 max_header_bytes=64 * 1024, read_timeout=30):
+        self.app = app
+        self.host = host
+        self.port = port
+        self.max_body = max_body
+        self.keep_alive = keep_alive
+        self.max_headers = max_headers
+        self.max_header_bytes = max_header_bytes
+        self.read_timeout = read_timeout
+        self.executor = ThreadPoolExecutor(workers)
+        self.loop = None
+        self._server = None
+        self._connections = set()
+
+    @classmethod
+    def from_env(cls, app, host='127.0.0.1', port=5000, environ=os.environ):
+        return cls(app, host, port,
+                   workers=int(environ.get('ASYNC_WORKERS', 32)),
+                   max_body=int(environ.get('ASYNC_MAX_BODY',
+                                            16 * 1024 * 1024)),
+                   keep_alive=float(environ.get('ASYNC_KEEP_ALIVE', 75)),
+                   max_headers=int(environ.get('ASYNC_MAX_HEADERS', 100)),
+                   max_header_bytes=int(environ.get('ASYNC_MAX_HEADER_BYTES',
+                                                    64 * 1024)),
+                   read_timeout=float(environ.get('ASYNC_READ_TIMEOUT', 30)))
+
+    async def start(self):
+        self.loop = asyncio.get_event_loop()
+        self._server = await asyncio.start_server(
+            self.handle, self.host, self.port)
+        # port 0 picks a free one
+        self.port = self._server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        self._server.close()
+        # idle keep-alive connections go at once, requests already running
+        # in the executor still finish and get their response
+        for task in list(self._connections):
+            task.cancel()
+        await asyncio.gather(*self._connections, return_exceptions=True)
+        await self._server.wait_closed()
+        self.executor.shutdown(wait=False)
+
+    def serve_forever(self):
+        loop = asyncio.get_event_loop()
+        loop.run_until_complete(self.start())
+        log.info('serving on http://%s:%s', self.host, self.port)
+        try:
+            loop.run_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            loop.run_until_complete(self.stop())
+
+    async def handle(self, reader, writer):
+        peer = writer.get_extra_info('peername') or ('', 0)
+        task = current_task()
+        self._connections.add(task)
+        try:
+            while True:
+                try:
+                    request_line = await asyncio.wait_for(
+                        reader.readline(), self.keep_alive)
+                except asyncio.TimeoutError:
+                    break
+                except (ValueError, asyncio.LimitOverrunError):
+                    # longer than the stream's 64KB line limit
+                    await self.error(writer, 414)
+                    break
+                if not request_line.strip():
+                    break
+                keep_alive = await self.handle_request(
+                    request_line, reader, writer, peer)
+                if not keep_alive:
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError,
+                asyncio.CancelledError):
+            pass
+        finally:
+            writer.close()
+            self._connections.discard(task)
+
+    async def handle_request(self, request_line, reader, writer, peer):
+        try:
+            method, target, version = request_line.decode('latin-1').split()
+        except ValueError:
+            await self.error(writer, 400)
+            return False
+
+        # the rest of the request has read_timeout to arrive, however slowly
+        # the client sends it
+        deadline = self.loop.time() + self.read_timeout
+
+        def read(coroutine):
+            return asyncio.wait_for(coroutine,
+                                    max(deadline - self.loop.time(), 0))
+
+        try:
+            headers = await read(self.read_headers(reader))
+            lookup = dict((name.lower(), value) for name, value in headers)
+            length, chunked = self.body_framing(headers)
+            if length > self.max_body:
+                raise RequestError(413)
+            expect = lookup.get('expect', '').lower()
+            if expect and expect != '100-continue':
+                raise RequestError(417)
+            if expect and (length or chunked) and version == 'HTTP/1.1':
+                # the client waits for this before sending the body
+                writer.write(b'HTTP/1.1 100 Continue\r\n\r\n')
+                await writer.drain()
+            if chunked:
+                body = await read(self.read_chunked(reader))
+            else:
+                body = await read(reader.readexactly(length)) if length \
+                    else b''
+        except asyncio.TimeoutError:
+            await self.error(writer, 408)
+            return False
+        except RequestError as e:
+            await self.error(writer, e.code)
+            return False
+
+        connection = lookup.get('connection', '').lower()
+        if version == 'HTTP/1.1':
+            keep_alive = connection != 'close'
+        else:
+            keep_alive = connection == 'keep-alive'
+
+        environ = self.environ(method, target, version, headers, body, peer)
+        chunks = asyncio.Queue(STREAM_QUEUE)
+        future = self.loop.run_in_executor(
+            self.executor, self.run_app, environ, chunks)
+        status, response_headers = await chunks.get()
+        keep_alive = await self.write_response(
+            writer, method, version, status, response_headers, chunks,
+            keep_alive)
+        await future
+        return keep_alive
+
+    async def read_headers(self, reader):
+        headers = []
+        size = 0
+        while True:
+            try:
+                line = await reader.readline()
+            except (ValueError, asyncio.LimitOverrunError):
+                raise RequestError(431)
+            if line in (b'\r\n', b'\n', b''):
+                return headers
+            size += len(line)
+            if len(headers) >= self.max_headers or \
+                    size > self.max_header_bytes:
+                raise RequestError(431)
+            name, _, value = line.decode('latin-1').partition(':')
+            headers.append((name.strip(), value.strip()))
+
+    def body_framing(self, headers):
+        # (content length, chunked) from every Content-Length and
+        # Transfer-Encoding header, not just the last of each
+        lengths = set()
+        codings = []
+        for name, value in headers:
+            name = name.lower()
+            if name == 'content-length':
+                lengths.update(part.strip() for part in value.split(','))
+            elif name == 'transfer-encoding':
+                codings.extend(part.strip().lower()
+                               for part in value.split(','))
+        if codings:
+            if lengths:
+                raise RequestError(400)
+            if codings != ['chunked']:
+                raise RequestError(501)
+            return 0, True
+        if len(lengths) > 1:
+            raise RequestError(400)
+        length = lengths.pop() if lengths else '0'
+        # int() would also take a sign, spaces or underscores
+        if not length.isdigit():
+            raise RequestError(400)
+        try:
+            return int(length), False
+        except ValueError:
+            raise RequestError(400)
+
+    async def read_chunked(self, reader):
+        body = []
+        size = 0
+        while True:
+            try:
+                line = await reader.readline()
+                chunk_size = int(line.split(b';', 1)[0].strip(), 16)
+            except (ValueError, asyncio.LimitOverrunError):
+                raise RequestError(400)
+            if chunk_size < 0:
+                raise RequestError(400)
+            if chunk_size == 0:
+                break
+            size += chunk_size
+            if size > self.max_body:
+                raise RequestError(413)
+            body.append(await reader.readexactly(chunk_size))
+            if await reader.readexactly(2) != b'\r\n':
+                raise RequestError(400)
+        # trailers are read and dropped
+        for _ in range(self.max_headers + 1):
+            try:
+                line = await reader.readline()
+            except (ValueError, asyncio.LimitOverrunError):
+                raise RequestError(431)
+            if line in (b'\r\n', b'\n', b''):
+                return b''.join(body)
+        raise RequestError(431)
+
+    def environ(self, method, target, version, headers, body, peer):
+        path, _, query = target.partition('?')
+        environ = {
+            'REQUEST_METHOD': method,
+            'SCRIPT_NAME': '',
+            # WSGI wants the decoded path as latin-1 text
+            'PATH_INFO': unquote(path, 'latin-1'),
+            'QUERY_STRING': query,
+            'SERVER_NAME': self.host,
+            'SERVER_PORT': str(self.port),
+            'SERVER_PROTOCOL': version,
+            'REMOTE_ADDR': peer[0],
+            'REMOTE_PORT': str(peer[1]),
+            'CONTENT_LENGTH': str(len(body)) if body else '',
+            'wsgi.version': (1, 0),
+            'wsgi.url_scheme': 'http',
+            'wsgi.input': io.BytesIO(body),
+            'wsgi.errors': sys.stderr,
+            'wsgi.multithread': True,
+            'wsgi.multiprocess': False,
+            'wsgi.run_once': False,
+        }
+        for name, value in headers:
+            key = name.upper().replace('-', '_')
+            if key == 'CONTENT_TYPE':
+                environ['CONTENT_TYPE'] = value
+            elif key not in ('CONTENT_LENGTH', 'TRANSFER_ENCODING'):
+                # the body is already decoded and its length set above
+                key = 'HTTP_' + key
+                if key in environ:
+                    value = environ[key] + ',' + value
+                environ[key] = value
+        return environ
+
+    def run_app(self, environ, chunks):
+        # runs on a worker thread; hands the status line and then each body
+        # chunk to the event loop, blocking only while a slow client's queue
+        # is full
+        def put(item):
+            asyncio.run_coroutine_threadsafe(
+                chunks.put(item), self.loop).result()
+
+        started = []
+        sent = []
+
+        def start_response(status, response_headers, exc_info=None):
+            if exc_info and sent:
+                raise exc_info[1].with_traceback(exc_info[2])
+            started[:] = [(status, response_headers)]
+
+        def send_headers():
+            if not sent:
+                put(started[0])
+                sent.append(True)
+
+        end = _END
+        try:
+            result = self.app(environ, start_response)
+            try:
+                for data in result:
+                    send_headers()
+                    if data:
+                        put(data)
+                send_headers()
+            finally:
+                if hasattr(result, 'close'):
+                    result.close()
+        except Exception:
+            log.exception('error handling %s %s', environ['REQUEST_METHOD'],
+                          environ['PATH_INFO'])
+            if sent:
+                # too late for a 500, cut the connection instead of ending
+                # the body as if it were complete
+                end = _ABORT
+            else:
+                put(('500 Internal Server Error', [('Content-Length', '0')]))
+        finally:
+            put(end)
+
+    async def write_response(self, writer, method, version, status, headers,
+                             chunks, keep_alive):
+        names = set(name.lower() for name, _ in headers)
+        code = int(status.split(None, 1)[0])
+        has_body = method != 'HEAD' and code not in (204, 304) and code >= 200
+        # without a length, HTTP/1.1 clients get a chunked body and HTTP/1.0
+        # clients read until we close
+        chunked = False
+        if has_body and 'content-length' not in names:
+            if version == 'HTTP/1.1':
+                chunked = True
+                headers = headers + [('Transfer-Encoding', 'chunked')]
+            else:
+                keep_alive = False
+        headers = headers + [('Connection',
+                              'keep-alive' if keep_alive else 'close')]
+
+        head = ['{0} {1}'.format(version, status)]
+        head.extend('{0}: {1}'.format(name, value) for name, value in headers)
+        writer.write(('\r\n'.join(head) + '\r\n\r\n').encode('latin-1'))
+
+        data = None
+        try:
+            while True:
+                data = await chunks.get()
+                if data is _END or data is _ABORT:
+                    break
+                if not has_body:
+                    continue
+                if chunked:
+                    writer.write('{0:x}\r\n'.format(len(data)).encode('ascii'))
+                    writer.write(data)
+                    writer.write(b'\r\n')
+                else:
+                    writer.write(data)
+                await writer.drain()
+        finally:
+            # a client that went away mustn't leave the app's thread blocked
+            # on a full queue
+            while data is not _END and data is not _ABORT:
+                data = await chunks.get()
+        if data is _ABORT:
+            return False
+        if chunked:
+            writer.write(b'0\r\n\r\n')
+        await writer.drain()
+        return keep_alive
+
+    async def error(self, writer, code):
+        reason = STATUS_TEXT[code]
+        writer.write('HTTP/1.1 {0} {1}\r\nContent-Length: 0\r\n'
+                     'Connection: close\r\n\r\n'.format(code, reason)
+                     .encode('latin-1'))
+        await writer.drain()
+
+
+def serve(app, host='127.0.0.1', port=5000):
+    AsyncioWSGIServer.from_env(app, host, port).serve_forever()
+
+
+def start_in_thread(app, host='127.0.0.1', port=0, **kwargs):
+    # runs a server on its own loop in a background thread, for tests and
+    # benchmarks; call stop_in_thread(server) when done
+    server = AsyncioWSGIServer(app, host, port, **kwargs)
+    loop = asyncio.new_event_loop()
+    ready = threading.Event()
+
+    def run():
+        asyncio.set_event_loop(loop)
+        loop.run_until_complete(server.start())
+        ready.set()
+        loop.run_forever()
+        loop.run_until_complete(server.stop())
+        loop.close()
+
+    server.thread = threading.Thread(target=run, daemon=True)
+    server.thread.start()
+    ready.wait()
+    return server
+
+
+def stop_in_thread(server):
+    server.loop.call_soon_threadsafe(server.loop.stop)
+    server.thread.join()
@@ -0,0 +1,62 @@
+import hashlib
+import hmac
+import os
+import threading
+import time
+from collections import OrderedDict
+
+
+# Remembers recently verified credentials so repeat requests from the same
+# client can skip the bcrypt check.
+#
+# Entries are keyed by username and hold an HMAC of the supplied password
+# (together with the stored hash it was verified against) under a random
+# per-process key, so plaintext passwords never sit in memory. Binding the
+# stored hash into the digest also means a password changed by another
+# process stops matching as soon as the new hash is read from the database.
+class CredentialCache(object):
+
+    def __init__(self, ttl=300, maxsize=1024):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._key = os.urandom(32)
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _digest(self, password, hashed):
+        if isinstance(hashed, str):
+            hashed = hashed.encode('utf-8')
+        message = hashed + b'\x00' + password.encode('utf-8')
+        return hmac.new(self._key, message, hashlib.sha256).digest()
+
+    def check(self, username, password, hashed):
+        digest = self._digest(password, hashed)
+        with self._lock:
+            entry = self._entries.get(username)
+            if entry is None:
+                return False
+            stored_digest, expires = entry
+            if expires < time.monotonic():
+                del self._entries[username]
+                return False
+            self._entries.move_to_end(username)
+        return hmac.compare_digest(stored_digest, digest)
+
+    def add(self, username, password, hashed):
+        digest = self._digest(password, hashed)
+        with self._lock:
+            self._entries[username] = (digest, time.monotonic() + self.ttl)
+            self._entries.move_to_end(username)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, username):
+        with self._lock:
+            self._entries.pop(username, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
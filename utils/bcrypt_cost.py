@@ -0,0 +1,104 @@
+import logging
+import os
+import threading
+import time
+
+import bcrypt
+
+# Picks the bcrypt cost factor for this process and keeps count of stored
+# hashes upgraded to it.
+#
+# Configured from the environment:
+#   BCRYPT_ROUNDS     use this cost factor as is
+#   BCRYPT_BUDGET_MS  otherwise, calibrate at startup to the highest cost
+#                     whose hash time on this machine fits the budget
+# With neither set the cost stays at DEFAULT_ROUNDS.
+
+log = logging.getLogger(__name__)
+
+MIN_ROUNDS = 4
+MAX_ROUNDS = 16
+DEFAULT_ROUNDS = 12
+
+
+def hash_rounds(hashed):
+    # bcrypt hashes look like $2b$12$<salt+hash>
+    if isinstance(hashed, str):
+        hashed = hashed.encode('utf-8')
+    try:
+        return int(hashed.split(b'$')[2])
+    except (IndexError, ValueError):
+        return None
+
+
+def time_hash(rounds, password=b'calibration password'):
+    start = time.perf_counter()
+    bcrypt.hashpw(password, bcrypt.gensalt(rounds))
+    return time.perf_counter() - start
+
+
+def calibrate(budget_seconds, min_rounds=MIN_ROUNDS, max_rounds=MAX_ROUNDS):
+    # each extra round doubles the work, so time the cheapest cost and
+    # extrapolate, then confirm the estimate and step down while it's over
+    base = max(time_hash(min_rounds), 1e-6)
+    rounds = min_rounds
+    while rounds < max_rounds and \
+            base * 2 ** (rounds + 1 - min_rounds) <= budget_seconds:
+        rounds += 1
+
+    elapsed = time_hash(rounds)
+    while rounds > min_rounds and elapsed > budget_seconds:
+        rounds -= 1
+        elapsed = time_hash(rounds)
+    return rounds, elapsed
+
+
+class BcryptCost(object):
+
+    def __init__(self, rounds=None, budget_ms=None):
+        self.budget_ms = budget_ms
+        self.measured_ms = None
+        self.rehashed = 0
+        self._rounds = rounds
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls, environ=os.environ):
+        rounds = environ.get('BCRYPT_ROUNDS')
+        budget = environ.get('BCRYPT_BUDGET_MS')
+        if rounds:
+            return cls(rounds=int(rounds))
+        if budget:
+            return cls(budget_ms=float(budget))
+        return cls(rounds=DEFAULT_ROUNDS)
+
+    @property
+    def rounds(self):
+        if self._rounds is None:
+            with self._lock:
+                if self._rounds is None:
+                    rounds, elapsed = calibrate(self.budget_ms / 1000.0)
+                    self.measured_ms = elapsed * 1000.0
+                    self._rounds = rounds
+                    log.info('bcrypt cost calibrated to %d (%.0f ms per hash, '
+                             'budget %.0f ms)', rounds, self.measured_ms,
+                             self.budget_ms)
+        return self._rounds
+
+    def needs_rehash(self, hashed):
+        return hash_rounds(hashed) != self.rounds
+
+    def record_rehash(self):
+        with self._lock:
+            self.rehashed += 1
+
+    def stats(self):
+        return {
+            'rounds': self.rounds,
+            'budget_ms': self.budget_ms,
+            'measured_ms': self.measured_ms,
+            'rehashed': self.rehashed,
+        }
+
+
+bcrypt_cost = BcryptCost.from_env()
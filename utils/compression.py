@@ -0,0 +1,92 @@
+import os
+import threading
+import time
+import zlib
+
+from flask import request
+
+# Negotiated gzip/deflate compression for JSON responses, applied in the
+# shared representation layer (utils.representation). Clients opt in with
+# Accept-Encoding; bodies under the size threshold are sent as they are.
+#
+# Configured from the environment:
+#   COMPRESS_MIN_SIZE  smallest body in bytes worth compressing (default 1024)
+#   COMPRESS_LEVEL     zlib level 1-9 (default 6)
+#
+# Per-endpoint byte counts and compression time are kept in stats so the
+# threshold and level can be tuned against real traffic.
+
+ENCODINGS = ['gzip', 'deflate']
+# zlib window bits selecting the container format
+WBITS = {'gzip': 16 + zlib.MAX_WBITS, 'deflate': zlib.MAX_WBITS}
+
+
+class CompressionStats(object):
+
+    def __init__(self):
+        self._endpoints = {}
+        self._lock = threading.Lock()
+
+    def record(self, endpoint, bytes_in, bytes_out, seconds):
+        with self._lock:
+            entry = self._endpoints.setdefault(endpoint, {
+                'responses': 0, 'compressed': 0, 'bytes_in': 0,
+                'bytes_out': 0, 'seconds': 0.0,
+            })
+            entry['responses'] += 1
+            entry['bytes_in'] += bytes_in
+            entry['bytes_out'] += bytes_out
+            entry['seconds'] += seconds
+            if bytes_out < bytes_in:
+                entry['compressed'] += 1
+
+    def snapshot(self):
+        with self._lock:
+            return dict((endpoint, dict(entry))
+                        for endpoint, entry in self._endpoints.items())
+
+
+class Compressor(object):
+
+    def __init__(self, min_size=1024, level=6):
+        self.min_size = min_size
+        self.level = level
+        self.stats = CompressionStats()
+
+    @classmethod
+    def from_env(cls, environ=os.environ):
+        return cls(min_size=int(environ.get('COMPRESS_MIN_SIZE', 1024)),
+                   level=int(environ.get('COMPRESS_LEVEL', 6)))
+
+    def compress(self, data, encoding):
+        compressor = zlib.compressobj(self.level, zlib.DEFLATED,
+                                      WBITS[encoding])
+        return compressor.compress(data) + compressor.flush()
+
+    def compress_response(self, response):
+        if (response.status_code < 200 or response.status_code in (204, 304)
+                or response.direct_passthrough
+                or 'Content-Encoding' in response.headers):
+            return response
+        response.vary.add('Accept-Encoding')
+
+        data = response.get_data()
+        encoding = request.accept_encodings.best_match(ENCODINGS)
+        if encoding is None or len(data) < self.min_size:
+            self.stats.record(request.endpoint, len(data), len(data), 0.0)
+            return response
+
+        start = time.perf_counter()
+        body = self.compress(data, encoding)
+        elapsed = time.perf_counter() - start
+        if len(body) >= len(data):
+            self.stats.record(request.endpoint, len(data), len(data), elapsed)
+            return response
+
+        response.set_data(body)
+        response.headers['Content-Encoding'] = encoding
+        self.stats.record(request.endpoint, len(data), len(body), elapsed)
+        return response
+
+
+compressor = Compressor.from_env()
@@ -0,0 +1,142 @@
+import os
+import threading
+
+from pymongo import MongoClient, monitoring
+
+# One configured MongoClient per process, shared by every app, model and
+# test in it.
+#
+# Clients are created with connect=False, so nothing touches the network
+# until the first operation; a client built while importing the app in a
+# pre-fork server's master is therefore safe to inherit. If a client has
+# been used and the process then forks, get_client notices the new pid and
+# builds a fresh client for the child instead of sharing sockets. Apps hold
+# an AppDatabase rather than a Database for the same reason: it asks
+# get_client again once it finds itself in a new process, where a Database
+# captured before the fork would keep using the parent's client.
+#
+# Settings come from app.config or the environment:
+#   MONGO_URI                          (default mongodb://localhost:27017/)
+#   MONGO_DBNAME                       (default develop_database)
+#   MONGO_MAX_POOL_SIZE                (default 100)
+#   MONGO_CONNECT_TIMEOUT_MS           (default 20000)
+#   MONGO_SOCKET_TIMEOUT_MS            (default none)
+#   MONGO_SERVER_SELECTION_TIMEOUT_MS  (default 30000)
+#
+# Every client reports its commands to the listeners added with
+# add_command_listener, whenever they were added.
+
+DEFAULTS = {
+    'MONGO_URI': 'mongodb://localhost:27017/',
+    'MONGO_DBNAME': 'develop_database',
+    'MONGO_MAX_POOL_SIZE': 100,
+    'MONGO_CONNECT_TIMEOUT_MS': 20000,
+    'MONGO_SOCKET_TIMEOUT_MS': None,
+    'MONGO_SERVER_SELECTION_TIMEOUT_MS': 30000,
+}
+
+_clients = {}
+_pid = None
+_lock = threading.Lock()
+_listeners = []
+
+
+class CommandDispatcher(monitoring.CommandListener):
+    # the one listener handed to each client; fans events out to whatever
+    # is in _listeners at the time
+
+    def started(self, event):
+        for listener in _listeners:
+            listener.started(event)
+
+    def succeeded(self, event):
+        for listener in _listeners:
+            listener.succeeded(event)
+
+    def failed(self, event):
+        for listener in _listeners:
+            listener.failed(event)
+
+
+_dispatcher = CommandDispatcher()
+
+
+def add_command_listener(listener):
+    if listener not in _listeners:
+        _listeners.append(listener)
+
+
+def config_from_env(environ=os.environ):
+    config = dict(DEFAULTS)
+    for key, default in DEFAULTS.items():
+        value = environ.get(key)
+        if value is None:
+            continue
+        if key in ('MONGO_URI', 'MONGO_DBNAME'):
+            config[key] = value
+        else:
+            config[key] = int(value)
+    return config
+
+
+def _settings(config):
+    merged = dict(DEFAULTS)
+    merged.update((key, config[key]) for key in DEFAULTS if key in config)
+    return merged
+
+
+def get_client(config=None):
+    global _pid
+    settings = _settings(config if config is not None else config_from_env())
+    key = tuple(sorted(
+        (name, value) for name, value in settings.items()
+        if name != 'MONGO_DBNAME'))
+
+    with _lock:
+        if _pid != os.getpid():
+            # forked since the clients were made; the parent's sockets and
+            # monitor threads don't belong to us
+            _clients.clear()
+            _pid = os.getpid()
+        client = _clients.get(key)
+        if client is None:
+            client = _clients[key] = MongoClient(
+                settings['MONGO_URI'],
+                maxPoolSize=settings['MONGO_MAX_POOL_SIZE'],
+                connectTimeoutMS=settings['MONGO_CONNECT_TIMEOUT_MS'],
+                socketTimeoutMS=settings['MONGO_SOCKET_TIMEOUT_MS'],
+                serverSelectionTimeoutMS=settings[
+                    'MONGO_SERVER_SELECTION_TIMEOUT_MS'],
+                event_listeners=[_dispatcher],
+                connect=False)
+        return client
+
+
+def get_database(config=None):
+    config = config if config is not None else config_from_env()
+    return get_client(config)[_settings(config)['MONGO_DBNAME']]
+
+
+class AppDatabase(object):
+    # app.db: forwards to the configured database on this process's client
+
+    def __init__(self, config=None):
+        config = config if config is not None else config_from_env()
+        self._config = _settings(config)
+        self._database = None
+        self._pid = None
+
+    def get(self):
+        if self._pid != os.getpid():
+            self._database = get_database(self._config)
+            self._pid = os.getpid()
+        return self._database
+
+    def __getattr__(self, name):
+        return getattr(self.get(), name)
+
+    def __getitem__(self, name):
+        return self.get()[name]
+
+    def __repr__(self):
+        return 'AppDatabase({0!r})'.format(self._config['MONGO_DBNAME'])
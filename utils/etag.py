@@ -0,0 +1,26 @@
+import hashlib
+
+from flask import Response, request
+from werkzeug.http import quote_etag
+
+# Conditional GET helpers. Tags are weak, since compressed and uncompressed
+# bodies of the same resource are the same representation for our clients.
+
+
+def make_etag(*parts):
+    key = '|'.join(str(part) for part in parts)
+    digest = hashlib.sha1(key.encode('utf-8'))
+    return digest.hexdigest()
+
+
+def etag_header(tag):
+    return quote_etag(tag, weak=True)
+
+
+def is_fresh(tag):
+    # True when the client's If-None-Match already names this version
+    return request.if_none_match.contains_weak(tag)
+
+
+def not_modified(tag):
+    return Response(status=304, headers={'ETag': etag_header(tag)})
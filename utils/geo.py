@@ -0,0 +1,130 @@
+import math
+
+# GeoJSON waypoints and the 2dsphere queries over them.
+#
+# A waypoint is either a plain name, as trips have always stored them, or a
+# document with a GeoJSON point:
+#
+#     {"name": "london", "location": {"type": "Point",
+#                                     "coordinates": [-0.1276, 51.5072]}}
+#
+# Only located waypoints are indexed by the 2dsphere index on
+# waypoints.location; plain names are kept as they are.
+
+EARTH_RADIUS_M = 6371008.8
+# default and largest radius for near queries, in metres
+DEFAULT_RADIUS = 50000
+MAX_RADIUS = 20000000
+# widest box side in degrees. Mongo draws a GeoJSON polygon's edges as great
+# circles while in_box checks a flat rectangle; up to 5 degrees they stay
+# within a few kilometres of each other, wider boxes drift apart fast.
+MAX_BOX_DEGREES = 5
+
+
+class GeoError(ValueError):
+    pass
+
+
+def parse_point(longitude, latitude):
+    try:
+        longitude = float(longitude)
+        latitude = float(latitude)
+    except (TypeError, ValueError):
+        raise GeoError('coordinates must be numbers')
+    if not (-180 <= longitude <= 180 and -90 <= latitude <= 90):
+        raise GeoError('coordinates must be [longitude, latitude] within '
+                       '[-180, 180] and [-90, 90]')
+    return {'type': 'Point', 'coordinates': [longitude, latitude]}
+
+
+def parse_waypoint(waypoint):
+    if isinstance(waypoint, str):
+        return waypoint
+    if not isinstance(waypoint, dict):
+        raise GeoError('waypoints must be names or objects')
+    waypoint = dict(waypoint)
+    location = waypoint.get('location')
+    if location is not None:
+        # a bare [lng, lat] pair is accepted as shorthand for a Point
+        if isinstance(location, dict):
+            if location.get('type') != 'Point':
+                raise GeoError('waypoint locations must be GeoJSON Points')
+            coordinates = location.get('coordinates')
+        else:
+            coordinates = location
+        if not isinstance(coordinates, (list, tuple)) or \
+                len(coordinates) != 2:
+            raise GeoError('a location needs [longitude, latitude]')
+        waypoint['location'] = parse_point(*coordinates)
+    return waypoint
+
+
+def parse_waypoints(waypoints):
+    # validates a trip's waypoints before they reach the 2dsphere index,
+    # which would otherwise reject the whole write
+    if waypoints is None:
+        return None
+    if not isinstance(waypoints, list):
+        raise GeoError('waypoints must be a list')
+    return [parse_waypoint(waypoint) for waypoint in waypoints]
+
+
+def parse_pair(text, name):
+    parts = (text or '').split(',')
+    if len(parts) != 2:
+        raise GeoError('{0} must be longitude,latitude'.format(name))
+    return parse_point(*parts)
+
+
+def parse_box(text):
+    # west,south,east,north
+    parts = (text or '').split(',')
+    if len(parts) != 4:
+        raise GeoError('box must be west,south,east,north')
+    south_west = parse_point(parts[0], parts[1])['coordinates']
+    north_east = parse_point(parts[2], parts[3])['coordinates']
+    west, south = south_west
+    east, north = north_east
+    if west >= east or south >= north:
+        raise GeoError('box must be west,south,east,north with west < east '
+                       'and south < north')
+    if east - west > MAX_BOX_DEGREES or north - south > MAX_BOX_DEGREES:
+        raise GeoError('box sides must be at most {0} degrees, use near '
+                       'with a radius for larger areas'.format(
+                           MAX_BOX_DEGREES))
+    return west, south, east, north
+
+
+def box_polygon(box):
+    west, south, east, north = box
+    return {'type': 'Polygon', 'coordinates': [[
+        [west, south], [east, south], [east, north], [west, north],
+        [west, south]]]}
+
+
+def near_query(point, radius):
+    return {'$nearSphere': {'$geometry': point, '$maxDistance': radius}}
+
+
+def within_query(box):
+    return {'$geoWithin': {'$geometry': box_polygon(box)}}
+
+
+def haversine(a, b):
+    # great-circle metres between two [longitude, latitude] pairs
+    lng1, lat1, lng2, lat2 = map(math.radians, (a[0], a[1], b[0], b[1]))
+    h = (math.sin((lat2 - lat1) / 2) ** 2 +
+         math.cos(lat1) * math.cos(lat2) * math.sin((lng2 - lng1) / 2) ** 2)
+    return 2 * EARTH_RADIUS_M * math.asin(min(1.0, math.sqrt(h)))
+
+
+def in_box(coordinates, box):
+    west, south, east, north = box
+    return west <= coordinates[0] <= east and south <= coordinates[1] <= north
+
+
+def located(trip):
+    # (position, waypoint) for each of the trip's waypoints with a location
+    return [(index, waypoint)
+            for index, waypoint in enumerate(trip.get('waypoints') or [])
+            if isinstance(waypoint, dict) and 'location' in waypoint]
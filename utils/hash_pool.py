@@ -0,0 +1,175 @@
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, TimeoutError
+from concurrent.futures.process import BrokenProcessPool
+
+import bcrypt
+
+# Runs bcrypt in a pool of worker processes so a burst of signups or logins
+# can't starve every other request of CPU. The number of hashes waiting for a
+# worker is bounded; once the queue is full callers get PoolBusy straight away
+# and the servers answer 503 with Retry-After instead of piling up work.
+# A hash that outlives HASH_POOL_TIMEOUT is shed the same way; it keeps its
+# place in the bound until its worker is done with it. A worker that dies
+# breaks its whole executor, which is then replaced with a fresh one.
+#
+# Configured from the environment:
+#   HASH_POOL_WORKERS      worker processes (default: cpu count, 0 = inline)
+#   HASH_POOL_QUEUE        hashes allowed to wait for a worker (default 32)
+#   HASH_POOL_TIMEOUT      seconds to wait for a result (default 30)
+#   HASH_POOL_RETRY_AFTER  Retry-After value sent when shedding load
+#                          (default 1)
+
+log = logging.getLogger(__name__)
+
+
+class PoolBusy(Exception):
+    pass
+
+
+def _hashpw(password, salt):
+    return bcrypt.hashpw(password, salt)
+
+
+class HashPool(object):
+
+    def __init__(self, workers=None, max_queue=32, timeout=30, retry_after=1):
+        if workers is None:
+            workers = os.cpu_count() or 1
+        self.workers = workers
+        self.max_queue = max_queue
+        self.timeout = timeout
+        self.retry_after = retry_after
+        self._slots = threading.BoundedSemaphore(max(workers, 1) + max_queue)
+        self._executor = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+        self.in_flight = 0
+        self.completed = 0
+        self.rejected = 0
+        self.timed_out = 0
+        self.total_seconds = 0.0
+        self.max_seconds = 0.0
+
+    @classmethod
+    def from_env(cls, environ=os.environ):
+        workers = environ.get('HASH_POOL_WORKERS')
+        return cls(workers=int(workers) if workers else None,
+                   max_queue=int(environ.get('HASH_POOL_QUEUE', 32)),
+                   timeout=float(environ.get('HASH_POOL_TIMEOUT', 30)),
+                   retry_after=int(environ.get('HASH_POOL_RETRY_AFTER', 1)))
+
+    def _get_executor(self):
+        # the executor is started on first use and again in a forked child,
+        # since worker processes are not inherited across fork
+        pid = os.getpid()
+        if self._executor is None or self._pid != pid:
+            with self._lock:
+                if self._executor is None or self._pid != pid:
+                    self._executor = ProcessPoolExecutor(self.workers)
+                    self._pid = pid
+        return self._executor
+
+    def _discard_executor(self, executor):
+        # a broken executor rejects every later submit; the next
+        # _get_executor starts a new one
+        with self._lock:
+            if self._executor is executor:
+                self._executor = None
+        executor.shutdown(wait=False)
+        log.warning('bcrypt pool worker died, restarting the pool')
+
+    def _submit(self, password, salt):
+        executor = self._get_executor()
+        try:
+            return executor, executor.submit(_hashpw, password, salt)
+        except BrokenProcessPool:
+            # broken by a hash that was already running
+            self._discard_executor(executor)
+            executor = self._get_executor()
+            return executor, executor.submit(_hashpw, password, salt)
+
+    def hashpw(self, password, salt):
+        if not self._slots.acquire(blocking=False):
+            with self._lock:
+                self.rejected += 1
+            log.warning('bcrypt pool full (%d in flight), shedding request',
+                        self.in_flight)
+            raise PoolBusy()
+
+        with self._lock:
+            self.in_flight += 1
+        start = time.monotonic()
+        if self.workers == 0:
+            try:
+                return _hashpw(password, salt)
+            finally:
+                self._finished(start)
+
+        try:
+            executor, future = self._submit(password, salt)
+        except Exception:
+            self._finished(start)
+            raise
+        # the slot is given back when the worker is done, not when we stop
+        # waiting for it
+        future.add_done_callback(lambda future: self._finished(start))
+        try:
+            return future.result(self.timeout)
+        except TimeoutError:
+            with self._lock:
+                self.timed_out += 1
+            log.warning('bcrypt hash took over %ss, shedding request',
+                        self.timeout)
+            raise PoolBusy()
+        except BrokenProcessPool:
+            # this hash's worker died; later ones get a new pool
+            self._discard_executor(executor)
+            raise PoolBusy()
+
+    def _finished(self, start):
+        elapsed = time.monotonic() - start
+        with self._lock:
+            self.in_flight -= 1
+            self.completed += 1
+            self.total_seconds += elapsed
+            self.max_seconds = max(self.max_seconds, elapsed)
+        self._slots.release()
+
+    def queue_depth(self):
+        # hashes submitted but not yet picked up by a worker
+        return max(self.in_flight - max(self.workers, 1), 0)
+
+    def stats(self):
+        with self._lock:
+            completed = self.completed
+            return {
+                'workers': self.workers,
+                'max_queue': self.max_queue,
+                'in_flight': self.in_flight,
+                'queue_depth': self.queue_depth(),
+                'completed': completed,
+                'rejected': self.rejected,
+                'timed_out': self.timed_out,
+                'avg_seconds': (self.total_seconds / completed
+                                if completed else 0.0),
+                'max_seconds': self.max_seconds,
+            }
+
+    def busy_response(self):
+        # (body, status, headers) tuple for flask_restful resources
+        return ({'error': 'Server busy, retry later.'},
+                503,
+                {'Retry-After': str(self.retry_after)})
+
+    def shutdown(self):
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=False)
+            self._executor = None
+
+
+hash_pool = HashPool.from_env()
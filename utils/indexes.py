@@ -0,0 +1,54 @@
+import logging
+import threading
+
+from pymongo.errors import OperationFailure
+
+# Declarative index bootstrap. Resources and models list the indexes their
+# queries rely on next to the code that issues those queries:
+#
+#     class Trip(Resource):
+#         collection = 'trips'
+#         indexes = [IndexModel([('user', ASCENDING), ('_id', ASCENDING)])]
+#
+# and each server builds them all once before serving its first request.
+# create_indexes is a no-op for indexes that already exist.
+#
+# An index the data can't satisfy, such as a unique username index over a
+# collection that already holds duplicates, is logged and skipped, and the
+# server runs without it until the data is fixed. Running a server's index
+# bootstrap once at deploy time surfaces that before any traffic does.
+
+log = logging.getLogger(__name__)
+
+
+def create_indexes(collection, indexes):
+    try:
+        collection.create_indexes(indexes)
+    except OperationFailure:
+        # duplicate keys and the like are data problems; serving without
+        # the index beats failing every request
+        log.exception('could not build indexes on %s, serving without them',
+                      collection.name)
+
+
+def ensure_indexes(db, resources):
+    for resource in resources:
+        indexes = getattr(resource, 'indexes', None)
+        if indexes:
+            create_indexes(db[resource.collection], indexes)
+
+
+def bootstrap_before_first_request(app, bootstrap):
+    # same as app.before_first_request, but safe when several threads take
+    # their first request at the same time
+    lock = threading.Lock()
+    state = {'done': False}
+
+    @app.before_request
+    def run_bootstrap():
+        if state['done']:
+            return
+        with lock:
+            if not state['done']:
+                bootstrap()
+                state['done'] = True
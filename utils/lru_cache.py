@@ -0,0 +1,104 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from bson import BSON
+
+# In-process LRU cache with a per-entry TTL and a memory bound.
+#
+# Sizes are estimated from the BSON encoding of the cached documents, which
+# tracks what they cost to hold far better than an entry count. Entries are
+# evicted least recently used first once either max_entries or max_bytes is
+# exceeded. Counters for hits, misses, evictions and expirations are kept so
+# the cache can be sized per worker.
+
+
+def bson_size(value):
+    if isinstance(value, dict):
+        return len(BSON.encode(value))
+    if isinstance(value, (list, tuple)):
+        return sum(bson_size(item) for item in value)
+    return 64
+
+
+class LRUTTLCache(object):
+
+    def __init__(self, max_entries=10000, max_bytes=8 * 1024 * 1024, ttl=30,
+                 sizeof=bson_size):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.sizeof = sizeof
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    @classmethod
+    def from_env(cls, prefix, environ=os.environ):
+        # e.g. TRIP_CACHE_MAX_ENTRIES, TRIP_CACHE_MAX_BYTES, TRIP_CACHE_TTL
+        return cls(
+            max_entries=int(environ.get(prefix + '_MAX_ENTRIES', 10000)),
+            max_bytes=int(environ.get(prefix + '_MAX_BYTES', 8 * 1024 * 1024)),
+            ttl=float(environ.get(prefix + '_TTL', 30)))
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            value, size, expires = entry
+            if expires < time.monotonic():
+                self._remove(key)
+                self.expirations += 1
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        size = self.sizeof(value)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            self._remove(key)
+            self._entries[key] = (value, size, time.monotonic() + self.ttl)
+            self.bytes += size
+            while (len(self._entries) > self.max_entries
+                   or self.bytes > self.max_bytes):
+                oldest = next(iter(self._entries))
+                self._remove(oldest)
+                self.evictions += 1
+
+    def delete(self, *keys):
+        with self._lock:
+            for key in keys:
+                self._remove(key)
+
+    def _remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.bytes -= entry[1]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.bytes = 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'bytes': self.bytes,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+            }
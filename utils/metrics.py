@@ -0,0 +1,246 @@
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+
+from flask import Response, g, has_request_context, request
+from pymongo import monitoring
+
+from utils import database
+from utils.bcrypt_cost import bcrypt_cost
+from utils.compression import compressor
+from utils.hash_pool import hash_pool
+
+# Per-request latency, split into phases, in Prometheus text format.
+#
+# init_app(app) times every request and serves GET /metrics. Inside a
+# request, time spent in
+#   auth           the servers' auth decorators (bcrypt, credential lookups)
+#   db             Mongo commands, measured by pymongo command monitoring
+#   serialization  JSON encoding and compression in utils.representation
+# is summed per phase and observed into per-endpoint histograms when the
+# request ends. Phases can overlap: auth includes the user lookup's db time.
+# Scraping only formats counters already held in memory.
+#
+# Other numbers (pool, cache, compression and bcrypt stats) come from
+# collectors read at scrape time: functions returning {name: value} or
+# {name: {((label, value), ...): value}}, exported as gauges. Gauge names
+# don't end in _total, which Prometheus keeps for counters.
+
+BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+           10.0)
+PHASES = ('auth', 'db', 'serialization')
+
+
+class Histogram(object):
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self):
+        total = 0
+        for bound, count in zip(self.buckets + (float('inf'),), self.counts):
+            total += count
+            yield bound, total
+
+
+class Registry(object):
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        # {(metric, labels): Histogram} and {(metric, labels): number}
+        self._histograms = {}
+        self._counters = {}
+
+    def observe(self, metric, labels, value):
+        key = (metric, labels)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram(self.buckets)
+            histogram.observe(value)
+
+    def inc(self, metric, labels, value=1):
+        key = (metric, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def render(self, collectors=()):
+        lines = []
+        typed = set()
+
+        def declare(metric, kind):
+            if metric not in typed:
+                typed.add(metric)
+                lines.append('# TYPE {0} {1}'.format(metric, kind))
+
+        with self._lock:
+            for (metric, labels), histogram in sorted(
+                    self._histograms.items()):
+                declare(metric, 'histogram')
+                for bound, total in histogram.cumulative():
+                    le = '+Inf' if bound == float('inf') else repr(bound)
+                    lines.append('{0}_bucket{1} {2}'.format(
+                        metric, format_labels(labels + (('le', le),)), total))
+                lines.append('{0}_sum{1} {2!r}'.format(
+                    metric, format_labels(labels), histogram.sum))
+                lines.append('{0}_count{1} {2}'.format(
+                    metric, format_labels(labels), histogram.count))
+            for (metric, labels), value in sorted(self._counters.items()):
+                declare(metric, 'counter')
+                lines.append('{0}{1} {2!r}'.format(
+                    metric, format_labels(labels), value))
+        for collector in collectors:
+            for metric, value in sorted(collector().items()):
+                if isinstance(value, dict):
+                    declare(metric, 'gauge')
+                    for labels, item in sorted(value.items()):
+                        lines.append('{0}{1} {2!r}'.format(
+                            metric, format_labels(labels), float(item)))
+                elif value is not None:
+                    declare(metric, 'gauge')
+                    lines.append('{0} {1!r}'.format(metric, float(value)))
+        lines.append('')
+        return '\n'.join(lines)
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(
+        '{0}="{1}"'.format(name, str(value).replace('\\', '\\\\')
+                           .replace('"', '\\"'))
+        for name, value in labels) + '}'
+
+
+def add_phase(name, seconds):
+    # no-op outside a request or in an app without init_app
+    if has_request_context():
+        phases = getattr(g, '_phases', None)
+        if phases is not None:
+            phases[name] = phases.get(name, 0.0) + seconds
+
+
+@contextmanager
+def phase(name):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        add_phase(name, time.perf_counter() - start)
+
+
+def timed(name):
+    # decorator form of phase()
+    def decorator(f):
+        @wraps(f)
+        def decorated(*args, **kwargs):
+            with phase(name):
+                return f(*args, **kwargs)
+        return decorated
+    return decorator
+
+
+class CommandTimer(monitoring.CommandListener):
+    # pymongo calls listeners on the thread that ran the command, which is
+    # the request's thread
+
+    def __init__(self, registry):
+        self.registry = registry
+
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        self.record(event, 'ok')
+
+    def failed(self, event):
+        self.record(event, 'error')
+
+    def record(self, event, outcome):
+        seconds = event.duration_micros / 1e6
+        add_phase('db', seconds)
+        labels = (('command', event.command_name), ('outcome', outcome))
+        self.registry.inc('mongo_commands_total', labels)
+        self.registry.inc('mongo_command_seconds_total', labels, seconds)
+
+
+registry = Registry()
+database.add_command_listener(CommandTimer(registry))
+
+
+def process_stats():
+    stats = dict(('hash_pool_' + name, value)
+                 for name, value in hash_pool.stats().items())
+    cost = bcrypt_cost.stats()
+    stats['bcrypt_rounds'] = cost['rounds']
+    stats['bcrypt_rehashed'] = cost['rehashed']
+    endpoints = compressor.stats.snapshot()
+    for field in ('responses', 'compressed', 'bytes_in', 'bytes_out',
+                  'seconds'):
+        stats['compression_{0}'.format(field)] = dict(
+            ((('endpoint', endpoint),), entry[field])
+            for endpoint, entry in endpoints.items())
+    return stats
+
+
+def cache_stats(name, cache):
+    # collector for an LRUTTLCache, or anything with a length
+    labels = (('cache', name),)
+
+    def collect():
+        if hasattr(cache, 'stats'):
+            stats = cache.stats()
+        else:
+            stats = {'entries': len(cache)}
+        return dict(('cache_' + field, {labels: value})
+                    for field, value in stats.items())
+    return collect
+
+
+def init_app(app, collectors=()):
+    collectors = (process_stats,) + tuple(collectors)
+
+    @app.before_request
+    def start_timer():
+        g._request_start = time.perf_counter()
+        g._phases = {}
+
+    def record_request(response):
+        start = getattr(g, '_request_start', None)
+        if start is None or request.endpoint == 'metrics':
+            return response
+        labels = (('endpoint', request.endpoint or 'none'),
+                  ('method', request.method))
+        registry.observe('http_request_duration_seconds', labels,
+                         time.perf_counter() - start)
+        for name in PHASES:
+            registry.observe('http_request_phase_seconds',
+                             labels + (('phase', name),),
+                             g._phases.get(name, 0.0))
+        registry.inc('http_requests_total',
+                     labels + (('status', response.status_code),))
+        return response
+
+    # after_request functions run last registered first; putting this one at
+    # the front makes it run after every other, so db time spent in them,
+    # such as the unit of work's flush, is counted whatever order the
+    # extensions were set up in
+    app.after_request_funcs.setdefault(None, []).insert(0, record_request)
+
+    def metrics():
+        return Response(registry.render(collectors),
+                        content_type='text/plain; version=0.0.4; '
+                                     'charset=utf-8')
+
+    app.add_url_rule('/metrics', 'metrics', metrics)
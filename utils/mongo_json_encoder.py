@@ -1,10 +1,13 @@
 import json
-from bson.objectid import ObjectId
+from utils.serializer import bson_default
 
 # Custom JSONEncoder that extracts the strings from MongoDB ObjectIDs
 # Thanks to http://stackoverflow.com/questions/16586180/typeerror-objectid-is-not-json-serializable
+# Kept for existing callers; the servers use utils.serializer, which shares
+# these conversions for the other BSON types as well.
 class JSONEncoder(json.JSONEncoder):
     def default(self, o):
-        if isinstance(o, ObjectId):
-            return str(o)
-        return json.JSONEncoder.default(self, o)
+        try:
+            return bson_default(o)
+        except TypeError:
+            return json.JSONEncoder.default(self, o)
@@ -0,0 +1,92 @@
+from bson.objectid import ObjectId
+from bson.errors import InvalidId
+from pymongo import ASCENDING
+
+# Keyset pagination over _id and incremental JSON array output, so listing
+# endpoints never have to hold a user's whole collection in memory.
+
+DEFAULT_LIMIT = 50
+MAX_LIMIT = 500
+STREAM_BATCH_SIZE = 100
+# deepest page a ranked listing serves, every page skips the ones before it
+MAX_OFFSET = 10000
+
+
+class PageError(ValueError):
+    pass
+
+
+def parse_page_args(args):
+    # reads ?limit=&after= from request.args, raising PageError on bad input
+    try:
+        limit = int(args.get('limit', DEFAULT_LIMIT))
+    except ValueError:
+        raise PageError('limit must be an integer')
+    if limit < 1:
+        raise PageError('limit must be positive')
+
+    after = args.get('after')
+    if after:
+        try:
+            after = ObjectId(after)
+        except (InvalidId, TypeError):
+            raise PageError('after must be a cursor from a previous page')
+    return min(limit, MAX_LIMIT), after or None
+
+
+def keyset_page(collection, query, limit, after=None):
+    # one page in _id order plus the cursor for the next one (None at the
+    # end); we fetch a single extra document to know whether there's more
+    page_query = dict(query)
+    if after is not None:
+        page_query['_id'] = {'$gt': after}
+    cursor = collection.find(page_query).sort('_id', ASCENDING)
+    cursor = cursor.limit(limit + 1)
+    documents = list(cursor)
+
+    next_cursor = None
+    if len(documents) > limit:
+        documents = documents[:limit]
+        next_cursor = str(documents[-1]['_id'])
+    return documents, next_cursor
+
+
+def parse_offset(args):
+    # reads ?offset= for ranked listings, which can't page by _id
+    try:
+        offset = int(args.get('offset', 0))
+    except ValueError:
+        raise PageError('offset must be an integer')
+    if not 0 <= offset <= MAX_OFFSET:
+        raise PageError('offset must be between 0 and {0}'.format(MAX_OFFSET))
+    return offset
+
+
+def text_page(collection, query, search, limit, offset=0):
+    # one page of a $text search, best match first, each document with its
+    # score; the next page starts at the returned offset (None at the end)
+    page_query = dict(query)
+    page_query['$text'] = {'$search': search}
+    score = {'$meta': 'textScore'}
+    cursor = collection.find(page_query, {'score': score}).sort(
+        [('score', score), ('_id', ASCENDING)]).skip(offset).limit(limit + 1)
+    documents = list(cursor)
+
+    next_offset = None
+    if len(documents) > limit:
+        documents = documents[:limit]
+        next_offset = offset + limit
+    return documents, next_offset
+
+
+def stream_json_array(documents, encode):
+    # yields a JSON array one encoded document at a time
+    yield '['
+    first = True
+    for document in documents:
+        if first:
+            first = False
+            yield encode(document)
+        else:
+            yield ',' + encode(document)
+    yield ']'
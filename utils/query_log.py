@@ -0,0 +1,220 @@
+import logging
+import os
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from bson.son import SON
+from flask import g, has_request_context, request
+from pymongo import monitoring
+
+from utils import database
+
+# Slow-query log and per-request query counts from pymongo command
+# monitoring.
+#
+#  - any command slower than SLOW_QUERY_MS (default 100) is logged with its
+#    filter and the code that issued it
+#  - a request issuing more than QUERY_COUNT_WARN commands (default 20) is
+#    logged with its queries grouped by issuing resource method, which is
+#    what an N+1 pattern looks like
+#  - find, count and aggregate commands are explained once per query shape
+#    after the request that issued them (QUERY_EXPLAIN=all) or only when
+#    they were slow (QUERY_EXPLAIN=slow, the default; off disables it),
+#    warning about plans that scan the whole collection. Explains run on a
+#    background thread, never on the request's.
+#
+# Every query is attributed to the endpoint and method it ran under, e.g.
+# trip.get. Slow ones also name the first frame of our own code that sent
+# them, e.g. OOPModel.py:87 _queryload; walking the stack for that is kept
+# off the path of ordinary queries.
+
+log = logging.getLogger(__name__)
+
+EXPLAINABLE = ('find', 'count', 'aggregate')
+# how many query shapes we remember having explained
+MAX_EXPLAINED = 10000
+# pymongo's own frames and the standard library's
+LIBRARY_PATHS = tuple(os.path.dirname(module.__file__) for module in
+                      (monitoring, os))
+
+
+def find_site(frame, limit=64):
+    # the first frame of our own code on the stack, as 'file:line function'
+    while frame is not None and limit:
+        code = frame.f_code
+        filename = code.co_filename
+        if filename != __file__ and not filename.startswith(LIBRARY_PATHS) \
+                and 'site-packages' not in filename:
+            return '{0}:{1} {2}'.format(os.path.basename(filename),
+                                        frame.f_lineno, code.co_name)
+        frame = frame.f_back
+        limit -= 1
+    return None
+
+
+def request_resource():
+    if not has_request_context():
+        return None
+    return '{0}.{1}'.format(request.endpoint, request.method.lower())
+
+
+def query_shape(command_name, command):
+    # the collection plus the fields queried on, values left out
+    collection = command.get(command_name)
+    if command_name == 'aggregate':
+        stages = command.get('pipeline') or [{}]
+        query = stages[0].get('$match', {})
+    else:
+        query = command.get('filter') or command.get('query') or {}
+    return (command_name, str(collection), tuple(sorted(query)))
+
+
+def has_collscan(plan):
+    if isinstance(plan, dict):
+        if plan.get('stage') == 'COLLSCAN':
+            return True
+        return any(has_collscan(value) for value in plan.values())
+    if isinstance(plan, list):
+        return any(has_collscan(value) for value in plan)
+    return False
+
+
+class QueryLog(monitoring.CommandListener):
+
+    def __init__(self, slow_ms=100, max_queries=20, explain='slow'):
+        self.slow_ms = slow_ms
+        self.max_queries = max_queries
+        self.explain = explain
+        # (connection_id, request_id) -> (database name, command) between
+        # started and finished
+        self._started = {}
+        self._explained = set()
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        # one thread, so explains queue up rather than load the server
+        self._explainer = ThreadPoolExecutor(1)
+
+    @classmethod
+    def from_env(cls, environ=os.environ):
+        return cls(slow_ms=float(environ.get('SLOW_QUERY_MS', 100)),
+                   max_queries=int(environ.get('QUERY_COUNT_WARN', 20)),
+                   explain=environ.get('QUERY_EXPLAIN', 'slow'))
+
+    def started(self, event):
+        if getattr(self._local, 'explaining', False):
+            return
+        key = (event.connection_id, event.request_id)
+        self._started[key] = (event.database_name, event.command)
+
+    def succeeded(self, event):
+        self.finished(event)
+
+    def failed(self, event):
+        self.finished(event)
+
+    def finished(self, event):
+        started = self._started.pop(
+            (event.connection_id, event.request_id), None)
+        if started is None:
+            return
+        database_name, command = started
+        ms = event.duration_micros / 1000.0
+        slow = ms >= self.slow_ms
+        queries = None
+        if has_request_context():
+            queries = getattr(g, '_queries', None)
+        if not slow and queries is None:
+            return
+
+        resource = request_resource()
+        shape = query_shape(event.command_name, command)
+        if slow:
+            # pymongo calls us on the thread that sent the command, so the
+            # stack still shows who did
+            site = find_site(sys._getframe(1))
+            log.warning('slow %s on %s.%s took %.1fms from %s (%s): %s',
+                        event.command_name, database_name, shape[1], ms,
+                        resource or 'no resource', site,
+                        command.get('filter', command.get('query', '')))
+        if queries is not None:
+            queries.append((shape, resource, ms))
+            if event.command_name in EXPLAINABLE and (
+                    self.explain == 'all' or
+                    (self.explain == 'slow' and slow)):
+                g._explain.append((database_name, command, shape,
+                                   resource))
+
+    def begin_request(self):
+        g._queries = []
+        g._explain = []
+
+    def end_request(self, db):
+        queries = getattr(g, '_queries', None)
+        if queries is None:
+            return
+        g._queries = None
+        if len(queries) > self.max_queries:
+            self.report(queries)
+        for database_name, command, shape, resource in g._explain:
+            self._explainer.submit(self.check_plan,
+                                   db.client[database_name], command, shape,
+                                   resource)
+
+    def report(self, queries):
+        groups = {}
+        for shape, resource, ms in queries:
+            key = (resource, shape)
+            count, total = groups.get(key, (0, 0.0))
+            groups[key] = (count + 1, total + ms)
+        lines = ['{0}x {1} {2} on {3} from {4}, {5:.1f}ms'.format(
+            count, shape[0], list(shape[2]), shape[1],
+            resource or 'no resource', total)
+            for (resource, shape), (count, total) in sorted(
+                groups.items(), key=lambda item: -item[1][0])]
+        log.warning('%s %s issued %d queries (over %d):\n  %s',
+                    request.method, request.path, len(queries),
+                    self.max_queries, '\n  '.join(lines))
+
+    def check_plan(self, db, command, shape, resource):
+        # runs on the explainer thread
+        with self._lock:
+            if shape in self._explained:
+                return
+            if len(self._explained) >= MAX_EXPLAINED:
+                self._explained.clear()
+            self._explained.add(shape)
+
+        # the command name has to stay the first key
+        command = SON((key, value) for key, value in command.items()
+                      if not key.startswith('$') and key != 'lsid')
+        self._local.explaining = True
+        try:
+            plan = db.command('explain', command, verbosity='queryPlanner')
+        except Exception as e:
+            log.debug('could not explain %s: %s', shape, e)
+            return
+        finally:
+            self._local.explaining = False
+        planner = plan.get('queryPlanner', plan)
+        if has_collscan(planner.get('winningPlan', planner)):
+            log.warning('%s on %s by %s scans the whole collection, '
+                        'no index covers %s', shape[0], shape[1],
+                        resource or 'no resource', list(shape[2]))
+
+
+query_log = QueryLog.from_env()
+database.add_command_listener(query_log)
+
+
+def init_app(app):
+
+    @app.before_request
+    def begin_request():
+        query_log.begin_request()
+
+    # a teardown, so queries from other after_request hooks (the unit of
+    # work's flush) are counted too
+    @app.teardown_request
+    def end_request(exc):
+        query_log.end_request(app.db)
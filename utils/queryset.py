@@ -0,0 +1,89 @@
+import copy
+
+from pymongo import ASCENDING
+
+
+# Lazy, chainable query over a DBModel collection, returned by DBModel.fetch.
+# Nothing is sent to MongoDB until the query set is iterated, counted or
+# checked with exists(); iterating streams model instances as the cursor
+# pulls batches from the server instead of building a list up front.
+#
+#     trips = Trip.fetch({'username': username}).sort('_id').limit(20)
+#     for trip in trips:
+#         ...
+class QuerySet(object):
+
+    def __init__(self, model, query=None):
+        self.model = model
+        self.query = query or {}
+        self._limit = 0
+        self._skip = 0
+        self._sort = None
+        self._projection = None
+        self._batch_size = 0
+
+    def _clone(self, **changes):
+        clone = copy.copy(self)
+        clone.__dict__.update(changes)
+        return clone
+
+    def limit(self, count):
+        return self._clone(_limit=count)
+
+    def skip(self, count):
+        return self._clone(_skip=count)
+
+    def sort(self, key_or_list, direction=ASCENDING):
+        if isinstance(key_or_list, str):
+            key_or_list = [(key_or_list, direction)]
+        return self._clone(_sort=list(key_or_list))
+
+    def projection(self, *fields):
+        return self._clone(_projection=list(fields))
+
+    def batch_size(self, count):
+        return self._clone(_batch_size=count)
+
+    def _cursor(self):
+        cursor = self.model._collection().find(self.query, self._projection)
+        if self._sort:
+            cursor = cursor.sort(self._sort)
+        if self._skip:
+            cursor = cursor.skip(self._skip)
+        if self._limit:
+            cursor = cursor.limit(self._limit)
+        if self._batch_size:
+            cursor = cursor.batch_size(self._batch_size)
+        return cursor
+
+    def __iter__(self):
+        # documents already loaded in this request come back as the same
+        # model instance (see utils.unit_of_work)
+        partial = self._projection is not None
+        for document in self._cursor():
+            yield self.model._from_document(document, partial=partial)
+
+    def count(self):
+        # counted by the server, honouring skip and limit
+        options = {}
+        if self._skip:
+            options['skip'] = self._skip
+        if self._limit:
+            options['limit'] = self._limit
+        return self.model._collection().count_documents(self.query,
+                                                        **options)
+
+    def exists(self):
+        # whether this page has any documents, so skip applies; a limit
+        # can't empty a page and the order doesn't change whether one exists
+        collection = self.model._collection()
+        return collection.find_one(self.query, {'_id': True},
+                                   skip=self._skip) is not None
+
+    def first(self):
+        for model in self.limit(1):
+            return model
+        return None
+
+    def all(self):
+        return list(self)
@@ -0,0 +1,14 @@
+from flask import make_response
+
+from utils import metrics, serializer
+from utils.compression import compressor
+
+
+# The JSON representation every server's output_json delegates to:
+# serialize with the shared serializer, then compress when the client
+# accepts it and the body is big enough.
+def json_response(data, code, headers=None):
+    with metrics.phase('serialization'):
+        resp = make_response(serializer.dumps(data), code)
+        resp.headers.extend(headers or {})
+        return compressor.compress_response(resp)
@@ -0,0 +1,123 @@
+import numpy
+
+from utils import geo
+
+# Route distance and visiting order for a trip's located waypoints.
+#
+# The pairwise great-circle distances come from one vectorized haversine
+# over every pair of waypoints. The order starts at the trip's first located
+# waypoint, visits the nearest unvisited one next, then 2-opt reverses
+# stretches of the route for as long as that makes it shorter. Routes are
+# open: they don't return to the start.
+#
+# Waypoints without a location take no part and are reported as unlocated.
+
+# bounds the n x n matrix, 2000 stops is 32MB of float64
+MAX_STOPS = 2000
+# 2-opt passes over the whole route; each is O(n^2), vectorized over one end
+MAX_PASSES = 50
+# improvements smaller than this many metres are float noise
+EPSILON = 1e-6
+
+
+class RouteError(ValueError):
+    pass
+
+
+def distance_matrix(coordinates):
+    # metres between every pair of [longitude, latitude] pairs
+    points = numpy.radians(numpy.asarray(coordinates, dtype=float))
+    points = points.reshape(-1, 2)
+    lng = points[:, 0]
+    lat = points[:, 1]
+    dlng = lng[:, None] - lng[None, :]
+    dlat = lat[:, None] - lat[None, :]
+    h = (numpy.sin(dlat / 2) ** 2 +
+         numpy.cos(lat)[:, None] * numpy.cos(lat)[None, :] *
+         numpy.sin(dlng / 2) ** 2)
+    return 2 * geo.EARTH_RADIUS_M * numpy.arcsin(
+        numpy.sqrt(numpy.clip(h, 0.0, 1.0)))
+
+
+def route_length(matrix, order):
+    order = numpy.asarray(order)
+    if len(order) < 2:
+        return 0.0
+    return float(matrix[order[:-1], order[1:]].sum())
+
+
+def nearest_neighbor(matrix, start=0):
+    n = len(matrix)
+    visited = numpy.zeros(n, dtype=bool)
+    order = [start]
+    visited[start] = True
+    for _ in range(n - 1):
+        distances = numpy.where(visited, numpy.inf, matrix[order[-1]])
+        stop = int(distances.argmin())
+        order.append(stop)
+        visited[stop] = True
+    return order
+
+
+def two_opt(matrix, order, max_passes=MAX_PASSES):
+    # Reversing order[i:j + 1] swaps the edges (i - 1, i) and (j, j + 1) for
+    # (i - 1, j) and (i, j + 1). A zero-distance stop appended to the end
+    # stands in for the missing j + 1 when j is the last stop, so the end of
+    # the route is free to move while the start stays put.
+    n = len(order)
+    if n < 4:
+        return list(order)
+    padded = numpy.zeros((n + 1, n + 1))
+    padded[:n, :n] = matrix
+    route = numpy.append(numpy.asarray(order), n)
+
+    for _ in range(max_passes):
+        improved = False
+        for i in range(1, n - 1):
+            a, b = route[i - 1], route[i]
+            c = route[i + 1:n]
+            d = route[i + 2:n + 1]
+            delta = (padded[a, c] + padded[b, d] -
+                     padded[a, b] - padded[c, d])
+            k = int(delta.argmin())
+            if delta[k] < -EPSILON:
+                j = i + 1 + k
+                route[i:j + 1] = route[i:j + 1][::-1].copy()
+                improved = True
+        if not improved:
+            break
+    return [int(stop) for stop in route[:n]]
+
+
+def plan_route(trip, max_stops=MAX_STOPS):
+    # distances are in metres; orders are positions in trip['waypoints']
+    stops = geo.located(trip)
+    positions = [index for index, _ in stops]
+    located = set(positions)
+    unlocated = [index for index in range(len(trip.get('waypoints') or []))
+                 if index not in located]
+    if len(stops) > max_stops:
+        raise RouteError('routes are limited to {0} located waypoints'.format(
+            max_stops))
+
+    route = {'stops': len(stops), 'unlocated': unlocated,
+             'distance': 0.0, 'legs': [],
+             'optimized_order': positions, 'optimized_distance': 0.0}
+    if len(stops) < 2:
+        return route
+
+    matrix = distance_matrix([waypoint['location']['coordinates']
+                              for _, waypoint in stops])
+    current = list(range(len(stops)))
+    order = two_opt(matrix, nearest_neighbor(matrix))
+    route['distance'] = route_length(matrix, current)
+    route['legs'] = [float(leg) for leg in
+                     matrix[current[:-1], current[1:]]]
+    optimized = route_length(matrix, order)
+    # the heuristic isn't exact, never offer an order longer than the trip's
+    if optimized < route['distance']:
+        route['optimized_order'] = [positions[stop] for stop in order]
+        route['optimized_distance'] = optimized
+    else:
+        route['optimized_distance'] = route['distance']
+    return route
@@ -0,0 +1,105 @@
+import datetime
+import decimal
+import json
+import logging
+import os
+import uuid
+
+from bson.dbref import DBRef
+from bson.objectid import ObjectId
+from bson.regex import Regex
+from bson.timestamp import Timestamp
+
+# Shared JSON serialization for every server's output_json.
+#
+# Backends are picked with the JSON_SERIALIZER environment variable:
+#   json    the standard library encoder (default)
+#   orjson  much faster, used when the orjson package is installed
+# An unavailable backend falls back to json with a warning. Each backend is
+# built once and reused for every response.
+#
+# BSON values become JSON as follows:
+#   ObjectId, UUID, Decimal      string
+#   datetime, date               ISO 8601 string; naive datetimes are UTC,
+#                                as MongoDB returns them, and get a "Z"
+#   DBRef                        {"$ref": ..., "$id": ...}
+#   Timestamp                    {"t": ..., "i": ...}
+#   Regex                        its pattern
+# bytes and Binary raise TypeError like any other unknown type: binary
+# fields such as password hashes are left out by the handlers, never
+# turned into text on the way out.
+
+log = logging.getLogger(__name__)
+
+DEFAULT_BACKEND = 'json'
+
+
+def bson_default(o):
+    if isinstance(o, ObjectId):
+        return str(o)
+    if isinstance(o, datetime.datetime):
+        if o.tzinfo is None:
+            return o.isoformat() + 'Z'
+        return o.isoformat()
+    if isinstance(o, datetime.date):
+        return o.isoformat()
+    if isinstance(o, (uuid.UUID, decimal.Decimal)):
+        return str(o)
+    if isinstance(o, DBRef):
+        return {'$ref': o.collection, '$id': bson_default(o.id)}
+    if isinstance(o, Timestamp):
+        return {'t': o.time, 'i': o.inc}
+    if isinstance(o, Regex):
+        return o.pattern
+    raise TypeError('{0!r} is not JSON serializable'.format(o))
+
+
+class JSONSerializer(object):
+    name = 'json'
+
+    def __init__(self):
+        # a JSONEncoder keeps no per-call state, so one instance serves
+        # every request
+        self._encoder = json.JSONEncoder(default=bson_default)
+
+    def dumps(self, data):
+        return self._encoder.encode(data)
+
+
+class OrjsonSerializer(object):
+    name = 'orjson'
+
+    def __init__(self):
+        import orjson
+        self._dumps = orjson.dumps
+        self._options = orjson.OPT_NAIVE_UTC | orjson.OPT_UTC_Z
+
+    def dumps(self, data):
+        return self._dumps(data, default=bson_default,
+                           option=self._options).decode('utf-8')
+
+
+BACKENDS = {
+    'json': JSONSerializer,
+    'orjson': OrjsonSerializer,
+}
+
+_serializers = {}
+
+
+def get_serializer(name=None):
+    name = name or os.environ.get('JSON_SERIALIZER', DEFAULT_BACKEND)
+    serializer = _serializers.get(name)
+    if serializer is None:
+        try:
+            serializer = BACKENDS[name]()
+        except (KeyError, ImportError):
+            log.warning('JSON serializer %r unavailable, using %r',
+                        name, DEFAULT_BACKEND)
+            serializer = get_serializer(DEFAULT_BACKEND)
+        _serializers[name] = serializer
+    return serializer
+
+
+def dumps(data):
+    return get_serializer().dumps(data)
@@ -0,0 +1,121 @@
+from collections import OrderedDict
+
+from flask import g, current_app, has_request_context
+
+# Per-request identity map and unit of work for DBModel.
+#
+# While a request is being handled by an app set up with init_app(app):
+#   * every document a DBModel loads is remembered by (collection, _id), and
+#     plain equality queries (e.g. {'username': ...}) remember which _id they
+#     found, so loading the same document again is answered without MongoDB;
+#   * save() on a model that allows it only registers the model, and all
+#     registered saves are written together, one bulk_write per collection,
+#     after the view has returned a response below 400. Any other response
+#     discards them. save() returning True only means the write was queued;
+#     a failed flush raises out of after_request and the client gets a 500
+#     instead of the view's response.
+# Outside a request, or for apps that didn't opt in, models behave as before.
+
+EXTENSION_KEY = 'unit_of_work'
+
+
+class UnitOfWork(object):
+
+    def __init__(self):
+        self.identities = {}
+        self.lookups = {}
+        self.pending = OrderedDict()
+
+    @staticmethod
+    def _query_key(model_cls, query):
+        # only flat equality queries on hashable values can be remembered
+        try:
+            items = tuple(sorted(query.items()))
+            hash(items)
+        except TypeError:
+            return None
+        if any(isinstance(value, dict) for _, value in items):
+            return None
+        return (model_cls._collection().name, items)
+
+    @staticmethod
+    def _identity_key(model_cls, identifier):
+        return (model_cls._collection().name, identifier)
+
+    def get(self, model_cls, query):
+        if set(query) == {'_id'}:
+            return self.get_identity(model_cls, query['_id'])
+        key = self._query_key(model_cls, query)
+        if key is None or key not in self.lookups:
+            return None
+        return self.get_identity(model_cls, self.lookups[key])
+
+    def get_identity(self, model_cls, identifier):
+        return self.identities.get(self._identity_key(model_cls, identifier))
+
+    def add(self, model, query=None):
+        identifier = model.data.get('_id')
+        if identifier is None:
+            return
+        self.identities[self._identity_key(type(model), identifier)] = model
+        if query:
+            key = self._query_key(type(model), query)
+            if key is not None:
+                self.lookups[key] = identifier
+
+    def discard(self, model):
+        key = self._identity_key(type(model), model.data.get('_id'))
+        self.identities.pop(key, None)
+        self.pending.pop(key, None)
+
+    def register_save(self, model):
+        # keyed by document, so saving it twice still writes it once
+        key = self._identity_key(type(model), model.data['_id'])
+        self.pending[key] = model
+        self.add(model)
+
+    def rollback(self):
+        self.pending.clear()
+
+    def flush(self):
+        # group pending writes by model class so each collection gets a
+        # single bulk_write
+        pending = list(self.pending.values())
+        self.pending.clear()
+        by_class = OrderedDict()
+        for model in pending:
+            by_class.setdefault(type(model), []).append(model)
+        for model_cls, models in by_class.items():
+            model_cls.save_many(models)
+
+
+def current_unit_of_work():
+    if not has_request_context():
+        return None
+    if EXTENSION_KEY not in current_app.extensions:
+        return None
+    uow = getattr(g, '_unit_of_work', None)
+    if uow is None:
+        uow = g._unit_of_work = UnitOfWork()
+    return uow
+
+
+def init_app(app):
+    app.extensions[EXTENSION_KEY] = True
+
+    @app.after_request
+    def flush_unit_of_work(response):
+        # after_request also runs for error responses, including the ones
+        # flask_restful makes from exceptions; those write nothing
+        uow = getattr(g, '_unit_of_work', None)
+        if uow is not None:
+            if response.status_code < 400:
+                uow.flush()
+            else:
+                uow.rollback()
+        return response
+
+    @app.teardown_request
+    def drop_unit_of_work(exception=None):
+        # g outlives the request when an app context was pushed beforehand
+        g._unit_of_work = None
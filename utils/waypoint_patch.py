@@ -0,0 +1,112 @@
+import numbers
+
+from bson.objectid import ObjectId
+
+# Single waypoint edits as small atomic updates, instead of a PUT of the
+# whole trip:
+#
+#   {"op": "append", "waypoints": [...]}               $push $each
+#   {"op": "insert", "position": 2, "waypoints": [...]} $push $each $position
+#   {"op": "move", "from": 5, "to": 1}                 $set of the moved span
+#   {"op": "remove", "position": 3}                    $set a marker, $pull it
+#   {"op": "remove", "waypoints": [...]}               $pull of equal values
+#
+# "waypoint": w can stand in for "waypoints": [w]. plan_patch turns an
+# operation into (conditions, update) steps for the server to run against
+# the trip in order. Operations addressing waypoints by position are planned
+# from the trip as the server last read it, and each step's conditions pin
+# the waypoints it relies on, so a trip changed in between makes the step
+# match nothing rather than edit the wrong waypoint.
+
+OPERATIONS = ('append', 'insert', 'move', 'remove')
+# most waypoints one operation may add or remove
+MAX_WAYPOINTS = 500
+
+
+class PatchError(ValueError):
+    pass
+
+
+def parse_position(operation, name):
+    position = operation.get(name)
+    # bool is an int too
+    if not isinstance(position, numbers.Integral) or \
+            isinstance(position, bool) or position < 0:
+        raise PatchError('{0} must be a non-negative integer'.format(name))
+    return position
+
+
+def parse_patch(body, clean=None):
+    # validates a PATCH body; clean, if given, checks or normalizes each
+    # waypoint being added
+    if not isinstance(body, dict):
+        raise PatchError('Request requires a patch operation object')
+    op = body.get('op')
+    if op not in OPERATIONS:
+        raise PatchError('op must be one of ' + ', '.join(OPERATIONS))
+
+    operation = {'op': op}
+    if op in ('insert', 'move') or (op == 'remove' and 'position' in body):
+        for name in (('from', 'to') if op == 'move' else ('position',)):
+            operation[name] = parse_position(body, name)
+    if op in ('append', 'insert') or (op == 'remove' and
+                                      'position' not in body):
+        waypoints = body.get('waypoints')
+        if waypoints is None and 'waypoint' in body:
+            waypoints = [body['waypoint']]
+        if not isinstance(waypoints, list) or not waypoints:
+            raise PatchError('{0} requires a waypoint or a list of '
+                             'waypoints'.format(op))
+        if len(waypoints) > MAX_WAYPOINTS:
+            raise PatchError('At most {0} waypoints per operation'.format(
+                MAX_WAYPOINTS))
+        if clean is not None and op != 'remove':
+            waypoints = [clean(waypoint) for waypoint in waypoints]
+        operation['waypoints'] = waypoints
+    return operation
+
+
+def needs_waypoints(operation):
+    # whether plan_patch needs the trip's current waypoints
+    return operation['op'] == 'move' or (operation['op'] == 'remove' and
+                                         'position' in operation)
+
+
+def plan_patch(operation, waypoints=None):
+    op = operation['op']
+    if op == 'append':
+        return [({}, {'$push': {'waypoints': {
+            '$each': operation['waypoints']}}})]
+    if op == 'insert':
+        # a position past the end appends
+        return [({}, {'$push': {'waypoints': {
+            '$each': operation['waypoints'],
+            '$position': operation['position']}}})]
+    if op == 'remove' and 'position' not in operation:
+        return [({}, {'$pull': {'waypoints': {
+            '$in': operation['waypoints']}}})]
+
+    waypoints = waypoints or []
+    positions = ([operation['from'], operation['to']] if op == 'move'
+                 else [operation['position']])
+    if max(positions) >= len(waypoints):
+        raise PatchError('position is past the end of the trip\'s '
+                         '{0} waypoints'.format(len(waypoints)))
+
+    if op == 'remove':
+        # there's no remove by position, so the waypoint is swapped for a
+        # marker only this operation uses and the marker pulled next; pulling
+        # null after an $unset would take any null waypoints with it
+        key = 'waypoints.{0}'.format(operation['position'])
+        marker = {'_removed': ObjectId()}
+        return [({key: waypoints[operation['position']]},
+                 {'$set': {key: marker}}),
+                ({}, {'$pull': {'waypoints': marker}})]
+
+    # move rewrites only the span between its two positions
+    moved = list(waypoints)
+    moved.insert(operation['to'], moved.pop(operation['from']))
+    low, high = min(positions), max(positions)
+    keys = ['waypoints.{0}'.format(n) for n in range(low, high + 1)]
+    return [(dict(zip(keys, waypoints[low:high + 1])),
+             {'$set': dict(zip(keys, moved[low:high + 1]))})]
@@ -0,0 +1,730 @@
+import datetime
+import gzip
+import http.client
+import json
+import os
+import random
+import socket
+import time
+import unittest
+from concurrent.futures.process import BrokenProcessPool
+
+import bcrypt
+from bson.objectid import ObjectId
+from flask import Flask, Response, request
+from flask_restful import Resource, Api
+from pymongo.errors import DuplicateKeyError
+
+from utils.auth_cache import CredentialCache
+from utils.tokens import issue_token, verify_token
+from utils.hash_pool import HashPool, PoolBusy
+from utils.indexes import ensure_indexes
+from utils.bcrypt_cost import BcryptCost, calibrate, hash_rounds, MIN_ROUNDS
+from utils.queryset import QuerySet
+from utils.serializer import get_serializer, BACKENDS
+from utils.representation import json_response
+from utils.compression import compressor
+from utils.lru_cache import LRUTTLCache
+from utils import database, metrics
+from utils.query_log import QueryLog, has_collscan
+from utils import geo, routes, waypoint_patch
+from utils.asyncio_server import start_in_thread, stop_in_thread
+from benchmarks.load import percentile
+
+
+class CredentialCacheTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.cache = CredentialCache(ttl=60, maxsize=2)
+
+    def test_remembers_verified_password(self):
+        self.cache.add('doge', '1234', b'hash')
+        assert self.cache.check('doge', '1234', b'hash')
+        assert not self.cache.check('doge', 'wrong', b'hash')
+
+    def test_changed_hash_does_not_match(self):
+        self.cache.add('doge', '1234', b'hash')
+        assert not self.cache.check('doge', '1234', b'newhash')
+
+    def test_invalidate(self):
+        self.cache.add('doge', '1234', b'hash')
+        self.cache.invalidate('doge')
+        assert not self.cache.check('doge', '1234', b'hash')
+
+    def test_expired_entries_are_dropped(self):
+        cache = CredentialCache(ttl=-1)
+        cache.add('doge', '1234', b'hash')
+        assert not cache.check('doge', '1234', b'hash')
+        self.assertEqual(len(cache), 0)
+
+    def test_size_bound_evicts_oldest(self):
+        self.cache.add('a', '1', b'h')
+        self.cache.add('b', '2', b'h')
+        self.cache.add('c', '3', b'h')
+        self.assertEqual(len(self.cache), 2)
+        assert not self.cache.check('a', '1', b'h')
+        assert self.cache.check('c', '3', b'h')
+
+
+class TokenTestCase(unittest.TestCase):
+
+    def test_round_trip(self):
+        token = issue_token('secret', 'doge')
+        self.assertEqual(verify_token('secret', token), 'doge')
+
+    def test_rejects_wrong_key_and_garbage(self):
+        token = issue_token('secret', 'doge')
+        self.assertIsNone(verify_token('other', token))
+        self.assertIsNone(verify_token('secret', 'not-a-token'))
+
+    def test_rejects_expired_token(self):
+        token = issue_token('secret', 'doge')
+        self.assertIsNone(verify_token('secret', token, max_age=-1))
+
+    def test_rejects_old_generation_and_deleted_users(self):
+        token = issue_token('secret', 'doge', 2)
+        generations = {'doge': 2}
+        self.assertEqual(verify_token('secret', token,
+                                      generation_of=generations.get), 'doge')
+        generations['doge'] = 3
+        self.assertIsNone(verify_token('secret', token,
+                                       generation_of=generations.get))
+        self.assertIsNone(verify_token('secret', token,
+                                       generation_of={}.get))
+
+
+class HashPoolTestCase(unittest.TestCase):
+
+    def test_hashes_in_worker_process(self):
+        pool = HashPool(workers=1, max_queue=1)
+        try:
+            hashed = pool.hashpw(b'1234', bcrypt.gensalt(4))
+            self.assertEqual(pool.hashpw(b'1234', hashed), hashed)
+        finally:
+            pool.shutdown()
+        self.assertEqual(pool.stats()['completed'], 2)
+
+    def test_timeout_sheds_but_keeps_slot(self):
+        pool = HashPool(workers=1, max_queue=0, timeout=0.001)
+        try:
+            with self.assertRaises(PoolBusy):
+                pool.hashpw(b'1234', bcrypt.gensalt(10))
+            self.assertEqual(pool.stats()['timed_out'], 1)
+            # still hashing, so the pool is full until the worker finishes
+            if pool.stats()['in_flight']:
+                assert not pool._slots.acquire(blocking=False)
+            deadline = time.monotonic() + 30
+            while pool.stats()['in_flight'] and time.monotonic() < deadline:
+                time.sleep(0.01)
+            self.assertEqual(pool.stats()['completed'], 1)
+        finally:
+            pool.shutdown()
+
+    def test_replaces_broken_pool(self):
+        pool = HashPool(workers=1, max_queue=1)
+        try:
+            broken = pool._get_executor()
+            # a worker dying breaks the executor for every later hash
+            with self.assertRaises(BrokenProcessPool):
+                broken.submit(os._exit, 1).result(30)
+            hashed = pool.hashpw(b'1234', bcrypt.gensalt(4))
+            self.assertEqual(pool.hashpw(b'1234', hashed), hashed)
+            assert pool._get_executor() is not broken
+        finally:
+            pool.shutdown()
+
+    def test_sheds_load_when_full(self):
+        pool = HashPool(workers=0, max_queue=0)
+        pool._slots.acquire()
+        with self.assertRaises(PoolBusy):
+            pool.hashpw(b'1234', bcrypt.gensalt(4))
+        self.assertEqual(pool.stats()['rejected'], 1)
+        body, status, headers = pool.busy_response()
+        self.assertEqual(status, 503)
+        assert 'Retry-After' in headers
+
+
+class BcryptCostTestCase(unittest.TestCase):
+
+    def test_hash_rounds(self):
+        self.assertEqual(hash_rounds(bcrypt.hashpw(b'x', bcrypt.gensalt(5))), 5)
+        self.assertIsNone(hash_rounds(b'plaintext'))
+
+    def test_calibrate_respects_budget(self):
+        rounds, elapsed = calibrate(0.0)
+        self.assertEqual(rounds, MIN_ROUNDS)
+        rounds, elapsed = calibrate(0.05, max_rounds=8)
+        assert MIN_ROUNDS <= rounds <= 8
+
+    def test_needs_rehash(self):
+        cost = BcryptCost(rounds=5)
+        assert cost.needs_rehash(bcrypt.hashpw(b'x', bcrypt.gensalt(4)))
+        assert not cost.needs_rehash(bcrypt.hashpw(b'x', bcrypt.gensalt(5)))
+
+
+class QuerySetTestCase(unittest.TestCase):
+
+    def test_chaining_returns_new_query_sets(self):
+        base = QuerySet(object, {'username': 'doge'})
+        narrowed = base.sort('_id').skip(5).limit(10).projection('name')
+        self.assertEqual((base._limit, base._skip, base._sort), (0, 0, None))
+        self.assertEqual(narrowed._limit, 10)
+        self.assertEqual(narrowed._skip, 5)
+        self.assertEqual(narrowed._sort, [('_id', 1)])
+        self.assertEqual(narrowed._projection, ['name'])
+        self.assertEqual(narrowed.query, {'username': 'doge'})
+
+    def test_queries_sent(self):
+        calls = []
+
+        class Cursor(list):
+            def sort(self, keys):
+                calls.append(('sort', keys))
+                return self
+
+            def skip(self, count):
+                calls.append(('skip', count))
+                return self
+
+            def limit(self, count):
+                calls.append(('limit', count))
+                return self
+
+        class Collection(object):
+            def find(self, query, projection):
+                calls.append(('find', query, projection))
+                return Cursor([{'_id': 1}])
+
+            def count_documents(self, query, **options):
+                calls.append(('count_documents', query, options))
+                return 1
+
+            def find_one(self, query, projection, skip=0):
+                calls.append(('find_one', query, skip))
+                return None if skip else {'_id': 1}
+
+        class Model(object):
+            @classmethod
+            def _collection(cls):
+                return Collection()
+
+            @classmethod
+            def _from_document(cls, document, partial=False):
+                return document
+
+        trips = QuerySet(Model, {'username': 'doge'}).sort('_id').skip(5) \
+            .limit(10)
+        self.assertEqual(trips.count(), 1)
+        self.assertEqual(trips.all(), [{'_id': 1}])
+        self.assertEqual(calls, [
+            ('count_documents', {'username': 'doge'}, {'skip': 5,
+                                                       'limit': 10}),
+            ('find', {'username': 'doge'}, None),
+            ('sort', [('_id', 1)]), ('skip', 5), ('limit', 10)])
+
+        # a page past the end is empty even though the query matches
+        assert not trips.exists()
+        assert trips.skip(0).exists()
+        self.assertEqual(calls[-2:], [('find_one', {'username': 'doge'}, 5),
+                                      ('find_one', {'username': 'doge'}, 0)])
+
+
+class SerializerTestCase(unittest.TestCase):
+
+    def test_bson_types(self):
+        identifier = ObjectId()
+        document = {
+            '_id': identifier,
+            'created': datetime.datetime(2015, 9, 1, 12, 30),
+        }
+        for name in BACKENDS:
+            decoded = json.loads(get_serializer(name).dumps(document))
+            self.assertEqual(decoded['_id'], str(identifier))
+            self.assertEqual(decoded['created'], '2015-09-01T12:30:00Z')
+
+    def test_refuses_bytes(self):
+        # a password hash must never be turned into text by accident
+        hashed = bcrypt.hashpw(b'1234', bcrypt.gensalt(4))
+        for name in BACKENDS:
+            with self.assertRaises(TypeError):
+                get_serializer(name).dumps({'password': hashed})
+
+    def test_unknown_backend_falls_back(self):
+        self.assertEqual(get_serializer('nope').name, 'json')
+
+
+class CompressionTestCase(unittest.TestCase):
+
+    def setUp(self):
+        app = Flask(__name__)
+        api = Api(app)
+        size = {'n': 1}
+
+        class Waypoints(Resource):
+            def get(self):
+                return {'waypoints': ['london'] * size['n']}
+
+        api.add_resource(Waypoints, '/waypoints/')
+        api.representation('application/json')(json_response)
+        self.size = size
+        self.app = app.test_client()
+
+    def test_large_bodies_are_compressed(self):
+        self.size['n'] = 1000
+        response = self.app.get('/waypoints/',
+                                headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        body = json.loads(gzip.decompress(response.data).decode())
+        self.assertEqual(len(body['waypoints']), 1000)
+        assert 'Accept-Encoding' in response.headers['Vary']
+        assert compressor.stats.snapshot()['waypoints']['compressed'] >= 1
+
+    def test_small_or_unaccepted_bodies_are_not(self):
+        response = self.app.get('/waypoints/',
+                                headers={'Accept-Encoding': 'gzip'})
+        assert 'Content-Encoding' not in response.headers
+
+        self.size['n'] = 1000
+        response = self.app.get('/waypoints/')
+        assert 'Content-Encoding' not in response.headers
+
+
+class LRUTTLCacheTestCase(unittest.TestCase):
+
+    def test_hits_and_misses(self):
+        cache = LRUTTLCache()
+        self.assertIsNone(cache.get('trip'))
+        cache.set('trip', {'name': 'europe'})
+        self.assertEqual(cache.get('trip'), {'name': 'europe'})
+        stats = cache.stats()
+        self.assertEqual((stats['hits'], stats['misses']), (1, 1))
+
+    def test_memory_bound_evicts_least_recently_used(self):
+        cache = LRUTTLCache(max_bytes=100, sizeof=lambda value: 40)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(cache.stats()['evictions'], 1)
+        self.assertEqual(cache.stats()['bytes'], 80)
+
+    def test_expiry_and_delete(self):
+        cache = LRUTTLCache(ttl=-1)
+        cache.set('a', {'x': 1})
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(cache.stats()['expirations'], 1)
+
+        cache = LRUTTLCache()
+        cache.set('a', {'x': 1})
+        cache.delete('a', 'missing')
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(cache.stats()['bytes'], 0)
+
+
+class IndexesTestCase(unittest.TestCase):
+
+    def test_unbuildable_index_is_skipped(self):
+        built = []
+
+        class Collection(object):
+            def __init__(self, name):
+                self.name = name
+
+            def create_indexes(self, indexes):
+                if self.name == 'users':
+                    raise DuplicateKeyError('E11000 duplicate key error')
+                built.append(self.name)
+
+        class Users(object):
+            collection = 'users'
+            indexes = ['username']
+
+        class Trips(object):
+            collection = 'trips'
+            indexes = ['user']
+
+        db = dict((name, Collection(name)) for name in ('users', 'trips'))
+        with self.assertLogs('utils.indexes', 'ERROR'):
+            ensure_indexes(db, [Users, Trips])
+        self.assertEqual(built, ['trips'])
+
+
+class DatabaseTestCase(unittest.TestCase):
+
+    def test_config_from_env(self):
+        config = database.config_from_env({'MONGO_URI': 'mongodb://db:27017/',
+                                           'MONGO_MAX_POOL_SIZE': '20'})
+        self.assertEqual(config['MONGO_URI'], 'mongodb://db:27017/')
+        self.assertEqual(config['MONGO_MAX_POOL_SIZE'], 20)
+        self.assertEqual(config['MONGO_DBNAME'], 'develop_database')
+
+    def test_one_client_per_process_and_settings(self):
+        # clients connect lazily, so no server is needed here
+        first = database.get_client({'MONGO_DBNAME': 'a'})
+        self.assertIs(database.get_client({'MONGO_DBNAME': 'b'}), first)
+        self.assertIsNot(database.get_client({'MONGO_MAX_POOL_SIZE': 5}),
+                         first)
+        self.assertEqual(database.get_database({'MONGO_DBNAME': 'a'}).name,
+                         'a')
+
+        # a forked child must not reuse the parent's client
+        database._pid = -1
+        self.assertIsNot(database.get_client({'MONGO_DBNAME': 'a'}), first)
+
+    def test_app_database_follows_fork(self):
+        db = database.AppDatabase({'MONGO_DBNAME': 'a'})
+        self.assertEqual(db.name, 'a')
+        before = db.client
+        # as seen from a child process
+        database._pid = -1
+        db._pid = -1
+        self.assertIsNot(db.client, before)
+        self.assertEqual(db['trips'].name, 'trips')
+
+
+class AsyncioServerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        app = Flask(__name__)
+
+        @app.route('/echo/', methods=['POST'])
+        def echo():
+            return Response(request.get_data(), mimetype='application/json')
+
+        @app.route('/stream/')
+        def stream():
+            return Response((str(n) for n in range(5)))
+
+        self.server = start_in_thread(app)
+        self.conn = http.client.HTTPConnection('127.0.0.1', self.server.port)
+
+    def tearDown(self):
+        self.conn.close()
+        stop_in_thread(self.server)
+
+    def test_keep_alive_requests(self):
+        for n in range(3):
+            body = json.dumps({'n': n})
+            self.conn.request('POST', '/echo/', body,
+                              {'Content-Type': 'application/json'})
+            response = self.conn.getresponse()
+            self.assertEqual(response.status, 200)
+            self.assertEqual(response.read().decode(), body)
+
+        self.conn.request('GET', '/missing/')
+        response = self.conn.getresponse()
+        response.read()
+        self.assertEqual(response.status, 404)
+
+    def test_streamed_body_is_chunked(self):
+        self.conn.request('GET', '/stream/')
+        response = self.conn.getresponse()
+        self.assertEqual(response.getheader('Transfer-Encoding'), 'chunked')
+        self.assertEqual(response.read(), b'01234')
+
+    def test_oversized_headers_rejected(self):
+        for headers in ({'X-Big': 'a' * 70000},
+                        dict(('X-H{0}'.format(n), 'a') for n in range(200))):
+            conn = http.client.HTTPConnection('127.0.0.1', self.server.port)
+            conn.request('GET', '/stream/', headers=headers)
+            response = conn.getresponse()
+            self.assertEqual(response.status, 431)
+            conn.close()
+
+    def raw_request(self, *parts):
+        # sends each part in turn and returns whatever comes back
+        sock = socket.create_connection(('127.0.0.1', self.server.port))
+        try:
+            for part in parts:
+                sock.sendall(part)
+            received = b''
+            while True:
+                data = sock.recv(65536)
+                if not data:
+                    return received
+                received += data
+        finally:
+            sock.close()
+
+    def test_chunked_request_body(self):
+        self.conn.request('POST', '/echo/', body=iter([b'{"n": ', b'1}']),
+                          encode_chunked=True)
+        response = self.conn.getresponse()
+        self.assertEqual(response.status, 200)
+        self.assertEqual(response.read(), b'{"n": 1}')
+
+    def test_conflicting_framing_rejected(self):
+        for framing in (b'Content-Length: 2\r\nContent-Length: 12\r\n',
+                        b'Content-Length: 2\r\n'
+                        b'Transfer-Encoding: chunked\r\n'):
+            response = self.raw_request(
+                b'POST /echo/ HTTP/1.1\r\nHost: x\r\n' + framing +
+                b'\r\n{}')
+            assert response.startswith(b'HTTP/1.1 400 '), response
+
+    def test_expect_continue(self):
+        sock = socket.create_connection(('127.0.0.1', self.server.port))
+        try:
+            sock.sendall(b'POST /echo/ HTTP/1.1\r\nHost: x\r\n'
+                         b'Content-Length: 2\r\nExpect: 100-continue\r\n'
+                         b'Connection: close\r\n\r\n')
+            received = sock.makefile('rb')
+            self.assertEqual(received.readline(),
+                             b'HTTP/1.1 100 Continue\r\n')
+            self.assertEqual(received.readline(), b'\r\n')
+            sock.sendall(b'{}')
+            response = received.read()
+        finally:
+            sock.close()
+        assert response.startswith(b'HTTP/1.1 200 OK'), response
+        assert response.endswith(b'{}')
+
+    def test_slow_request_times_out(self):
+        self.server.read_timeout = 0.2
+        response = self.raw_request(b'POST /echo/ HTTP/1.1\r\n'
+                                    b'Content-Length: 2\r\n\r\n')
+        assert response.startswith(b'HTTP/1.1 408 '), response
+
+
+class MetricsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        app = Flask(__name__)
+        api = Api(app)
+
+        class FakeCommand(object):
+            command_name = 'find'
+            duration_micros = 2500
+
+        class Slow(Resource):
+            def get(self):
+                with metrics.phase('auth'):
+                    pass
+                metrics.CommandTimer(metrics.registry).succeeded(
+                    FakeCommand())
+                return {'ok': True}
+
+        api.add_resource(Slow, '/slow/')
+        api.representation('application/json')(json_response)
+        metrics.init_app(app, [metrics.cache_stats('test', LRUTTLCache())])
+        self.app = app.test_client()
+
+    def test_phases_are_exported(self):
+        self.app.get('/slow/')
+        response = self.app.get('/metrics')
+        self.assertEqual(response.status_code, 200)
+        text = response.data.decode()
+        for phase in ('auth', 'db', 'serialization'):
+            assert ('http_request_phase_seconds_count{endpoint="slow",'
+                    'method="GET",phase="' + phase + '"}') in text
+        assert ('http_request_phase_seconds_bucket{endpoint="slow",'
+                'method="GET",phase="db",le="0.005"}') in text
+        assert 'mongo_commands_total{command="find",outcome="ok"}' in text
+        assert 'cache_entries{cache="test"} 0.0' in text
+        assert 'hash_pool_in_flight' in text
+        # scrapes aren't timed themselves
+        assert 'endpoint="metrics"' not in text
+        assert 'compression_responses{endpoint="slow"}' in text
+        for line in text.splitlines():
+            if line.startswith('# TYPE') and line.endswith(' gauge'):
+                assert not line.split()[2].endswith('_total'), line
+
+    def test_later_after_request_work_is_timed(self):
+        app = Flask(__name__)
+        metrics.init_app(app)
+
+        @app.route('/deferred/')
+        def deferred():
+            return 'ok'
+
+        # registered after init_app, like the unit of work's flush
+        @app.after_request
+        def flush(response):
+            metrics.add_phase('db', 1.0)
+            return response
+
+        app.test_client().get('/deferred/')
+        histogram = metrics.registry._histograms[(
+            'http_request_phase_seconds',
+            (('endpoint', 'deferred'), ('method', 'GET'), ('phase', 'db')))]
+        self.assertGreaterEqual(histogram.sum, 1.0)
+
+
+class QueryLogTestCase(unittest.TestCase):
+
+    def setUp(self):
+        app = Flask(__name__)
+        api = Api(app)
+        self.query_log = query_log = QueryLog(slow_ms=50, max_queries=2,
+                                              explain='off')
+
+        class Event(object):
+            database_name = 'test_database'
+            command_name = 'find'
+            connection_id = ('localhost', 27017)
+
+            def __init__(self, request_id, duration_micros=1000):
+                self.request_id = request_id
+                self.duration_micros = duration_micros
+                self.command = {'find': 'trips', 'filter': {'user': 'x'}}
+
+        class Trips(Resource):
+            def get(self):
+                for n in range(3):
+                    query_log.started(Event(n))
+                    query_log.succeeded(Event(n, 100000 if n == 0 else 10))
+                return {}
+
+        api.add_resource(Trips, '/trips/')
+
+        @app.before_request
+        def begin_request():
+            query_log.begin_request()
+
+        @app.teardown_request
+        def end_request(exc):
+            query_log.end_request(None)
+
+        self.app = app.test_client()
+
+    def test_slow_and_repeated_queries_are_logged(self):
+        with self.assertLogs('utils.query_log', 'WARNING') as logs:
+            self.app.get('/trips/')
+        slow, repeated = logs.output
+        assert 'slow find on test_database.trips took 100.0ms' in slow
+        assert 'from trips.get (utilsTests.py:' in slow
+        assert 'GET /trips/ issued 3 queries (over 2)' in repeated
+        assert "3x find ['user'] on trips from trips.get" in repeated
+
+    def test_collscan_in_plan(self):
+        self.assertFalse(has_collscan(
+            {'stage': 'FETCH', 'inputStage': {'stage': 'IXSCAN'}}))
+        self.assertTrue(has_collscan(
+            {'stage': 'SORT', 'inputStage': {'stage': 'COLLSCAN'}}))
+        self.assertTrue(has_collscan(
+            {'stage': 'OR', 'inputStages': [{'stage': 'IXSCAN'},
+                                            {'stage': 'COLLSCAN'}]}))
+
+
+class GeoTestCase(unittest.TestCase):
+
+    def test_waypoints(self):
+        waypoints = geo.parse_waypoints([
+            'home', {'name': 'paris', 'location': [2.3522, 48.8566]}])
+        self.assertEqual(waypoints[0], 'home')
+        self.assertEqual(waypoints[1]['location'],
+                         {'type': 'Point', 'coordinates': [2.3522, 48.8566]})
+        self.assertEqual(geo.located({'waypoints': waypoints}),
+                         [(1, waypoints[1])])
+        for bad in ([{'location': [200, 0]}], [{'location': [1]}], 'paris',
+                    [{'location': {'type': 'Polygon'}}]):
+            self.assertRaises(geo.GeoError, geo.parse_waypoints, bad)
+
+    def test_box_and_distance(self):
+        box = geo.parse_box('-1,48,3,52')
+        self.assertTrue(geo.in_box([2.35, 48.85], box))
+        self.assertFalse(geo.in_box([31.2, 30.0], box))
+        self.assertRaises(geo.GeoError, geo.parse_box, '5,45,-5,55')
+        self.assertRaises(geo.GeoError, geo.parse_box, '-100,0,100,10')
+        self.assertRaises(geo.GeoError, geo.parse_box, '-80,40,80,50')
+        # London to Paris is about 344km
+        self.assertAlmostEqual(
+            geo.haversine([-0.1276, 51.5072], [2.3522, 48.8566]) / 1000,
+            344, delta=1)
+
+
+class RoutesTestCase(unittest.TestCase):
+
+    def located(self, *coordinates):
+        return [{'name': str(n), 'location': {'type': 'Point',
+                                              'coordinates': list(point)}}
+                for n, point in enumerate(coordinates)]
+
+    def test_distance_matrix_matches_haversine(self):
+        points = [[-0.1276, 51.5072], [2.3522, 48.8566], [31.2357, 30.0444]]
+        matrix = routes.distance_matrix(points)
+        for i, a in enumerate(points):
+            for j, b in enumerate(points):
+                self.assertAlmostEqual(matrix[i][j], geo.haversine(a, b),
+                                       delta=1e-3)
+
+    def test_untangles_route(self):
+        # along a line, visited out of order
+        trip = {'waypoints': ['home'] + self.located(
+            [0, 0], [3, 0], [1, 0], [2, 0], [4, 0])}
+        route = routes.plan_route(trip)
+        self.assertEqual(route['stops'], 5)
+        self.assertEqual(route['unlocated'], [0])
+        self.assertEqual(route['optimized_order'], [1, 3, 4, 2, 5])
+        self.assertLess(route['optimized_distance'], route['distance'])
+        self.assertAlmostEqual(sum(route['legs']), route['distance'])
+
+    def test_many_stops(self):
+        rng = random.Random(0)
+        trip = {'waypoints': self.located(*[
+            [rng.uniform(-10, 10), rng.uniform(40, 55)]
+            for _ in range(300)])}
+        route = routes.plan_route(trip)
+        self.assertEqual(sorted(route['optimized_order']), list(range(300)))
+        self.assertLess(route['optimized_distance'], route['distance'])
+        self.assertRaises(routes.RouteError, routes.plan_route, trip,
+                          max_stops=100)
+
+
+class WaypointPatchTestCase(unittest.TestCase):
+
+    def plan(self, body, waypoints=None):
+        return waypoint_patch.plan_patch(waypoint_patch.parse_patch(body),
+                                         waypoints)
+
+    def test_push_operations(self):
+        self.assertEqual(self.plan({'op': 'append', 'waypoint': 'rome'}),
+                         [({}, {'$push': {'waypoints': {'$each': ['rome']}}})])
+        self.assertEqual(
+            self.plan({'op': 'insert', 'position': 1, 'waypoints': ['a']}),
+            [({}, {'$push': {'waypoints': {'$each': ['a'],
+                                           '$position': 1}}})])
+
+    def test_positional_operations(self):
+        waypoints = ['a', 'b', 'c', 'd']
+        self.assertEqual(
+            self.plan({'op': 'move', 'from': 3, 'to': 1}, waypoints),
+            [({'waypoints.1': 'b', 'waypoints.2': 'c', 'waypoints.3': 'd'},
+              {'$set': {'waypoints.1': 'd', 'waypoints.2': 'b',
+                        'waypoints.3': 'c'}})])
+        steps = self.plan({'op': 'remove', 'position': 2}, waypoints)
+        marker = steps[0][1]['$set']['waypoints.2']
+        self.assertEqual(steps, [({'waypoints.2': 'c'},
+                                  {'$set': {'waypoints.2': marker}}),
+                                 ({}, {'$pull': {'waypoints': marker}})])
+        # each removal pulls only its own marker, never null waypoints
+        other = self.plan({'op': 'remove', 'position': 2}, waypoints)
+        self.assertNotEqual(other[1], steps[1])
+        self.assertIsNotNone(marker)
+        self.assertRaises(waypoint_patch.PatchError, self.plan,
+                          {'op': 'remove', 'position': 4}, waypoints)
+
+    def test_rejects_bad_operations(self):
+        for body in ({'op': 'sort'}, {'op': 'append'},
+                     {'op': 'insert', 'position': -1, 'waypoint': 'a'},
+                     {'op': 'move', 'from': True, 'to': 0}, []):
+            self.assertRaises(waypoint_patch.PatchError,
+                              waypoint_patch.parse_patch, body)
+
+
+class PercentileTestCase(unittest.TestCase):
+
+    def test_nearest_rank(self):
+        ordered = list(range(1, 101))
+        self.assertEqual(percentile(ordered, 0.95), 95)
+        self.assertEqual(percentile(ordered, 0.99), 99)
+        self.assertEqual(percentile(ordered, 1.0), 100)
+        self.assertEqual(percentile(list(range(1, 11)), 0.50), 5)
+        self.assertEqual(percentile([7], 0.5), 7)
+        self.assertIsNone(percentile([], 0.5))
+
+
+if __name__ == '__main__':
+    unittest.main()